@@ -1,14 +1,12 @@
 #usr/bin/env python3
 import streamlit as st
-import cv2
 import os
 from src.dewarping import ImageDewarper
 from src.preprocessing import ImagePreprocessor
 from src.ocr import TextExtractor
 from src.objects import ProcessedImage
-import numpy as np
-import tempfile
-import hashlib
+from src.utils.cache import hash_bytes
+from src.utils.imageio import decode_image
 
 ABSOLUTE_PATH = os.path.dirname(os.path.abspath(__file__))
 HELP_PATH = os.path.join(ABSOLUTE_PATH, 'docs/help')
@@ -27,32 +25,14 @@ class SingleOCR:
         if not ui.dewarp_button_state:
             return
 
-        # Dewarp the image and temporarily save it to a temp directory (mandatory for page-dewarp)
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            # Write the image to the temp directory
-            temp_image_path = os.path.join(tmpdirname, "temp_image.png")
-            cv2.imwrite(temp_image_path, ui_handler.processed_image.original_img)
-            
-            original_dir = os.getcwd()
-            os.chdir(tmpdirname)
+        # Dewarp the image in memory
+        dewarped_img = self.image_dewarper.dewarp_image(ui_handler.processed_image.original_img, additional_args=ui.get_args())
 
-            # Dewarp the image
-            self.image_dewarper.dewarp_single_image("temp_image.png", additional_args=ui.get_args()) 
-            
-            # Read the dewarped image that got saved to the temp directory
-            os.chdir(original_dir)
-            dewarped_image_path = os.path.join(tmpdirname, "temp_image_thresh.png")
-            
-            # Error handling
-            if os.path.exists(dewarped_image_path):
-                dewarped_img = cv2.imread(dewarped_image_path)
-                
-                if dewarped_img is not None:
-                    ui_handler.processed_image.dewarped_img = dewarped_img  # Save to image object
-                else:
-                    st.error("Could not read the dewarped image.")
-            else:
-                st.error(f"Output image at {dewarped_image_path} does not exist.")
+        # Error handling
+        if dewarped_img is not None:
+            ui_handler.processed_image.dewarped_img = dewarped_img  # Save to image object
+        else:
+            st.error("Could not dewarp the image.")
 
         # Update the depicted image
         if dewarped_img is not None:
@@ -131,22 +111,19 @@ class UIHandler:
         uploaded_file = st.file_uploader("Choose an image...", type=['jpg', 'png', 'jpeg', 'tiff'])
 
         if uploaded_file is not None:
-            current_file_hash = self._get_file_hash(uploaded_file)
+            # The upload is already in memory, it is hashed and decoded in place rather than read again and copied
+            data = uploaded_file.getbuffer()
+            current_file_hash = hash_bytes(data)
             previous_file_hash = st.session_state.get('file_hash', None)
 
             if previous_file_hash is None or previous_file_hash != current_file_hash:
                 st.session_state['file_hash'] = current_file_hash  # Update the file hash in session state
-                image = cv2.imdecode(np.frombuffer(uploaded_file.read(), np.uint8), -1)
+                image = decode_image(data)
                 self.processed_image = ProcessedImage(image)  # Save the image to UIHandler instance
 
             return True  # File was uploaded
         return False  # No file uploaded
     
-    def _get_file_hash(self, uploaded_file):
-        file_hash = hashlib.md5(uploaded_file.read()).hexdigest()
-        uploaded_file.seek(0)  # Reset file pointer to the beginning
-        return file_hash
-    
     def handle_img_text(self):
         col1, col2 = st.columns([2, 3])  # 2:3 ratio for image and text
         self.image_placeholder = col1.empty()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Synthetic book pages with ground truth: text rendered with page curvature, skew, uneven lighting, noise and a dark
+background around the page, as in phone captures.
+
+    python -m benchmarks.corpus data/raw --pages 20
+"""
+import os
+import argparse
+import cv2
+import numpy as np
+
+VOCABULARY = """the of and to in a is that for it as was with be by on not he this are or his from at which but have an
+they you were her she there been one all we their has would when if so no will more out up into do any your what some
+can them could my than other time then only its also these two may first new very after most made over such where
+through back years much before good great well old long little own same last might still never being under while
+house morning evening light window garden river mountain letter reading book chapter story history science city road
+water silence memory journey winter summer autumn spring table door street village country family father mother
+friend stranger question answer reason people world nothing something everything between without against toward
+perhaps although however because nearly almost always often seldom quietly slowly suddenly carefully together""".split()
+
+FONTS = [cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_COMPLEX, cv2.FONT_HERSHEY_TRIPLEX]
+
+def page_text(rng, lines=28, words_per_line=(5, 9)):
+    return [" ".join(rng.choice(VOCABULARY, rng.integers(*words_per_line, endpoint=True))) for _ in range(lines)]
+
+def render_page(lines, rng, width=1600, height=2300, curvature=0.015, skew=1.5, noise=12.0, border=0.08):
+    """
+    Renders the lines on a page and distorts it. Returns the BGR image and the text actually rendered, as lines
+    that do not fit are cut. curvature is the page bow as a fraction of its height, skew the maximum rotation in
+    degrees, noise the standard deviation of the Gaussian noise and border the width of the background around the page.
+    """
+    paper = int(rng.integers(225, 250))
+    page = np.full((height, width), paper, np.uint8)
+    font = FONTS[rng.integers(len(FONTS))]
+    scale, thickness = 1.1, 2
+    margin = width // 12
+    line_height = cv2.getTextSize("Hg", font, scale, thickness)[0][1] * 2 + 8
+
+    rendered = []
+    for i, line in enumerate(lines):
+        y = margin + (i + 1) * line_height
+        if y > height - margin:
+            break
+        words = line.split()
+        while words and cv2.getTextSize(" ".join(words), font, scale, thickness)[0][0] > width - 2 * margin:
+            words.pop()
+        cv2.putText(page, " ".join(words), (margin, y), font, scale, int(rng.integers(10, 50)), thickness, cv2.LINE_AA)
+        rendered.append(" ".join(words))
+
+    # Page bow, strongest away from the spine, and uneven lighting
+    ys, xs = np.indices((height, width), dtype=np.float32)
+    bow = curvature * height * ((xs / width) * 2 - 1) ** 2
+    page = cv2.remap(page, xs, ys - bow + bow.max() / 2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    lighting = np.linspace(rng.uniform(0.8, 0.9), 1.0, width, dtype=np.float32)[None, :]
+    page = (page * lighting).astype(np.uint8)
+
+    # Background around the page, then the whole capture slightly rotated
+    pad_y, pad_x = int(border * height), int(border * width)
+    capture = np.full((height + 2 * pad_y, width + 2 * pad_x), int(rng.integers(30, 80)), np.uint8)
+    capture[pad_y:pad_y + height, pad_x:pad_x + width] = page
+    angle = rng.uniform(-skew, skew)
+    center = (capture.shape[1] / 2, capture.shape[0] / 2)
+    rotation = cv2.getRotationMatrix2D(center, angle, 1.0)
+    capture = cv2.warpAffine(capture, rotation, (capture.shape[1], capture.shape[0]), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    capture = capture.astype(np.float32) + rng.normal(0, noise, capture.shape).astype(np.float32)
+    capture = np.clip(capture, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(capture, cv2.COLOR_GRAY2BGR), "\n".join(rendered)
+
+def generate_corpus(output_dir, pages=10, seed=0, **distortions):
+    """Writes page_NNNN.png and its page_NNNN.gt.txt ground truth, returns the image paths."""
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(pages):
+        image, text = render_page(page_text(rng), rng, **distortions)
+        path = os.path.join(output_dir, f"page_{i + 1:04d}.png")
+        cv2.imwrite(path, image)
+        with open(os.path.join(output_dir, f"page_{i + 1:04d}.gt.txt"), 'w') as file:
+            file.write(text)
+        paths.append(path)
+    return paths
+
+def main(args):
+    paths = generate_corpus(args.output_dir, args.pages, args.seed, curvature=args.curvature, skew=args.skew, noise=args.noise)
+    print(f"{len(paths)} pages written to {args.output_dir}")
+
+def parser_add_arguments(parser):
+    parser.add_argument('output_dir', help='Folder to write the pages and their ground truth to.')
+    parser.add_argument('--pages', type=int, default=10, help='Number of pages.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus.')
+    parser.add_argument('--curvature', type=float, default=0.015, help='Page bow, as a fraction of the page height.')
+    parser.add_argument('--skew', type=float, default=1.5, help='Maximum rotation in degrees.')
+    parser.add_argument('--noise', type=float, default=12.0, help='Standard deviation of the Gaussian noise.')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate synthetic book pages with ground truth.')
+    parser_add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Times every stage on a synthetic (or given) corpus and measures the character error rate and word recall against its ground truth.
+Results are written as JSON, and can be compared with a previous run to spot regressions.
+
+    python -m benchmarks.stages --pages 20 --engine tesserocr --output results.json
+    python -m benchmarks.stages --pages 20 --engine tesserocr --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+from collections import Counter
+import cv2
+import numpy as np
+from .corpus import generate_corpus
+
+STAGES = ["dewarp", "preprocess", "ocr", "postprocess"]
+
+def edit_distance(a, b):
+    """Levenshtein distance, one row at a time with NumPy."""
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return len(a)
+    b_codes = np.array([ord(c) for c in b])
+    offsets = np.arange(len(b) + 1)
+    row = offsets.copy()
+    for i, char in enumerate(a, 1):
+        substitution = row[:-1] + (b_codes != ord(char))
+        deletion = row[1:] + 1
+        new_row = np.empty_like(row)
+        new_row[0] = i
+        new_row[1:] = np.minimum(substitution, deletion)
+        # Insertions chain along the row: new_row[j] = min_k(new_row[k] + j - k)
+        row = np.minimum.accumulate(new_row - offsets) + offsets
+    return int(row[-1])
+
+def character_error_rate(text, truth):
+    # Whitespace and line breaks are layout, not content
+    text, truth = " ".join(text.split()), " ".join(truth.split())
+    return edit_distance(text, truth) / max(1, len(truth))
+
+def word_recall(text, truth):
+    # Order-insensitive, tells recognition errors apart from reading order errors
+    truth_words = Counter(truth.split())
+    return sum((Counter(text.split()) & truth_words).values()) / max(1, sum(truth_words.values()))
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # Bytes on macOS, KB elsewhere
+
+def summarize(latencies, rss_before):
+    latencies = np.array(latencies)
+    return {
+        "pages": len(latencies),
+        "pages_per_sec": len(latencies) / latencies.sum() if latencies.sum() > 0 else None,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_growth_mb": peak_rss_mb() - rss_before,
+    }
+
+def time_stage(fn, inputs, warmup=1):
+    for item in inputs[:warmup]:
+        fn(item)
+    outputs, latencies = [], []
+    for item in inputs:
+        start_time = time.perf_counter()
+        outputs.append(fn(item))
+        latencies.append(time.perf_counter() - start_time)
+    return outputs, latencies
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "args": vars(args),
+    }
+
+def load_corpus(args, tmpdir):
+    corpus_dir = args.corpus or tmpdir
+    if args.corpus is None:
+        generate_corpus(corpus_dir, args.pages, args.seed)
+    names = sorted(filename for filename in os.listdir(corpus_dir) if filename.endswith('.png'))[:args.pages]
+    images = [cv2.imread(os.path.join(corpus_dir, name)) for name in names]
+    truths = []
+    for name in names:
+        truth_path = os.path.join(corpus_dir, name[:-len('.png')] + '.gt.txt')
+        truths.append(open(truth_path).read() if os.path.exists(truth_path) else None)
+    return names, images, truths
+
+def run(args):
+    from src.dewarping import ImageDewarper
+    from src.preprocessing import ImagePreprocessor
+    from src.ocr import TextExtractor, tool_version
+
+    stages = args.stages.split(',')
+    results = {"meta": metadata(args), "stages": {}, "quality": {}}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        names, images, truths = load_corpus(args, tmpdir)
+    print(f"{len(images)} pages", file=sys.stderr)
+
+    if "dewarp" in stages:
+        dewarper = ImageDewarper(backend=args.backend)
+        rss_before = peak_rss_mb()
+        dewarped, latencies = time_stage(dewarper.dewarp_image, images, args.warmup)
+        results["stages"]["dewarp"] = summarize(latencies, rss_before)
+        results["stages"]["dewarp"]["failed"] = sum(image is None for image in dewarped)
+        images = [original if image is None else image for original, image in zip(images, dewarped)]
+
+    if "preprocess" in stages:
+        preprocessor = ImagePreprocessor()
+        rss_before = peak_rss_mb()
+        images, latencies = time_stage(preprocessor.preprocess_single_image, images, args.warmup)
+        results["stages"]["preprocess"] = summarize(latencies, rss_before)
+
+    texts = None
+    if "ocr" in stages:
+        text_extractor = TextExtractor(lang=args.lang, engine=args.engine)
+        results["meta"]["ocr"] = tool_version(text_extractor.engine)
+        rss_before = peak_rss_mb()
+        texts, latencies = time_stage(text_extractor.get_text, images, args.warmup)
+        results["stages"]["ocr"] = summarize(latencies, rss_before)
+        results["quality"]["cer_ocr"] = mean_metric(character_error_rate, texts, truths)
+        results["quality"]["word_recall_ocr"] = mean_metric(word_recall, texts, truths)
+
+    if "postprocess" in stages and texts is not None:
+        if args.llm_model is None:
+            print("Skipping postprocess, pass --llm_model with a small local model to time it.", file=sys.stderr)
+        else:
+            from src.postprocessing import TextCleanerLLM
+            cleaner = TextCleanerLLM(args.llm_model, device_map="cpu", pipeline_params={'max_new_tokens': args.max_new_tokens, 'do_sample': False})
+            if args.prompt_template is not None:
+                cleaner.set_prompt_template(args.prompt_template)
+            results["meta"]["llm"] = cleaner.model_version
+            rss_before = peak_rss_mb()
+            cleaned, latencies = time_stage(cleaner.clean_text, texts, args.warmup)
+            results["stages"]["postprocess"] = summarize(latencies, rss_before)
+            results["quality"]["cer_postprocess"] = mean_metric(character_error_rate, cleaned, truths)
+            results["quality"]["word_recall_postprocess"] = mean_metric(word_recall, cleaned, truths)
+    return results
+
+def mean_metric(metric, texts, truths):
+    values = [metric(text, truth) for text, truth in zip(texts, truths) if truth is not None]
+    return float(np.mean(values)) if values else None
+
+# Metrics where lower is better, the rest are better higher
+LOWER_IS_BETTER = {"p50_ms", "p95_ms", "peak_rss_mb", "peak_rss_growth_mb", "failed", "cer_ocr", "cer_postprocess"}
+
+def compare(results, baseline, tolerance):
+    """Prints the change of every metric against a previous run, returns the regressions beyond the tolerance."""
+    rows, regressions = [], []
+    pairs = [(f"{stage}.{metric}", value, baseline.get("stages", {}).get(stage, {}).get(metric))
+             for stage, metrics in results["stages"].items() for metric, value in metrics.items()]
+    pairs += [(metric, value, baseline.get("quality", {}).get(metric)) for metric, value in results["quality"].items()]
+    for name, value, base in pairs:
+        if value is None or base is None or name.endswith(".pages"):
+            continue
+        change = (value - base) / base if base else 0.0
+        worse = change > tolerance if name.split('.')[-1] in LOWER_IS_BETTER else change < -tolerance
+        if name.startswith(("cer", "word_recall")):  # Quality is compared in absolute terms
+            change = value - base
+            worse = change > 0.01 if name.startswith("cer") else change < -0.01
+        rows.append(f"{name:36s} {base:12.3f} {value:12.3f} {change:+9.1%}{'  REGRESSION' if worse else ''}")
+        if worse:
+            regressions.append(name)
+    print(f"{'metric':36s} {'baseline':>12s} {'current':>12s} {'change':>9s}")
+    print("\n".join(rows))
+    return regressions
+
+def main(args):
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+def parser_add_arguments(parser):
+    parser.add_argument('--corpus', default=None, help='Folder of .png pages with optional .gt.txt ground truth. A synthetic corpus is generated by default.')
+    parser.add_argument('--pages', type=int, default=10, help='Number of pages to benchmark.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic corpus.')
+    parser.add_argument('--stages', default=",".join(STAGES), help='Comma-separated stages to run, in pipeline order.')
+    parser.add_argument('--warmup', type=int, default=1, help='Pages run once before timing each stage.')
+    parser.add_argument('--backend', choices=["native", "subprocess"], default="native", help='Dewarping backend.')
+    parser.add_argument('--lang', default='eng', help='Language used by Tesseract.')
+    parser.add_argument('--engine', choices=['pytesseract', 'tesserocr'], default='pytesseract', help='OCR engine.')
+    parser.add_argument('--llm_model', default=None, help='Small local model to time the postprocess stage with. Skipped by default.')
+    parser.add_argument('--prompt_template', default=None, help='Prompt template file for the postprocess stage.')
+    parser.add_argument('--max_new_tokens', type=int, default=64, help='Tokens generated per page in the postprocess stage.')
+    parser.add_argument('--output', default=None, help='JSON file to write the results to. Printed by default.')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run to compare against. Exits with 1 on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative change of a metric considered a regression.')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark every stage on a corpus with ground truth.')
+    parser_add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
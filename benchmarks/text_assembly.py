@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of TextExtractor's word assembly against the former pandas implementation.
+
+    python -m benchmarks.text_assembly --words 2000 --repeat 50
+"""
+import io
+import csv
+import random
+import argparse
+import timeit
+import pandas as pd
+from src.ocr import TextExtractor, parse_tsv, TSV_HEADER
+
+WORDS = ["the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "None", "NA", "12", "señor", "l'home", "\"quoted\""]
+
+def synthetic_tsv(n_words, seed=0):
+    """Builds a Tesseract-like TSV with blocks, paragraphs, lines and some unrecognized words."""
+    rng = random.Random(seed)
+    rows = ["1\t1\t0\t0\t0\t0\t0\t0\t2480\t3508\t-1\t"]
+    words = 0
+    block = 0
+    while words < n_words:
+        block += 1
+        rows.append(f"2\t1\t{block}\t0\t0\t0\t0\t0\t100\t100\t-1\t")
+        for par in range(1, rng.randint(1, 3) + 1):
+            rows.append(f"3\t1\t{block}\t{par}\t0\t0\t0\t0\t100\t100\t-1\t")
+            for line in range(1, rng.randint(1, 8) + 1):
+                rows.append(f"4\t1\t{block}\t{par}\t{line}\t0\t0\t0\t100\t20\t-1\t")
+                for word in range(1, rng.randint(1, 12) + 1):
+                    text = "" if rng.random() < 0.15 else rng.choice(WORDS)
+                    rows.append(f"5\t1\t{block}\t{par}\t{line}\t{word}\t0\t0\t20\t20\t{rng.uniform(0, 96):.6f}\t{text}")
+                    words += 1
+    rng.shuffle(rows)  # Make sure ordering is not taken for granted
+    return TSV_HEADER + "\n".join(rows) + "\n"
+
+def legacy_get_text(tsv, threshold=0.5):
+    """TextExtractor.get_text as it was implemented on top of pandas."""
+    df = pd.read_csv(io.StringIO(tsv), quoting=csv.QUOTE_NONE, sep='\t')
+    df['parent_group'] = df['page_num'].astype(str) + '_' + df['block_num'].astype(str) + '_' + df['par_num'].astype(str)
+    df = df.groupby('parent_group').filter(lambda x: x.isnull().sum().sum() / x.shape[0] < threshold)
+    df_filtered = df.dropna(subset=['text'])
+    df_sorted = df_filtered.sort_values(by=['parent_group', 'line_num', 'word_num'])
+
+    text = ""
+    for _, group in df_sorted.groupby('parent_group'):
+        words = group['text'].tolist()
+        text += " ".join(words) + " "
+    return text
+
+def main(args):
+    extractor = TextExtractor(nan_thresh=args.nan_thresh)
+    tsv = synthetic_tsv(args.words, args.seed)
+
+    new_text = extractor._assemble_text(parse_tsv(tsv), args.nan_thresh)
+    old_text = legacy_get_text(tsv, args.nan_thresh)
+    assert new_text.encode() == old_text.encode(), "Vectorized output differs from the pandas implementation."
+
+    old_time = min(timeit.repeat(lambda: legacy_get_text(tsv, args.nan_thresh), number=1, repeat=args.repeat))
+    new_time = min(timeit.repeat(lambda: extractor._assemble_text(parse_tsv(tsv), args.nan_thresh), number=1, repeat=args.repeat))
+    print(f"words: {args.words}, output: {len(new_text)} chars (identical)")
+    print(f"pandas:     {old_time * 1000:.3f} ms")
+    print(f"vectorized: {new_time * 1000:.3f} ms")
+    print(f"speedup:    {old_time / new_time:.1f}x")
+
+def parser_add_arguments(parser):
+    parser.add_argument('--words', type=int, default=1000, help='Number of words in the synthetic page.')
+    parser.add_argument('--nan_thresh', type=float, default=0.5, help='NaN threshold for cleanup.')
+    parser.add_argument('--repeat', type=int, default=20, help='Timing repetitions, the best one is reported.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic page.')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the OCR word assembly.')
+    parser_add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -1,38 +1,78 @@
+import sys
+import time
 import argparse
-from src.dewarping import parser_add_arguments as parser_add_arguments_dewarping, main as main_dewarping
-from src.preprocessing import parser_add_arguments as parser_add_arguments_preprocessing, main as main_preprocessing
-from src.ocr import parser_add_arguments as parser_add_arguments_ocr, main as main_ocr
-
-# Bandage to warn if LLM requirements are not installed and the user tries to use it
-try:
-    from src.postprocessing import parser_add_arguments as parser_add_arguments_postprocessing, main as main_postprocessing
-    epilog = ""
-except ImportError:
-    epilog = "*** Note: Postprocessing is not enabled as LLM requirements are not installed. ***"
-    parser_add_arguments_postprocessing = lambda x: None
-    main_postprocessing = lambda x: None
+import importlib
+
+# Subcommands are registered by module path, so heavy dependencies (cv2, pandas, pytesseract, transformers...)
+# are only imported for the subcommand that actually runs
+SUBCOMMANDS = {
+    'dewarp': ('src.dewarping', 'Dewarp images in a folder.', ['numpy', 'cv2', 'page_dewarp']),
+    'preprocess': ('src.preprocessing', 'Preprocess images in a folder.', ['numpy', 'cv2']),
+    'autotune': ('src.autotune', 'Tune the preprocessing parameters on the pages in a folder.', ['numpy', 'cv2', 'pytesseract', 'tesserocr']),
+    'ocr': ('src.ocr', 'Extract text from images in a folder.', ['numpy', 'cv2', 'pytesseract', 'tesserocr']),
+    'pipeline': ('src.pipeline', 'Dewarp, preprocess and extract text from images in a folder without intermediate files.', ['numpy', 'cv2', 'page_dewarp', 'pytesseract', 'tesserocr']),
+    'postprocess': ('src.postprocessing', 'Clean text files in a folder using an LLM.', ['torch', 'transformers']),
+    'queue': ('src.distributed', 'Run the pipeline over a collection of books on several nodes through a shared work queue.', ['numpy', 'cv2', 'page_dewarp', 'pytesseract', 'tesserocr']),
+    'serve': ('src.server', 'Serve OCR (and optionally LLM cleanup) over HTTP on warm engines.', ['numpy', 'cv2', 'page_dewarp', 'pytesseract', 'tesserocr']),
+}
+
+def import_subcommand(name, profile=False):
+    module_path, _, dependencies = SUBCOMMANDS[name]
+    timings = []
+    if profile:
+        # Import the heavy dependencies one by one first, so that their cost is reported separately
+        for dependency in dependencies:
+            start_time = time.perf_counter()
+            try:
+                importlib.import_module(dependency)
+            except ImportError:
+                continue
+            timings.append((dependency, time.perf_counter() - start_time))
+
+    start_time = time.perf_counter()
+    try:
+        module = importlib.import_module(module_path)
+    except ImportError as e:
+        if name == 'postprocess':
+            raise SystemExit(f"Postprocessing is not enabled as LLM requirements are not installed ({e}).")
+        raise
+    timings.append((module_path, time.perf_counter() - start_time))
+    return module, timings
+
+def find_subcommand(argv):
+    for arg in argv:
+        if arg in SUBCOMMANDS:
+            return arg
+    return None
 
 def main():
+    start_time = time.perf_counter()
+    argv = sys.argv[1:]
+    profile = '--profile_startup' in argv
+
     parser = argparse.ArgumentParser(description='OCR processing.')
+    parser.add_argument('--profile_startup', action='store_true', help='Report how long importing the subcommand and its dependencies takes.')
     subparsers = parser.add_subparsers()
 
-    dewarp_parser = subparsers.add_parser('dewarp', help='Dewarp images in a folder.')
-    parser_add_arguments_dewarping(dewarp_parser)
-    dewarp_parser.set_defaults(func=main_dewarping)
-
-    preprocess_parser = subparsers.add_parser('preprocess', help='Preprocess images in a folder.')
-    parser_add_arguments_preprocessing(preprocess_parser)
-    preprocess_parser.set_defaults(func=main_preprocessing)
-
-    ocr_parser = subparsers.add_parser('ocr', help='Extract text from images in a folder.')
-    parser_add_arguments_ocr(ocr_parser)
-    ocr_parser.set_defaults(func=main_ocr)
+    # Only the requested subcommand gets its arguments, the others are listed by name and help alone
+    selected = find_subcommand(argv)
+    timings = []
+    for name, (_, help_text, _) in SUBCOMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text)
+        if name == selected:
+            module, timings = import_subcommand(name, profile)
+            module.parser_add_arguments(subparser)
+            subparser.set_defaults(func=module.main)
 
-    postprocess_parser = subparsers.add_parser('postprocess', help='Clean text files in a folder using an LLM.', epilog=epilog)
-    parser_add_arguments_postprocessing(postprocess_parser)
-    postprocess_parser.set_defaults(func=main_postprocessing)    
+    if profile:
+        for module_name, seconds in timings:
+            print(f"import {module_name}: {seconds:.3f}s", file=sys.stderr)
+        print(f"startup: {time.perf_counter() - start_time:.3f}s", file=sys.stderr)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return
     args.func(args)
 
 if __name__ == "__main__":
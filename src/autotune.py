@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import os
+import cv2
+import json
+import math
+import time
+import random
+import argparse
+import itertools
+import tempfile
+import numpy as np
+from .preprocessing import ImagePreprocessor
+from .layout import select_crops
+from .ocr import TextExtractor, parse_tsv, parser_add_options as parser_add_options_ocr
+from .utils.executors import run_tasks, parser_add_executor_options
+from .utils.manifest import hash_params
+from .utils.sources import as_page, list_pages, prefetch
+from .utils.metrics import with_metrics, parser_add_metrics_options
+from .utils.logger_config import setup_logger
+
+logger = setup_logger()
+
+# Values tried for each preprocessing knob, min_thresh only matters for binary thresholding
+SEARCH_SPACE = {
+    "blur_type": ["median", "gaussian", "none"],
+    "thresh_type": ["otsu", "adaptive", "binary"],
+    "min_thresh": [100, 127, 160],
+    "noise_kernel": [0, 2, 3],
+    "erode_kernel": [0, 2, 3],
+    "dilate_kernel": [0, 2, 3],
+}
+
+class PreprocessingTuner:
+    """
+    Searches the preprocessing parameters that maximize Tesseract's confidence on a page or a book.
+    Candidates are scored on the most text-dense crops of the sampled pages with successive halving: all of them
+    on one downscaled crop per page, the best third on that crop at full resolution, and the rest on every crop.
+    Winning parameters are kept in params_file, keyed by the content of the sampled pages.
+    """
+    def __init__(self, text_extractor=None, candidates=32, sample_pages=5, crops_per_page=3, crop_size=512, seed=0, params_file=None, executor="thread", workers=None):
+        # Never cache scoring runs, they would fill the cache with crops
+        text_extractor = text_extractor or TextExtractor()
+        self.text_extractor = TextExtractor(text_extractor.lang, text_extractor.nan_thresh, text_extractor.engine,
+                                            lang_candidates=text_extractor.lang_candidates, max_engines=text_extractor.max_engines)
+        self.candidates = candidates
+        self.sample_pages = sample_pages
+        self.crops_per_page = crops_per_page
+        self.crop_size = crop_size
+        self.seed = seed
+        self.params_file = params_file
+        self.executor = executor  # Candidates are scored in parallel
+        self.workers = workers
+        # (scale, crops per page) of each round, a third of the candidates is kept after every round but the last
+        self.rungs = [(0.5, 1), (1.0, 1), (1.0, crops_per_page)]
+
+    def get_args(self):
+        return {
+            "ocr": {"lang": self.text_extractor.lang, "lang_candidates": self.text_extractor.get_args()["lang_candidates"], "engine": self.text_extractor.engine},
+            "candidates": self.candidates,
+            "sample_pages": self.sample_pages,
+            "crops_per_page": self.crops_per_page,
+            "crop_size": self.crop_size,
+            "seed": self.seed
+        }
+
+    def search_space(self):
+        defaults = ImagePreprocessor().get_args()
+        del defaults["deskew"]  # Not tuned, the sampled pages are deskewed beforehand if needed
+        grid = []
+        for values in itertools.product(*SEARCH_SPACE.values()):
+            params = dict(defaults, **dict(zip(SEARCH_SPACE, values)))
+            if params["thresh_type"] != "binary" and params["min_thresh"] != defaults["min_thresh"]:
+                continue
+            grid.append(params)
+        # The defaults always compete, the rest is a random sample of the grid
+        sample = random.Random(self.seed).sample(grid, min(len(grid), self.candidates))
+        return [defaults] + [params for params in sample if params != defaults][:self.candidates - 1]
+
+    def score(self, params, crops, lang=None):
+        """Expected number of correctly read words: the summed confidence of the recognized words."""
+        preprocessor = ImagePreprocessor(**params)
+        total = 0.0
+        for crop in crops:
+            image = preprocessor.plan.run(crop)
+            # Pages that end up (almost) blank or black have nothing to read, skip Tesseract
+            white = cv2.countNonZero(image) / image.size
+            if not 0.05 < white < 0.995:
+                continue
+            image = preprocessor.remove_and_add_borders(image)
+            data = parse_tsv(self.text_extractor.image_to_tsv(image, lang))
+            words = np.array([text is not None and any(c.isalnum() for c in text) for text in data['text']], dtype=bool)
+            total += data['conf'][words & (data['conf'] > 0)].sum() / 100
+        return total
+
+    def tune(self, images):
+        # Detected once, rather than on every crop of every candidate
+        lang = self.text_extractor.detect_lang(images[0]) if self.text_extractor.lang == 'auto' else None
+        crops = [select_crops(image, self.crops_per_page, self.crop_size) for image in images]
+        candidates = self.search_space()
+        for i, (scale, crops_per_page) in enumerate(self.rungs):
+            rung_crops = [crop if scale == 1.0 else cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                          for page_crops in crops for crop in page_crops[:crops_per_page]]
+            scores = run_tasks(self, 'score', [(params, rung_crops, lang) for params in candidates], self.executor, self.workers)
+            keep = 1 if i == len(self.rungs) - 1 else math.ceil(len(candidates) / 3)
+            ranking = sorted(range(len(candidates)), key=lambda j: -scores[j])[:keep]
+            logger.info(f"Autotune round {i + 1}: {len(candidates)} candidates on {len(rung_crops)} crops at scale {scale}, best score {scores[ranking[0]]:.1f}.")
+            candidates = [candidates[j] for j in ranking]
+        return candidates[0]
+
+    def sample(self, pages):
+        pages = sorted((as_page(page) for page in pages), key=lambda page: page.key)
+        if len(pages) <= self.sample_pages:
+            return pages
+        step = len(pages) / self.sample_pages
+        return [pages[int(i * step + step / 2)] for i in range(self.sample_pages)]
+
+    def tune_book(self, pages, prepare=None, context=None):
+        """
+        Tunes the parameters on a sample of the book's pages (paths or pages). prepare is applied to every loaded page,
+        e.g. dewarping, and context holds whatever else changes the pages it sees.
+        """
+        samples = self.sample(pages)
+        key = hash_params([[page.content_hash() for page in samples], self.get_args(), context])
+        tuned = self._load()
+        if key in tuned:
+            logger.info(f"Using the tuned preprocessing parameters from {self.params_file}.")
+            return tuned[key]
+
+        start_time = time.time()
+        images = [image for _, image in decoded_pages(samples)]
+        if not images:
+            logger.warning("None of the sampled pages could be decoded, keeping the current preprocessing parameters.")
+            return {}
+        if prepare is not None:
+            images = [prepare(image) for image in images]
+        params = self.tune(images)
+        logger.info(f"Tuned preprocessing parameters on {len(samples)} pages in {time.time() - start_time:.1f}s: {params}")
+
+        tuned[key] = params
+        self._save(tuned)
+        return params
+
+    def _load(self):
+        if self.params_file is None or not os.path.exists(self.params_file):
+            return {}
+        with open(self.params_file, 'r') as file:
+            return json.load(file)
+
+    def _save(self, tuned):
+        if self.params_file is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.params_file)), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.params_file)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(tuned, file, indent=2)
+        os.replace(tmp_path, self.params_file)
+
+def decoded_pages(pages):
+    """Yields (page, image) for the pages that decode, the others are left out of the sample with a warning."""
+    for page, image in prefetch(pages):
+        if image is None:
+            logger.warning(f"Could not decode {page.key}, leaving it out of autotuning.")
+            continue
+        yield page, image
+
+def get_tuner(args, text_extractor=None):
+    if not getattr(args, 'autotune', False):
+        return None
+    params_file = args.autotune_file or os.path.join(args.output_dir, '.autotune.json')
+    return PreprocessingTuner(text_extractor, args.autotune_candidates, args.autotune_pages, params_file=params_file, executor=args.executor, workers=args.workers)
+
+@with_metrics
+def main(args):
+    tuner = PreprocessingTuner(TextExtractor(args.lang, args.nan_thresh, args.engine, lang_candidates=args.lang_candidates, max_engines=args.max_engines), args.autotune_candidates, args.autotune_pages, executor=args.executor, workers=args.workers)
+
+    logger.info("Tuning preprocessing parameters...")
+    start_time = time.time()
+    if not os.path.exists(args.input_path):
+        logger.error(f"Invalid input path: {args.input_path}")
+        return
+    pages = list_pages(args.input_path)
+
+    result = tuner.tune_book(pages)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_path)), exist_ok=True)
+    with open(args.output_path, 'w') as file:
+        json.dump(result, file, indent=2)
+    logger.info(f'Tuning on {args.input_path} complete in {time.time() - start_time}, parameters written to {args.output_path}.')
+
+def parser_add_arguments(parser):
+    parser.add_argument('input_path', help='Path of the image, folder, archive or PDF (book) to tune the preprocessing for.')
+    parser.add_argument('output_path', help='JSON file to write the tuned preprocessing parameters to.')
+    parser_add_tuner_options(parser)
+    parser_add_options_ocr(parser)
+    parser_add_executor_options(parser)
+    parser_add_metrics_options(parser)
+
+def parser_add_tuner_options(parser):
+    parser.add_argument('--autotune_candidates', type=int, default=32, help='Number of preprocessing parameter sets to try.')
+    parser.add_argument('--autotune_pages', type=int, default=5, help='Number of pages sampled from a folder to tune on.')
+
+def parser_add_autotune_options(parser):
+    parser.add_argument('--autotune', action='store_true', help='Tune the preprocessing parameters on a sample of the pages before processing a folder, instead of using the given ones.')
+    parser.add_argument('--autotune_file', default=None, help='JSON file keeping the tuned parameters of each book. Defaults to .autotune.json in the output folder.')
+    parser_add_tuner_options(parser)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tune the preprocessing parameters on a page or a folder.')
+    parser_add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -2,25 +2,193 @@
 import os
 import subprocess
 import shutil
-from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import threading
+import cv2
+import numpy as np
+from pathlib import Path
+from .utils.executors import run_tasks, parser_add_executor_options
 import argparse
+from functools import lru_cache
+from importlib.metadata import version, PackageNotFoundError
 from .utils.logger_config import setup_logger
+from .utils.cache import hash_array, get_cache, parser_add_cache_options
+from .utils.manifest import get_manifest, parser_add_manifest_options
+from .utils.sources import as_page, list_pages, is_page_collection
+from .utils.resolution import get_resolution, parser_add_resolution_options
+from .utils.metrics import metrics, with_metrics, parser_add_metrics_options
 import time
 
+# page-dewarp internals are used to dewarp in-process, falling back to its CLI if they are not importable
+try:
+    from page_dewarp.cli import ArgParser
+    from page_dewarp.dewarp import round_nearest_multiple
+    from page_dewarp.image import WarpedImage, get_page_dims
+    from page_dewarp.normalisation import norm2pix
+    from page_dewarp.optimise import optimise_params
+    from page_dewarp.options import cfg
+    from page_dewarp.projection import project_xy
+    from page_dewarp.solve import get_default_params
+    from page_dewarp.spans import keypoints_from_samples, sample_spans
+    NATIVE_DEWARP_AVAILABLE = True
+except ImportError:
+    WarpedImage = object
+    NATIVE_DEWARP_AVAILABLE = False
+
 logger = setup_logger()
 
+if NATIVE_DEWARP_AVAILABLE:
+    _PAGE_DEWARP_DEFAULTS = {opt: ArgParser.get_config_param(opt) for opt in ArgParser.config_map}
+
+class InMemoryWarpedImage(WarpedImage):
+    """
+    page-dewarp's WarpedImage fitted on an array and remapped in memory instead of read from and written to disk.
+    The model is fitted on page-dewarp's screen-sized copy, and if target_width is given the full image is remapped
+    straight to that width, rather than to page-dewarp's output size and resampled afterwards.
+    """
+    def __init__(self, image, name='page', target_width=None):
+        self.cv2_img = image
+        self.target_width = target_width
+        self.file_path = Path(name)
+        self.dewarped_img = None
+        self.small = self.resize_to_screen()
+        if self.small.ndim == 2:  # page-dewarp's masks expect colour, only the screen-sized copy is converted
+            self.small = cv2.cvtColor(self.small, cv2.COLOR_GRAY2BGR)
+
+        self.calculate_page_extents()
+        self.contour_list = self.contour_info(text=True)
+        spans = self.iteratively_assemble_spans()
+        if len(spans) < 1:
+            logger.warning(f"Skipping {name} because only {len(spans)} spans were found.")
+            return
+
+        span_points = sample_spans(self.small.shape, spans)
+        corners, ycoords, xcoords = keypoints_from_samples(self.stem, self.small, self.pagemask, self.page_outline, span_points)
+        rough_dims, span_counts, params = get_default_params(corners, ycoords, xcoords)
+        dstpoints = np.vstack((corners[0].reshape((1, 1, 2)),) + tuple(span_points))
+        params = optimise_params(self.stem, self.small, dstpoints, span_counts, params, cfg.debug_lvl_opt.DEBUG_LEVEL)
+        page_dims = get_page_dims(corners, rough_dims, params)
+        if np.any(page_dims < 0):
+            page_dims = rough_dims  # Same fallback as page-dewarp
+        self.dewarped_img = self.remap(page_dims, params)
+
+    def remap(self, page_dims, params):
+        # Same as page-dewarp's RemappedImage, minus writing the result to the CWD
+        img = self.cv2_img
+        height = 0.5 * page_dims[1] * cfg.output_opts.OUTPUT_ZOOM * img.shape[0]
+        height = round_nearest_multiple(height, cfg.output_opts.REMAP_DECIMATE)
+        width = round_nearest_multiple(height * page_dims[0] / page_dims[1], cfg.output_opts.REMAP_DECIMATE)
+        if self.target_width is not None:
+            height = round_nearest_multiple(height * self.target_width / width, cfg.output_opts.REMAP_DECIMATE)
+            width = round_nearest_multiple(self.target_width, cfg.output_opts.REMAP_DECIMATE)
+        height_small, width_small = np.floor_divide([height, width], cfg.output_opts.REMAP_DECIMATE)
+
+        page_x_coords, page_y_coords = np.meshgrid(np.linspace(0, page_dims[0], width_small),
+                                                   np.linspace(0, page_dims[1], height_small))
+        page_xy_coords = np.hstack((page_x_coords.reshape((-1, 1)), page_y_coords.reshape((-1, 1)))).astype(np.float32)
+        image_points = norm2pix(img.shape, project_xy(page_xy_coords, params), False)
+        image_x_coords = cv2.resize(image_points[:, 0, 0].reshape(page_x_coords.shape), (width, height), interpolation=cv2.INTER_CUBIC).astype(np.float32)
+        image_y_coords = cv2.resize(image_points[:, 0, 1].reshape(page_y_coords.shape), (width, height), interpolation=cv2.INTER_CUBIC).astype(np.float32)
+
+        img_gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else img
+        remapped = cv2.remap(img_gray, image_x_coords, image_y_coords, cv2.INTER_CUBIC, None, cv2.BORDER_REPLICATE)
+        if cfg.output_opts.NO_BINARY:
+            return remapped
+        return cv2.adaptiveThreshold(remapped, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, cfg.mask_opts.ADAPTIVE_WINSZ, 25)
+
+@lru_cache(maxsize=None)
+def tool_version():
+    try:
+        page_dewarp_version = version('page-dewarp')
+    except PackageNotFoundError:
+        page_dewarp_version = None
+    return f"page-dewarp {page_dewarp_version}, opencv {cv2.__version__}"
+
 class ImageDewarper:
-    def __init__(self, src_folder=None, dest_folder=None, additional_args=None):
+    _config_lock = threading.Lock()
+    _configured_args = None
+
+    def __init__(self, src_folder=None, dest_folder=None, additional_args=None, backend="native", cache=None, resolution=None):
         self.src_folder = src_folder
         self.dest_folder = dest_folder
         self.additional_args = additional_args or []
+        self.cache = cache
+        self.resolution = resolution  # ResolutionPolicy, page-dewarp's output size if None
+        if backend == "native" and not NATIVE_DEWARP_AVAILABLE:
+            logger.warning("page-dewarp internals could not be imported, falling back to the subprocess backend.")
+            backend = "subprocess"
+        self.backend = backend
+
+    def get_args(self):
+        return {"additional_args": self.additional_args, "backend": self.backend,
+                "resolution": self.resolution.get_args() if self.resolution is not None else None}
 
     def dewarp_single_image(self, img_path, additional_args=None):
         if additional_args is None:
             additional_args = self.additional_args
-        print(f"Processing {img_path}...")
+        page = as_page(img_path)
+        print(f"Processing {page.key}...")
+        dest_folder = self.dest_folder or os.getcwd()
+        with metrics.span('dewarp.page', page=page.name):
+            if self.backend == "native" or self.cache is not None or not page.is_file:
+                image = page.read()
+                if image is None:
+                    logger.warning(f"Could not decode {page.key}, skipping it.")
+                    return
+                dewarped_img = self.dewarp_image(image, additional_args, name=page.name)
+                if dewarped_img is not None:
+                    cv2.imwrite(os.path.join(dest_folder, page.name + '_thresh.png'), dewarped_img)
+            else:
+                # page-dewarp writes to its CWD, so run it from the destination folder
+                default_args = ['-nb', '1']
+                with metrics.span('dewarp', backend=self.backend):
+                    subprocess.run(['page-dewarp', os.path.abspath(page.path)] + default_args + additional_args, cwd=dest_folder)
+
+    def dewarp_image(self, image, additional_args=None, name='page'):
+        if additional_args is None:
+            additional_args = self.additional_args
+        if self.cache is None:
+            return self._dewarp_image(image, additional_args, name)
+        key = self.cache.key(hash_array(image), 'dewarp', dict(self.get_args(), additional_args=additional_args), tool_version())
+        return self.cache.cached(key, lambda: self._dewarp_image(image, additional_args, name))
+
+    def _dewarp_image(self, image, additional_args, name):
+        with metrics.span('dewarp', backend=self.backend):
+            return self._run_dewarp(image, additional_args, name)
+
+    def _run_dewarp(self, image, additional_args, name):
         default_args = ['-nb', '1']
-        subprocess.run(['page-dewarp', img_path] + default_args + additional_args)
+        if self.backend == "native":
+            # Options are global to page-dewarp, so concurrent calls are expected to share the same arguments
+            with self._config_lock:
+                self._configure(default_args + additional_args)
+            target_width = self.resolution.ocr_width() if self.resolution is not None else None
+            return InMemoryWarpedImage(image, name, target_width).dewarped_img
+
+        # page-dewarp only works on files and writes its output to the CWD, so run it in a private temp dir
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            cv2.imwrite(os.path.join(tmpdirname, "page.png"), image)
+            subprocess.run(['page-dewarp', 'page.png'] + default_args + additional_args, cwd=tmpdirname)
+            dewarped_img_path = os.path.join(tmpdirname, "page_thresh.png")
+            if not os.path.exists(dewarped_img_path):
+                logger.error("page-dewarp did not produce an output image.")
+                return None
+            dewarped_img = cv2.imread(dewarped_img_path)
+            return self.resolution.to_ocr(dewarped_img) if self.resolution is not None else dewarped_img
+
+    @classmethod
+    def _configure(cls, args):
+        # page-dewarp keeps its options in a global config, so only parse them again when they change
+        if cls._configured_args == args:
+            return
+        parser = ArgParser.__new__(ArgParser)
+        argparse.ArgumentParser.__init__(parser, prog='page-dewarp')
+        for opt, value in _PAGE_DEWARP_DEFAULTS.items():
+            ArgParser.set_config_param(opt, value)
+        parser.prepare_arguments()
+        parser.parsed = parser.parse_args(['page.png'] + args)
+        parser.store_parsed_config()
+        cls._configured_args = list(args)
 
     def move_dewarped_images(self):
         current_dir = os.getcwd()
@@ -29,7 +197,7 @@ class ImageDewarper:
                 dewarped_img_path = os.path.join(current_dir, img_name)
                 shutil.move(dewarped_img_path, os.path.join(self.dest_folder, img_name))
 
-    def dewarp_images(self):
+    def dewarp_images(self, executor="thread", workers=None, manifest=None):
         if not os.path.exists(self.src_folder):
             print("Source folder does not exist.")
             return
@@ -37,35 +205,42 @@ class ImageDewarper:
         if not os.path.exists(self.dest_folder):
             os.makedirs(self.dest_folder)
 
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self.dewarp_single_image, os.path.join(self.src_folder, img_name)) 
-                       for img_name in os.listdir(self.src_folder) 
-                       if img_name.endswith(('.jpg', '.jpeg', '.png'))]
+        tasks = [(page,) for page in list_pages(self.src_folder)]
+        if manifest is None:
+            run_tasks(self, 'dewarp_single_image', tasks, executor, workers)
+        else:
+            output_path = lambda page: os.path.join(self.dest_folder, page.name + '_thresh.png')
+            manifest.run(self, 'dewarp_single_image', tasks, 'dewarp', self.get_args(), output_path, executor, workers)
 
-        for future in futures:
-            future.result()  # to raise any exception that occurred during processing
-
-        self.move_dewarped_images()
         print("All images have been processed.")
 
+@with_metrics
 def main(args):
-    dewarper = ImageDewarper(args.input_path, args.output_dir, args.additional_args)
+    dewarper = ImageDewarper(args.input_path, args.output_dir, args.additional_args, args.backend, get_cache(args), get_resolution(args))
 
     logger.info("Dewarping images...")
     start_time = time.time()
-    if os.path.isdir(args.input_path):
-        dewarper.dewarp_images()
+    if is_page_collection(args.input_path):
+        dewarper.dewarp_images(args.executor, args.workers, get_manifest(args))
     elif os.path.isfile(args.input_path):
         dewarper.dewarp_single_image(args.input_path)
-        dewarper.move_dewarped_images()
     else:
         logger.error(f"Invalid input path: {args.input_path}")
     logger.info(f"Dewarping complete in {time.time() - start_time}.")
 
 def parser_add_arguments(parser):
-    parser.add_argument('input_path', help='Path of the image or folder to process.')
+    parser.add_argument('input_path', help='Path of the image, folder, archive (zip/tar), PDF or multi-page TIFF to process.')
     parser.add_argument('output_dir', help='Destination folder to store processed images.')
+    parser_add_options(parser)
+    parser_add_executor_options(parser)
+    parser_add_resolution_options(parser)
+    parser_add_cache_options(parser)
+    parser_add_manifest_options(parser)
+    parser_add_metrics_options(parser)
+
+def parser_add_options(parser):
     parser.add_argument('--additional_args', nargs='*', default=[], help='Additional command-line arguments for page-dewarp.')
+    parser.add_argument('--backend', choices=["native", "subprocess"], default="native", help='Run page-dewarp in-process on arrays or as a subprocess per image.')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Dewarp images in a folder.')
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Runs the pipeline over a collection of books on several nodes, through a work queue on shared storage.
+
+    python -m src queue submit /shared/books /shared/texts --queue /shared/queue.sqlite --engine tesserocr
+    python -m src queue work --queue /shared/queue.sqlite       # on every node
+    python -m src queue status --queue /shared/queue.sqlite
+"""
+import os
+import time
+import argparse
+from .pipeline import get_pipeline, parser_add_arguments as parser_add_arguments_pipeline
+from .autotune import get_tuner
+from .utils.executors import run_tasks, parser_add_executor_options
+from .utils.manifest import hash_params
+from .utils.sources import IMAGE_EXTENSIONS, list_pages, is_page_collection
+from .utils.workqueue import WorkQueue, LeaseKeeper, worker_id, parser_add_queue_options
+from .utils.metrics import metrics, with_metrics, parser_add_metrics_options
+from .utils.logger_config import setup_logger
+
+logger = setup_logger()
+
+# Options of the submitting command that do not change the outputs, and are left to each worker
+WORKER_OPTIONS = {'action', 'func', 'queue', 'lease', 'max_attempts', 'shard_size', 'executor', 'workers', 'metrics_file', 'trace_file',
+                  'manifest', 'no_manifest', 'staged', 'queue_size', 'profile_startup'}
+
+def list_books(path):
+    """
+    Returns (name, source, loose) for every book of a collection: its subfolders, archives, PDFs and multi-page TIFFs.
+    Images lying in the collection folder itself (loose) make a book named after it. A single book is a collection of one.
+    """
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        return [(os.path.basename(path).split('.')[0], path, False)]
+    books, names, loose = [], set(), False
+    for filename in sorted(os.listdir(path)):
+        file_path = os.path.join(path, filename)
+        if filename.startswith('.'):
+            continue
+        if os.path.isdir(file_path) or is_page_collection(file_path):
+            name = filename.split('.')[0]
+            books.append((filename if name in names else name, file_path, False))
+            names.add(name)
+        elif filename.lower().endswith(IMAGE_EXTENSIONS):
+            loose = True
+    if loose:
+        books.append((os.path.basename(path), path, True))
+    return books
+
+def book_pages(source, loose=False):
+    pages = list_pages(source)
+    if loose:  # Only the images of the folder itself, its archives and PDFs are books of their own
+        pages = [page for page in pages if page.member is None and page.index is None]
+    return pages
+
+def shard(books, shard_size):
+    units = []
+    for name, source, loose in books:
+        count = len(book_pages(source, loose))
+        for start in range(0, count, shard_size):
+            units.append((name, start, min(count, start + shard_size), {"source": source, "loose": loose}))
+    return units
+
+def submit(args):
+    params = {key: value for key, value in vars(args).items() if key not in WORKER_OPTIONS}
+    params['output_dir'] = os.path.abspath(args.output_dir)
+    if params.get('clean_dir') is not None:
+        params['clean_dir'] = os.path.abspath(params['clean_dir'])
+    job = hash_params(params)
+    books = list_books(args.input_path)
+    units = shard(books, args.shard_size)
+    added = WorkQueue(args.queue, args.lease, args.max_attempts).submit(job, params, units)
+    logger.info(f"Job {job[:12]}: {len(books)} books in {len(units)} units, {added} added or requeued to {args.queue}.")
+    print(f"Job {job[:12]}: {len(books)} books in {len(units)} units, {added} added or requeued.")
+
+def work(args):
+    work_queue = WorkQueue(args.queue, args.lease, args.max_attempts)
+    worker = worker_id()
+    jobs = {}
+    done = 0
+    logger.info(f"{worker}: waiting for units from {args.queue}.")
+    while True:
+        unit = work_queue.lease(worker)
+        if unit is None:
+            if not args.wait and work_queue.remaining() == 0:
+                break
+            time.sleep(args.poll)  # Others are still working, their units come back if they die
+            continue
+
+        if unit["job"] not in jobs:
+            job_args = argparse.Namespace(**work_queue.params(unit["job"]))
+            jobs[unit["job"]] = (job_args, get_pipeline(job_args))
+        job_args, pipeline = jobs[unit["job"]]
+
+        start_time = time.time()
+        try:
+            with LeaseKeeper(work_queue, unit, worker) as keeper, metrics.span('queue.unit', book=unit["book"], start=unit["start"]):
+                process_unit(pipeline, job_args, unit, args)
+        except Exception as e:
+            logger.error(f"{worker}: {unit['book']} [{unit['start']}:{unit['stop']}] failed with {e!r}")
+            metrics.count('units_total', status='failed')
+            work_queue.fail(unit, worker, e)
+            continue
+        if keeper.lost:  # Another worker has it now, leave the acknowledgement to it
+            continue
+        work_queue.ack(unit, worker)
+        metrics.count('units_total', status='done')
+        done += 1
+        logger.info(f"{worker}: {unit['book']} [{unit['start']}:{unit['stop']}] done in {time.time() - start_time:.1f}s.")
+
+        if work_queue.claim_book(unit["job"], unit["book"]):
+            # Book-level outputs, e.g. the merged parquet file, once every page of the book is there
+            payload = unit["payload"]
+            pipeline.text_extractor.write_book(payload["source"], book_pages(payload["source"], payload["loose"]),
+                                               os.path.join(job_args.output_dir, unit["book"]))
+    logger.info(f"{worker}: no units left, {done} processed.")
+
+def process_unit(pipeline, job_args, unit, args):
+    payload = unit["payload"]
+    pages = book_pages(payload["source"], payload["loose"])
+    output_dir = os.path.join(job_args.output_dir, unit["book"])
+    os.makedirs(output_dir, exist_ok=True)
+    if job_args.clean_dir is not None:
+        pipeline.clean_dir = os.path.join(job_args.clean_dir, unit["book"])
+        os.makedirs(pipeline.clean_dir, exist_ok=True)
+
+    tuner = get_tuner(argparse.Namespace(**dict(vars(job_args), output_dir=output_dir)), pipeline.text_extractor)
+    if tuner is not None and pipeline.preprocessor is not None:
+        pipeline.autotune(tuner, pages)  # Remembered per book, only the first unit of a book pays for it
+
+    tasks = [(page, output_dir) for page in pages[unit["start"]:unit["stop"]]]
+    run_tasks(pipeline, 'process_single_image', tasks, args.executor, args.workers)
+
+def status(args):
+    counts, failed, leased = WorkQueue(args.queue, args.lease, args.max_attempts).stats()
+    print(", ".join(f"{count} {state}" for state, count in sorted(counts.items())) or "Empty queue.")
+    for worker, book, start, stop, lease_expires in leased:
+        print(f"  {worker} working on {book} [{start}:{stop}], lease expires in {lease_expires - time.time():.0f}s")
+    for book, start, stop, error in failed:
+        print(f"  failed {book} [{start}:{stop}]: {error}")
+
+@with_metrics
+def main(args):
+    {'submit': submit, 'work': work, 'status': status}[args.action](args)
+
+def parser_add_arguments(parser):
+    actions = parser.add_subparsers(dest='action', required=True)
+    submit_parser = actions.add_parser('submit', help='Split a collection of books into units and add them to the queue, along with the pipeline options.')
+    parser_add_arguments_pipeline(submit_parser)
+    submit_parser.add_argument('--shard_size', type=int, default=50, help='Pages per work unit.')
+    parser_add_queue_options(submit_parser)
+
+    work_parser = actions.add_parser('work', help='Lease, process and acknowledge units until the queue is empty.')
+    parser_add_queue_options(work_parser)
+    work_parser.add_argument('--wait', action='store_true', help='Keep polling for new units once the queue is empty.')
+    work_parser.add_argument('--poll', type=float, default=10, help='Seconds between polls when no unit is available.')
+    parser_add_executor_options(work_parser)
+    parser_add_metrics_options(work_parser)
+
+    status_parser = actions.add_parser('status', help='Print the state of the units in the queue.')
+    parser_add_queue_options(status_parser)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the pipeline over a collection of books on several nodes.')
+    parser_add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import re
+import cv2
+import numpy as np
+from .layout import select_crops
+
+# Languages of packages.txt, the default candidates of the auto language mode
+DEFAULT_CANDIDATES = "eng+cat+spa+fra+deu+ita+por+nld+swe+rus+ara+jpn+chi_sim+chi_tra+kor"
+
+# Scripts reported by Tesseract's OSD and the languages written in them
+SCRIPT_LANGUAGES = {
+    "Latin": ["eng", "cat", "spa", "fra", "deu", "ita", "por", "nld", "swe", "pol", "ces", "ron", "hun", "fin", "dan", "nor", "tur"],
+    "Fraktur": ["deu", "frk", "eng", "nld", "swe", "dan"],
+    "Cyrillic": ["rus", "ukr", "bul", "srp", "bel", "mkd"],
+    "Greek": ["ell"],
+    "Arabic": ["ara", "fas", "urd"],
+    "Hebrew": ["heb"],
+    "Devanagari": ["hin", "mar", "nep", "san"],
+    "Han": ["chi_sim", "chi_tra", "jpn"],
+    "Japanese": ["jpn"],
+    "Katakana": ["jpn"],
+    "Hiragana": ["jpn"],
+    "Hangul": ["kor"],
+    "Thai": ["tha"],
+}
+
+# Tesseract's script models (tessdata script/ folder), which read every language of a script with one small model
+SCRIPT_MODELS = {"Latin": "script/Latin", "Fraktur": "script/Fraktur", "Cyrillic": "script/Cyrillic", "Greek": "script/Greek",
+                 "Arabic": "script/Arabic", "Hebrew": "script/Hebrew", "Devanagari": "script/Devanagari"}
+
+# Frequent function words, counted in a single read of a crop to rank the languages sharing a script
+STOPWORDS = {
+    "eng": "the of and to in is that it was for with as on be by this are from which his not",
+    "cat": "el la els les de del que i amb per una és als són però aquest com seu va",
+    "spa": "el la los las de del que y en con por una es se para como pero su más",
+    "fra": "le la les de des du que et en un une est pour dans qui sur pas au avec",
+    "deu": "der die das und ist nicht ein eine zu den mit sich auf für von dem des auch",
+    "ita": "il la di che e un una per non sono del della gli le con si è nel anche",
+    "por": "o a os as de do da que e em um uma para com não se dos das mais",
+    "nld": "de het een en van is dat niet op te in zijn met voor die er ook aan",
+    "swe": "och att det som en är på av för med till den inte har de om ett var",
+    "pol": "i w nie na się z że do jest to jak ale o od po tak dla są",
+    "ces": "a v se na je že to s z do jako ale o jsou by od pro tak",
+    "ron": "și de în la nu cu pe că o un este din se care mai pentru",
+    "hun": "a az és hogy nem is egy van meg de csak már mint ez el",
+    "fin": "ja on ei se että oli hän mutta kun niin ovat tai myös joka",
+    "dan": "og i at det en til er som på de med af for ikke der var",
+    "nor": "og i det er som på en til av at med for ikke har de var",
+    "tur": "ve bir bu da de için ile olarak çok daha gibi ne ama en",
+    "rus": "и в не на что с по как это он но из к за от то",
+    "ukr": "і в не на що з до як це він але та із за від є",
+}
+STOPWORDS = {lang: frozenset(words.split()) for lang, words in STOPWORDS.items()}
+
+class LanguageDetector:
+    """
+    Picks the languages of a page among candidates, so that Tesseract only loads and runs those. Tesseract's script
+    detection (OSD) runs on the most text-dense crops of the page and narrows the candidates down to the languages
+    of the script. If several remain, e.g. for Latin, a single read of a crop with the script model (or else the first
+    candidate) ranks them by their stopwords, then the max_scored first each read the crop and the most confident
+    ones are kept.
+    """
+    def __init__(self, text_extractor, candidates=DEFAULT_CANDIDATES, crops=2, crop_size=512, max_languages=2, margin=0.85, min_script_conf=1.0,
+                 max_scored=2, script_models=None):
+        self.text_extractor = text_extractor  # Runs Tesseract, the detector only decides what on
+        self.candidates = candidates.split('+') if isinstance(candidates, str) else list(candidates)
+        self.crops = crops
+        self.crop_size = crop_size
+        self.max_languages = max_languages  # Languages kept at most, best first
+        self.margin = margin  # Fraction of the best score another language needs to be kept
+        self.min_script_conf = min_script_conf  # Below it the script is ignored and every candidate ranked
+        self.max_scored = max_scored  # Candidates read on their own, the engine pool needs room for them and the ranking model
+        self.script_models = script_models or {}  # Installed models of SCRIPT_MODELS, by script
+
+    def detect(self, image):
+        """Returns the Tesseract language string of the page, e.g. 'spa' or 'spa+eng'."""
+        if len(self.candidates) == 1:
+            return self.candidates[0]
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        crops = [np.ascontiguousarray(crop) for crop in select_crops(binary, self.crops, self.crop_size)]
+
+        script, candidates = self.script_candidates(np.vstack(crops) if len(crops) > 1 else crops[0])
+        if len(candidates) > self.max_scored:
+            candidates = self.rank(crops[0], candidates, self.script_models.get(script, candidates[0]))[:max(1, self.max_scored)]
+        if len(candidates) == 1:
+            return candidates[0]
+        scores = {lang: self.score(crops[0], lang) for lang in candidates}
+        best = max(scores.values())
+        ranked = sorted(candidates, key=lambda lang: -scores[lang])
+        return "+".join(lang for lang in ranked[:self.max_languages] if best > 0 and scores[lang] >= self.margin * best) or ranked[0]
+
+    def script_candidates(self, image):
+        """Returns the script of the image and the candidates written in it, or None and every candidate if unsure."""
+        script = self.text_extractor.detect_script(image)
+        if script is None:
+            return None, self.candidates
+        name, conf = script
+        languages = SCRIPT_LANGUAGES.get(name, [])
+        candidates = [lang for lang in self.candidates if lang in languages]
+        if conf < self.min_script_conf or not candidates:
+            return None, self.candidates
+        return name, candidates
+
+    def rank(self, image, candidates, model):
+        # Words are read once with a single model, the same engine on every page of the script. Ties, e.g. when no
+        # stopword is read, keep the order of the candidates.
+        words = [word.lower() for word in self.text_extractor.read_crop(image, model)['text'] if word is not None]
+        words = [re.sub(r"^\W+|\W+$", "", word) for word in words]
+        hits = {lang: sum(word in STOPWORDS.get(lang, ()) for word in words) for lang in candidates}
+        return sorted(candidates, key=lambda lang: -hits[lang])
+
+    def score(self, image, lang):
+        # Dictionaries raise the confidence of real words, so the right language reads the crop most confidently
+        data = self.text_extractor.read_crop(image, lang)
+        words = data['text']
+        is_word = np.fromiter((word is not None and any(char.isalnum() for char in word) for word in words), dtype=bool, count=len(words))
+        return float(np.clip(data['conf'][is_word], 0, 100).sum() / 100)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import cv2
+import numpy as np
+
+def find_text_regions(image, work_width=800, max_fill=0.45, min_area=0.0005, padding=0.01):
+    """
+    Returns the (x, y, w, h) boxes of the text blocks of a page, in reading order.
+    Works on a downsampled binary image: ink touching the image edges (scan borders, the black frame added by
+    preprocessing) is dropped, the rest is smeared into lines and paragraphs, and the resulting connected components
+    are kept unless they are specks (smaller than min_area of the page) or illustrations (more than max_fill ink).
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape
+    scale = min(1.0, work_width / width)
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    small_height, small_width = gray.shape
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+
+    _, labels, _, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    edge_labels = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+    ink[np.isin(labels, edge_labels[edge_labels > 0])] = 0
+
+    # Words are closer horizontally than lines are vertically
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, small_width // 40), max(3, small_height // 80)))
+    blocks = cv2.morphologyEx(ink, cv2.MORPH_CLOSE, kernel)
+    n_blocks, _, stats, _ = cv2.connectedComponentsWithStats(blocks, connectivity=8)
+
+    pad_x, pad_y = int(padding * small_width) + 1, int(padding * small_height) + 1
+    boxes = []
+    for x, y, w, h, area in stats[1:]:
+        if w * h < min_area * small_width * small_height:
+            continue
+        if cv2.countNonZero(ink[y:y + h, x:x + w]) > max_fill * w * h:
+            continue
+        boxes.append((max(0, x - pad_x), max(0, y - pad_y), min(small_width, x + w + pad_x), min(small_height, y + h + pad_y)))
+
+    boxes = _merge_overlapping(boxes)
+    boxes = [(int(x0 / scale), int(y0 / scale), min(width, int(np.ceil(x1 / scale))), min(height, int(np.ceil(y1 / scale)))) for x0, y0, x1, y1 in boxes]
+    return [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in reading_order(boxes)]
+
+def _merge_overlapping(boxes):
+    # Padding can make neighbouring blocks overlap, OCRing the same pixels twice
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for box in boxes:
+            for i, other in enumerate(result):
+                if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                    result[i] = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+                    merged = True
+                    break
+            else:
+                result.append(box)
+        boxes = result
+    return boxes
+
+def _split(boxes, axis):
+    # Groups of (x0, y0, x1, y1) boxes separated by an empty gap along the axis, 0 for columns and 1 for bands
+    boxes = sorted(boxes, key=lambda box: box[axis])
+    groups = [[boxes[0]]]
+    end = boxes[0][axis + 2]
+    for box in boxes[1:]:
+        if box[axis] >= end:
+            groups.append([])
+        groups[-1].append(box)
+        end = max(end, box[axis + 2])
+    return groups
+
+def reading_order(boxes, axis=1, tried=False):
+    """
+    Orders (x0, y0, x1, y1) boxes with a recursive XY-cut: the page is cut into bands top to bottom wherever no box
+    spans the gap, bands into columns left to right, and so on. Headers above two columns are read before both.
+    """
+    if len(boxes) <= 1:
+        return list(boxes)
+    groups = _split(boxes, axis)
+    if len(groups) == 1:
+        if tried:
+            return sorted(boxes, key=lambda box: (box[1], box[0]))
+        return reading_order(boxes, 1 - axis, True)
+    return [box for group in groups for box in reading_order(group, 1 - axis)]
+
+def select_crops(image, n_crops, crop_size):
+    """
+    Returns the n_crops tiles of the page with the most ink, skipping mostly dark tiles such as pictures or scan borders.
+    """
+    height, width = image.shape[:2]
+    if height <= crop_size or width <= crop_size:
+        return [image]
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    rows, cols = height // crop_size, width // crop_size
+    density = cv2.resize(ink[:rows * crop_size, :cols * crop_size].astype(np.float32), (cols, rows), interpolation=cv2.INTER_AREA)
+    density[density > 0.5] = 0
+    order = np.argsort(density, axis=None)[::-1][:n_crops]
+    return [image[r * crop_size:(r + 1) * crop_size, c * crop_size:(c + 1) * crop_size] for r, c in zip(*np.unravel_index(order, density.shape))]
@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
 
 class ProcessedImage:
-    def __init__(self, original_img):
+    def __init__(self, original_img, name=None):
+        self.name = name
         self.original_img = original_img
         self.dewarped_img = None
         self.preprocessed_img = None
-        self.extracted_text = None
\ No newline at end of file
+        self.extracted_text = None
+        self.words = None  # Tesseract's table, as returned by parse_tsv
+        self.cleaned_text = None
+        self.route = None  # Steps the page needs, as decided by a PageRouter. Every enabled step runs if None
+        self.resampled = False  # Whether dewarping or preprocessing already brought latest_img to the OCR resolution
+
+    @property
+    def latest_img(self):
+        # Output of the last step that ran
+        for image in (self.preprocessed_img, self.dewarped_img, self.original_img):
+            if image is not None:
+                return image
+        return None
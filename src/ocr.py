@@ -1,81 +1,365 @@
 #!/usr/bin/env python3
 import os
+import io
+import csv
+import threading
+from collections import OrderedDict
 import cv2
 import argparse
-import pytesseract
-from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .utils.executors import run_tasks, parser_add_executor_options
+from functools import lru_cache
 from .utils.logger_config import setup_logger
+from .utils.cache import hash_array, get_cache, parser_add_cache_options
+from .utils.manifest import get_manifest, parser_add_manifest_options
+from .utils.sources import IMAGE_EXTENSIONS, as_page, list_pages, is_page_collection
+from .utils import words
+from .layout import find_text_regions
+from .language import LanguageDetector, DEFAULT_CANDIDATES, SCRIPT_MODELS
+from .utils.resolution import get_resolution, parser_add_resolution_options
+from .utils.metrics import metrics, with_metrics, parser_add_metrics_options
 import time
 
+# tesserocr talks to libtesseract directly, avoiding a tesseract process and model load per image
+try:
+    import tesserocr
+    TESSEROCR_AVAILABLE = True
+except ImportError:
+    TESSEROCR_AVAILABLE = False
+
 logger = setup_logger()
 
+# Strings that pandas.read_csv turns into NaN by default. Treated as missing words to keep the output
+# identical to the former DataFrame-based implementation.
+NA_STRINGS = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                        '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
+
+TSV_HEADER = "level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext\n"
+
+class TesseractAPIPool:
+    """
+    Keeps warm Tesseract engines per thread and language combination, so the traineddata is loaded once per worker.
+    At most max_engines, given by the caller, are kept per thread, the least recently used is closed first. The OSD
+    engine of the auto language mode runs on every page, it is kept on its own and never evicted.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, lang, max_engines=4):
+        if not hasattr(self._local, 'apis'):
+            self._local.apis = OrderedDict()
+        apis = self._local.apis
+        if lang in apis:
+            apis.move_to_end(lang)
+            return apis[lang]
+        while len(apis) >= max(1, max_engines):
+            _, api = apis.popitem(last=False)
+            api.End()
+        apis[lang] = tesserocr.PyTessBaseAPI(lang=lang)
+        return apis[lang]
+
+    def osd(self):
+        if not hasattr(self._local, 'osd'):
+            self._local.osd = tesserocr.PyTessBaseAPI(lang='osd', psm=tesserocr.PSM.OSD_ONLY)
+        return self._local.osd
+
+    def _set_image(self, api, img):
+        img = np.ascontiguousarray(img)
+        height, width = img.shape[:2]
+        bytes_per_pixel = 1 if img.ndim == 2 else img.shape[2]
+        api.SetImageBytes(img.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+
+    def image_to_tsv(self, img, lang, max_engines=4):
+        api = self.get(lang, max_engines)
+        self._set_image(api, img)
+        return TSV_HEADER + api.GetTSVText(0)
+
+    def detect_script(self, img):
+        api = self.osd()
+        self._set_image(api, img)
+        result = api.DetectOrientationScript()
+        return (result['script_name'], result['script_conf']) if result else None
+
+def merge_region_tsvs(tsvs, origins, width, height):
+    """
+    Merges the TSV outputs of the regions of a page into the TSV of the whole page: boxes are moved back to page
+    coordinates and blocks renumbered in region order. Block numbers are offset so that they all have the same
+    number of digits, which keeps their order when paragraphs are sorted by their string key.
+    """
+    n_blocks = sum(max([int(line.split('\t')[2]) for line in tsv.splitlines()[1:] if line.strip()] + [0]) for tsv in tsvs)
+    block_offset = 10 ** len(str(n_blocks))
+    lines = [TSV_HEADER + f"1\t1\t0\t0\t0\t0\t0\t0\t{width}\t{height}\t-1\t"]
+    for tsv, (x, y) in zip(tsvs, origins):
+        region_blocks = 0
+        for line in tsv.splitlines()[1:]:
+            row = line.split('\t')
+            if len(row) < 12 or row[0] == '1':
+                continue
+            region_blocks = max(region_blocks, int(row[2]))
+            row[2] = str(block_offset + int(row[2]))
+            row[6] = str(int(row[6]) + x)
+            row[7] = str(int(row[7]) + y)
+            lines.append('\t'.join(row))
+        block_offset += region_blocks
+    return '\n'.join(lines) + '\n'
+
+# Module-level so that TextExtractor stays picklable for process-pool workers
+_api_pool = TesseractAPIPool()
+
+def parse_tsv(tsv):
+    """
+    Parses Tesseract's TSV output into a dict of typed NumPy columns. Missing words are None.
+    """
+    lines = tsv.split('\n')
+    header = lines[0].rstrip('\r').split('\t')
+    rows = [line.rstrip('\r').split('\t') for line in lines[1:] if line.strip('\r')]
+
+    # Text is the last column, everything before it is numeric
+    numeric = np.array([row[:-1] for row in rows], dtype=np.float64).reshape(-1, len(header) - 1)
+    data = {name: numeric[:, i] if name == 'conf' else numeric[:, i].astype(np.int64) for i, name in enumerate(header[:-1])}
+    data[header[-1]] = np.array([None if row[-1] in NA_STRINGS else row[-1] for row in rows], dtype=object)
+    return data
+
+@lru_cache(maxsize=None)
+def installed_languages(engine):
+    if engine == 'tesserocr':
+        return set(tesserocr.get_languages()[1])
+    import pytesseract
+    return set(pytesseract.get_languages())
+
+@lru_cache(maxsize=None)
+def tool_version(engine):
+    if engine == 'tesserocr':
+        return f"tesserocr {tesserocr.tesseract_version()}"
+    import pytesseract
+    return f"tesseract {pytesseract.get_tesseract_version()}"
+
 class TextExtractor:
-    def __init__(self, lang='eng', nan_thresh=0.5):
-        self.lang = lang
+    def __init__(self, lang='eng', nan_thresh=0.5, engine='pytesseract', cache=None, output_format='txt', roi=False, resolution=None,
+                 lang_candidates=DEFAULT_CANDIDATES, max_engines=4):
+        self.lang = lang  # 'auto' to detect the languages of every page among lang_candidates
+        self.lang_candidates = lang_candidates
+        self.max_engines = max_engines  # Warm tesserocr engines (language combinations) kept per thread
+        self._detector = None
         self.nan_thresh = nan_thresh
+        self.cache = cache
+        self.output_format = output_format  # txt, or parquet to keep the word boxes and confidences
+        self.roi = roi  # Only OCR the text regions found by a layout pass
+        self.resolution = resolution  # ResolutionPolicy, images are read as they are if None
+        if engine == 'tesserocr' and not TESSEROCR_AVAILABLE:
+            logger.warning("tesserocr is not installed, falling back to pytesseract.")
+            engine = 'pytesseract'
+        self.engine = engine
 
     def update_args(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def get_args(self):
+        return {"lang": self.lang, "lang_candidates": self.lang_candidates if self.lang == 'auto' else None,
+                "nan_thresh": self.nan_thresh, "engine": self.engine, "output_format": self.output_format, "roi": self.roi,
+                "resolution": self.resolution.get_args() if self.resolution is not None else None}
+
+    @property
+    def detector(self):
+        if self._detector is None:
+            installed = installed_languages(self.engine)
+            candidates = self.lang_candidates.split('+')
+            missing = [lang for lang in candidates if lang not in installed]
+            if missing:
+                logger.warning(f"Languages {'+'.join(missing)} are not installed and will not be detected.")
+            script_models = {script: model for script, model in SCRIPT_MODELS.items() if model in installed}
+            self._detector = LanguageDetector(self, [lang for lang in candidates if lang in installed] or ['eng'], script_models=script_models)
+        return self._detector
+
+    def detect_lang(self, img):
+        with metrics.span('ocr.detect_lang'):
+            lang = self.detector.detect(img)
+        metrics.count('pages_by_lang_total', lang=lang)
+        return lang
+
+    def detect_script(self, img):
+        """Returns the (script, confidence) found by Tesseract's OSD, or None if osd.traineddata is not installed."""
+        if 'osd' not in installed_languages(self.engine):
+            return None
+        if self.engine == 'tesserocr':
+            return _api_pool.detect_script(img)
+        import pytesseract
+        try:
+            osd = pytesseract.image_to_osd(img, output_type=pytesseract.Output.DICT)
+        except pytesseract.TesseractError:  # Too few characters
+            return None
+        return osd['script'], osd['script_conf']
+
+    def image_to_tsv(self, img, lang=None):
+        # Cache the raw table rather than the text, so that changing nan_thresh only reruns the assembly. In auto mode
+        # the entry is keyed by the candidates, the languages are only detected on a miss.
+        lang = lang or (None if self.lang == 'auto' else self.lang)
+        if self.cache is None:
+            return self._image_to_tsv(img, lang)
+        params = {'lang': lang, 'engine': self.engine, 'roi': self.roi} if lang else \
+                 {'lang': 'auto', 'lang_candidates': self.lang_candidates, 'engine': self.engine, 'roi': self.roi}
+        key = self.cache.key(hash_array(img), 'ocr', params, tool_version(self.engine))
+        return self.cache.cached(key, lambda: self._image_to_tsv(img, lang))
+
+    def _image_to_tsv(self, img, lang=None):
+        lang = lang or self.detect_lang(img)
+        if self.roi:
+            return self._regions_to_tsv(img, lang)
+        return self._ocr_tsv(img, lang)
+
+    def _regions_to_tsv(self, img, lang, margin=10):
+        with metrics.span('ocr.layout'):
+            regions = find_text_regions(img)
+        if not regions:  # Nothing that looks like text, let Tesseract decide
+            return self._ocr_tsv(img, lang)
+
+        # Regions are padded with white, Tesseract reads text touching the image edge poorly
+        white = 255 if img.ndim == 2 else (255,) * img.shape[2]
+        crops = [cv2.copyMakeBorder(img[y:y + h, x:x + w], margin, margin, margin, margin, cv2.BORDER_CONSTANT, value=white)
+                 for x, y, w, h in regions]
+        # Read on the calling thread, with its warm engines: pages are already spread over the workers
+        tsvs = [self._ocr_tsv(crop, lang) for crop in crops]
+        height, width = img.shape[:2]
+        return merge_region_tsvs(tsvs, [(x - margin, y - margin) for x, y, _, _ in regions], width, height)
+
+    def read_crop(self, img, lang):
+        """Returns the words Tesseract reads on an image as parse_tsv does, as it is: not resampled, cached nor split into regions."""
+        return parse_tsv(self._ocr_tsv(img, lang))
+
+    def _ocr_tsv(self, img, lang=None):
+        lang = lang or self.lang
+        with metrics.span('ocr.tesseract', engine=self.engine, lang=lang, pixels=img.shape[0] * img.shape[1]):
+            return self._run_tesseract(img, lang)
+
+    def _run_tesseract(self, img, lang):
+        if self.engine == 'tesserocr':
+            return _api_pool.image_to_tsv(img, lang, self.max_engines)
+        import pytesseract  # Imported lazily, it pulls in pandas which the tesserocr engine does not need
+        return pytesseract.image_to_data(img, lang=lang, output_type=pytesseract.Output.STRING)
+
+    def image_to_data(self, img):
+        # Same parsing as pytesseract's DATAFRAME output
+        import pandas as pd
+        return pd.read_csv(io.StringIO(self.image_to_tsv(img)), quoting=csv.QUOTE_NONE, sep='\t')
+
+    def get_words(self, img, resample=True):
+        # Images dewarped or preprocessed with the same policy are already at the OCR resolution, and their borders
+        # changed their width, so they are not resampled again
+        if self.resolution is not None and resample:
+            img = self.resolution.to_ocr(img)
+        tsv = self.image_to_tsv(img)
+        with metrics.span('ocr.parse_tsv'):
+            data = parse_tsv(tsv)
+        metrics.count('words_total', int(sum(word is not None for word in data['text'])))
+        return data
+
     def get_text(self, img):
-        df = pytesseract.image_to_data(img, lang=self.lang, output_type=pytesseract.Output.DATAFRAME)
-        df = self._cleanup_block_paragraph(df, self.nan_thresh)
-        df_filtered = df.dropna(subset=['text'])
-        df_sorted = df_filtered.sort_values(by=['parent_group', 'line_num', 'word_num'])
+        return self.words_to_text(self.get_words(img))
 
-        text = ""
-        for _, group in df_sorted.groupby('parent_group'):
-            words = group['text'].tolist()
-            text += " ".join(words) + " "
+    def words_to_text(self, data):
+        with metrics.span('ocr.assemble'):
+            return self._assemble_text(data, self.nan_thresh)
 
-        return text
+    def _assemble_text(self, data, threshold=0.5):
+        text = data['text']
+        if len(text) == 0:
+            return ""
+        is_null = np.fromiter((word is None for word in text), dtype=bool, count=len(text))
 
-    def _cleanup_block_paragraph(self, df, threshold=0.5):
-        df['parent_group'] = self._get_word_group(df)
-        df = df.groupby('parent_group').filter(lambda x: x.isnull().sum().sum() / x.shape[0] < threshold)
-        return df
+        # Drop block paragraphs (page, block, par) that are mostly unrecognized
+        keys = (data['page_num'] << 42) | (data['block_num'] << 21) | data['par_num']
+        groups, group_idx = np.unique(keys, return_inverse=True)
+        nan_ratio = np.bincount(group_idx, weights=is_null, minlength=len(groups)) / np.bincount(group_idx, minlength=len(groups))
+        keep = (nan_ratio < threshold)[group_idx] & ~is_null
 
-    def _get_word_group(self, df):
-        return df['page_num'].astype(str) + '_' + df['block_num'].astype(str) + '_' + df['par_num'].astype(str)
+        # Paragraphs are ordered by their 'page_block_par' string, as they were when keyed by strings
+        group_order = sorted(range(len(groups)), key=lambda i: f"{groups[i] >> 42}_{(groups[i] >> 21) & 0x1FFFFF}_{groups[i] & 0x1FFFFF}")
+        group_rank = np.empty(len(groups), dtype=np.int64)
+        group_rank[group_order] = np.arange(len(groups))
+        order = np.lexsort((data['word_num'][keep], data['line_num'][keep], group_rank[group_idx[keep]]))
+
+        # Every word, including the last one of each paragraph, is followed by a space
+        words = text[keep][order]
+        return " ".join(words) + " " if len(words) else ""
     
+    def output_path(self, page, output_dir):
+        if self.output_format == 'parquet':
+            return words.page_path(output_dir, page.name)
+        return os.path.join(output_dir, page.name + '.txt')
+
+    def save(self, name, text, data, output_dir):
+        if self.output_format == 'parquet':
+            words.write_page(output_dir, data, name)
+            return
+        with open(os.path.join(output_dir, name + '.txt'), 'w') as file:
+            file.write(text)
+
+    def write_book(self, source, pages, output_dir):
+        """With the parquet output, merges the pages of a source into <source name>.parquet in output_dir."""
+        if self.output_format != 'parquet':
+            return
+        book_name = os.path.basename(os.path.normpath(source)).split('.')[0]
+        path = words.write_book(os.path.join(output_dir, book_name + '.parquet'), [self.output_path(page, output_dir) for page in pages])
+        logger.info(f"Words of {len(pages)} pages written to {path}.")
+
     def process_single_image(self, image_path, output_dir):
-        if os.path.exists(image_path) and image_path.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff')):
-            image = cv2.imread(image_path)
-            extracted_text = self.get_text(image)
-            output_filename = os.path.splitext(os.path.basename(image_path))[0] + '.txt'
-            output_path = os.path.join(output_dir, output_filename)
-            with open(output_path, 'w') as file:
-                file.write(extracted_text)
+        page = as_page(image_path)
+        if os.path.exists(page.path) and page.filename.lower().endswith(IMAGE_EXTENSIONS):
+            with metrics.span('ocr.page', page=page.name):
+                image = page.read()
+                if image is None:
+                    logger.warning(f"Could not decode {page.key}, skipping it.")
+                    return
+                data = self.get_words(image)
+                self.save(page.name, self.words_to_text(data) if self.output_format == 'txt' else None, data, output_dir)
         else:
             logger.info(f"{image_path} is not a valid image file.")
 
-    def process_images(self, image_folder, output_dir):
-        with ThreadPoolExecutor() as executor:
-            for filename in os.listdir(image_folder):
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff')):
-                    image_path = os.path.join(image_folder, filename)
-                    executor.submit(self.process_single_image, image_path, output_dir)
+    def process_images(self, image_folder, output_dir, executor="thread", workers=None, manifest=None):
+        pages = list_pages(image_folder)
+        tasks = [(page, output_dir) for page in pages]
+        if manifest is None:
+            run_tasks(self, 'process_single_image', tasks, executor, workers)
+        else:
+            manifest.run(self, 'process_single_image', tasks, 'ocr', self.get_args(), self.output_path, executor, workers)
+        self.write_book(image_folder, pages, output_dir)
 
+@with_metrics
 def main(args):
-    text_extractor = TextExtractor(args.lang, args.nan_thresh)
+    text_extractor = TextExtractor(args.lang, args.nan_thresh, args.engine, get_cache(args), args.output_format, args.roi, get_resolution(args),
+                                   args.lang_candidates, args.max_engines)
     
     logger.info('Extracting text...')
     start_time = time.time()
     
-    if os.path.isdir(args.input_path):
-        text_extractor.process_images(args.input_path, args.output_dir)
+    if is_page_collection(args.input_path):
+        text_extractor.process_images(args.input_path, args.output_dir, args.executor, args.workers, get_manifest(args))
     elif os.path.isfile(args.input_path):
         text_extractor.process_single_image(args.input_path, args.output_dir)
+        text_extractor.write_book(args.input_path, [as_page(args.input_path)], args.output_dir)
     else:
         logger.error(f"Invalid input path: {args.input_path}")
     logger.info(f'Extraction from {args.input_path} to {args.output_dir} complete in {time.time() - start_time}.')
 
 def parser_add_arguments(parser):
-    parser.add_argument('input_path', help='Path of the image or folder to process.')
+    parser.add_argument('input_path', help='Path of the image, folder, archive (zip/tar), PDF or multi-page TIFF to process.')
     parser.add_argument('output_dir', help='Destination folder to store processed images.')
-    parser.add_argument('--lang', default='eng', help='Language used by Tesseract. Default is English.')
+    parser_add_options(parser)
+    parser_add_resolution_options(parser)
+    parser_add_executor_options(parser)
+    parser_add_cache_options(parser)
+    parser_add_manifest_options(parser)
+    parser_add_metrics_options(parser)
+
+def parser_add_options(parser):
+    parser.add_argument('--lang', default='eng', help='Language used by Tesseract, e.g. spa or spa+eng. Default is English. Use auto to detect the languages of every page among --lang_candidates.')
+    parser.add_argument('--lang_candidates', default=DEFAULT_CANDIDATES, help='Languages --lang auto picks from, joined with +. Those not installed are skipped. Defaults to the languages of packages.txt.')
+    parser.add_argument('--max_engines', type=int, default=4, help='Warm tesserocr engines, one per language combination, kept per thread. The least recently used is closed first.')
     parser.add_argument('--nan_thresh', type=float, default=0.5, help='NaN threshold for cleanup. That is, greatly unrecognized blocks of text will be removed.')
+    parser.add_argument('--engine', choices=['pytesseract', 'tesserocr'], default='pytesseract', help='Call the tesseract binary per image, or keep warm engines through libtesseract (requires tesserocr).')
+    parser.add_argument('--roi', action='store_true', help='Find the text regions of each page first and only OCR those, skipping margins, borders and illustrations.')
+    parser.add_argument('--output_format', choices=['txt', 'parquet'], default='txt', help='Write a text file per page, or a parquet file per book with the words, their boxes, confidences and block/paragraph/line numbers (requires pyarrow).')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Extract text from a given image path.')
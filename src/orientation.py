@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import cv2
+import numpy as np
+
+# Quarter turns of cv2.rotate, clockwise
+_ROTATE_CODES = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+def estimate_skew(image, work_size=1200, max_skew=15.0, max_points=200000, min_turn_ratio=1.25):
+    """
+    Returns (rotation, skew): the clockwise quarter turn (0 or 90) and the counterclockwise angle in degrees that make
+    the text lines of the page horizontal. Works on a downsampled binary image: the angle is the one whose horizontal
+    projection profile of the ink is the sharpest, searched coarse to fine, for the page as it is and turned by a quarter.
+    Pages are only turned if that profile is min_turn_ratio times as sharp, so that pages without clear lines, e.g.
+    tables or figures, are left as they are. Whether the page is then upside down is left to is_upside_down.
+    """
+    ink, _ = text_ink(image, work_size)
+    ys, xs = np.nonzero(ink)
+    if len(ys) < 100:  # Blank page
+        return 0, 0.0
+    if len(ys) > max_points:
+        step = len(ys) // max_points + 1
+        ys, xs = ys[::step], xs[::step]
+    ys, xs = ys.astype(np.float32), xs.astype(np.float32)
+
+    # Lines of a page turned by a quarter show up in the vertical profile, i.e. the horizontal one of (x, -y)
+    coarse = np.arange(-max_skew, max_skew + 0.5, 1.0)
+    upright, upright_score = _best_angle(ys, xs, coarse)
+    turned, turned_score = _best_angle(xs, -ys, coarse)
+    rotation, tilt = (90, turned) if turned_score > min_turn_ratio * upright_score else (0, upright)
+    if rotation == 90:
+        ys, xs = xs, ink.shape[0] - 1 - ys
+    tilt, _ = _best_angle(ys, xs, np.arange(tilt - 1.0, tilt + 1.05, 0.1))
+    return rotation, float(round(-tilt, 2))  # Rotating by the opposite angle straightens the lines
+
+def is_upside_down(image, work_size=1200, n_crops=3, crop_size=512, min_glyphs=40, min_ratio=1.5):
+    """
+    Tells upside-down pages (with horizontal lines) apart by their ascenders, more frequent than descenders in Latin
+    scripts: glyphs of the most text-dense crops reaching above the x-height band of their line outnumber those
+    reaching below it. Glyphs merge into words once downsampled, so the crops are taken at full resolution. Sparse
+    pages have too few glyphs to tell, then the ragged side of the lines decides, and the page is left as it is if
+    they are justified.
+    """
+    ink, scale = text_ink(image, work_size)
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    ascenders = descenders = 0
+    for x, y in _dense_tiles(ink, max(1, int(crop_size * scale)), n_crops):
+        x, y = int(x / scale), int(y / scale)
+        crop = cv2.medianBlur(np.ascontiguousarray(gray[y:y + crop_size, x:x + crop_size]), 3)
+        _, crop_ink = cv2.threshold(crop, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        up, down = _count_extenders(crop_ink)
+        ascenders += up
+        descenders += down
+    if ascenders + descenders >= min_glyphs and max(ascenders, descenders) >= min_ratio * min(ascenders, descenders):
+        return descenders > ascenders
+    return _aligned_side(ink) == 'right'
+
+def text_ink(image, work_size):
+    """
+    Returns the ink of a downsampled binary copy (as 255) and its scale. Ink touching the edges is dropped, scan
+    borders and dark page edges would dominate any measure of the text.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    scale = min(1.0, work_size / max(gray.shape))
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return _drop_edge_ink(ink), scale
+
+def _dense_tiles(ink, tile, n_tiles):
+    # Origins of the tiles with the most ink, as in select_crops, but of the ink left once borders are dropped
+    rows, cols = ink.shape[0] // tile, ink.shape[1] // tile
+    if rows == 0 or cols == 0:
+        return [(0, 0)]
+    density = cv2.resize((ink[:rows * tile, :cols * tile] > 0).astype(np.float32), (cols, rows), interpolation=cv2.INTER_AREA)
+    order = np.argsort(density, axis=None)[::-1][:n_tiles]
+    return [(c * tile, r * tile) for r, c in zip(*np.unravel_index(order, density.shape)) if density[r, c] > 0]
+
+def _aligned_side(ink, min_lines=4):
+    """Returns 'left' or 'right' for the side the text lines of a page are aligned on, None if both or neither."""
+    ys, xs = np.nonzero(ink)
+    if len(ys) == 0:
+        return None
+    x0, x1 = xs.min(), xs.max() + 1
+    lines = cv2.morphologyEx(ink, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, (x1 - x0) // 30), 1)))
+    _, _, stats, _ = cv2.connectedComponentsWithStats(lines, connectivity=8)
+    left, width, height = stats[1:, 0], stats[1:, 2], stats[1:, 3]
+    is_line = (width >= 0.2 * (x1 - x0)) & (height < 4 * np.median(height))
+    if np.count_nonzero(is_line) < min_lines:
+        return None
+    # Spread of the starts and ends of the lines, robust to indents and short last lines of paragraphs
+    starts, ends = left[is_line], left[is_line] + width[is_line]
+    start_spread, end_spread = np.median(np.abs(starts - np.median(starts))), np.median(np.abs(ends - np.median(ends)))
+    ragged = 0.02 * (x1 - x0)
+    if end_spread > ragged and start_spread < end_spread / 3:
+        return 'left'
+    if start_spread > ragged and end_spread < start_spread / 3:
+        return 'right'
+    return None
+
+def _drop_edge_ink(ink):
+    # Scan borders and dark page edges would dominate the profiles
+    _, labels = cv2.connectedComponents(ink, connectivity=8)
+    edge_labels = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+    ink[np.isin(labels, edge_labels[edge_labels > 0])] = 0
+    return ink
+
+def _best_angle(ys, xs, angles):
+    """
+    Returns the angle (counterclockwise) by which the text lines are tilted, and the sharpness of its profile. The sum
+    of squared row counts is largest when the rows line up with the text lines. It grows as the profile gets shorter
+    though, so the sharpness returned is the mean squared count over the squared mean count, which can be compared
+    between the profiles of the page height and width.
+    """
+    best, best_score, best_counts = 0.0, -1.0, None
+    for angle in angles:
+        theta = np.deg2rad(angle)
+        rows = (ys * np.cos(theta) + xs * np.sin(theta)).astype(np.int64)
+        counts = np.bincount(rows - rows.min()).astype(np.float64)
+        score = float(np.dot(counts, counts))
+        if score > best_score:
+            best, best_score, best_counts = float(angle), score, counts
+    return best, float(np.mean(best_counts ** 2) / np.mean(best_counts) ** 2)
+
+def _count_extenders(ink, max_glyphs=2000):
+    """Returns the number of glyphs reaching above the x-height band of their line (ascenders) and below it (descenders)."""
+    _, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    left, top, width, height, area = (stats[1:, i].astype(np.float32) for i in range(5))
+    # Specks, and glyphs cut by the crop edges
+    glyphs = (area >= 8) & (height >= 4) & (left > 0) & (top > 0) & (left + width < ink.shape[1]) & (top + height < ink.shape[0])
+    if not glyphs.any():
+        return 0, 0
+    step = np.count_nonzero(glyphs) // max_glyphs + 1
+    left, top, width, height = left[glyphs][::step], top[glyphs][::step], width[glyphs][::step], height[glyphs][::step]
+    bottom, center_x, center_y = top + height, left + width / 2, top + height / 2
+    size = float(np.median(height))
+
+    # The band of every glyph is the median top and bottom of its neighbours on the same line, local enough to follow
+    # bowed lines
+    near = (np.abs(center_x[:, None] - center_x[None, :]) < 6 * size) & (np.abs(center_y[:, None] - center_y[None, :]) < 0.6 * size)
+    band_top = np.nanmedian(np.where(near, top[None, :], np.nan), axis=1)
+    band_bottom = np.nanmedian(np.where(near, bottom[None, :], np.nan), axis=1)
+    margin = 0.3 * (band_bottom - band_top)
+    # Sticking out on one side only, which leaves out the dots of i and j, commas and quotes
+    ascenders = np.count_nonzero((top < band_top - margin) & (np.abs(bottom - band_bottom) < margin))
+    descenders = np.count_nonzero((bottom > band_bottom + margin) & (np.abs(top - band_top) < margin))
+    return ascenders, descenders
+
+def _rotate(image, rotation, skew):
+    if rotation:
+        image = cv2.rotate(image, _ROTATE_CODES[rotation])
+    if abs(skew) < 0.05:
+        return image
+    # Rotated around the centre, into a canvas large enough to keep the corners. The corners are filled with the
+    # edges of the image, white would cut dark scan borders off the edges and make them look like ink.
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), skew, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_width, new_height = int(np.ceil(height * sin + width * cos)), int(np.ceil(height * cos + width * sin))
+    matrix[0, 2] += (new_width - width) / 2
+    matrix[1, 2] += (new_height - height) / 2
+    return cv2.warpAffine(image, matrix, (new_width, new_height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+def deskew(image, work_size=1200, max_skew=15.0):
+    """
+    Straightens the page and turns it upright, with a single interpolating rotation at full resolution (the half turn
+    of upside-down pages is lossless). Returns (image, rotation, skew).
+    """
+    rotation, skew = estimate_skew(image, work_size, max_skew)
+    image = _rotate(image, rotation, skew)
+    if is_upside_down(image, work_size):
+        image = cv2.rotate(image, cv2.ROTATE_180)
+        rotation = (rotation + 180) % 360
+    return image, rotation, skew
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+import os
+import cv2
+import argparse
+from .utils.executors import run_tasks, parser_add_executor_options
+from .dewarping import ImageDewarper, parser_add_options as parser_add_options_dewarping
+from .preprocessing import ImagePreprocessor, load_params, parser_add_options as parser_add_options_preprocessing
+from .orientation import deskew
+from .routing import get_router, parser_add_routing_options
+from .autotune import get_tuner, parser_add_autotune_options
+from .ocr import TextExtractor, parser_add_options as parser_add_options_ocr
+from .objects import ProcessedImage
+from .utils.logger_config import setup_logger
+from .utils.cache import get_cache, parser_add_cache_options
+from .utils.manifest import get_manifest, parser_add_manifest_options
+from .utils.resolution import get_resolution, parser_add_resolution_options
+from .utils.sources import IMAGE_EXTENSIONS, as_page, list_pages, is_page_collection, iter_pages
+from .utils.metrics import metrics, with_metrics, parser_add_metrics_options
+from .utils.stages import Stage, run_stages, parser_add_stage_options
+import time
+
+logger = setup_logger()
+
+# Stages of a --staged run, in order
+STAGES = ["decode", "dewarp", "preprocess", "ocr", "clean"]
+
+class UndecodablePageError(ValueError):
+    """Raised by the decode stage for pages that are skipped rather than failing the run."""
+
+class Pipeline:
+    """
+    Runs dewarping, preprocessing, OCR and optionally LLM cleanup on in-memory images. Each page is decoded once
+    and only the extracted text is written, unless intermediate dumps are requested.
+    """
+    def __init__(self, dewarper=None, preprocessor=None, text_extractor=None, dump_dir=None, cleaner=None, clean_dir=None, router=None):
+        self.dewarper = dewarper  # Skip the stage if None
+        self.preprocessor = preprocessor  # Skip the stage if None
+        self.text_extractor = text_extractor or TextExtractor()
+        self.dump_dir = dump_dir
+        self.cleaner = cleaner  # TextCleanerLLM, skip the stage if None
+        self.clean_dir = clean_dir  # Where cleaned texts are written
+        self.router = router  # PageRouter picking the steps of every page, every enabled step runs on every page if None
+        self._light = None
+
+    def get_args(self):
+        return {
+            "dewarp": self.dewarper.get_args() if self.dewarper is not None else None,
+            "preprocess": self.preprocessor.get_params() if self.preprocessor is not None else None,
+            "ocr": self.text_extractor.get_args(),
+            "clean": self.cleaner.get_args() if self.cleaner is not None else None,
+            "route": self.router.get_args() if self.router is not None else None
+        }
+
+    def run(self, processed_image):
+        self.route(processed_image)
+        self.dewarp(processed_image)
+        self.preprocess(processed_image)
+        self.extract(processed_image)
+        self.clean(processed_image)
+        return processed_image
+
+    def route(self, processed_image):
+        if self.router is not None:
+            processed_image.route = self.router.route(processed_image.original_img, processed_image.name)
+        return processed_image
+
+    def dewarp(self, processed_image):
+        if self.dewarper is None or (processed_image.route is not None and not processed_image.route["dewarp"]):
+            return processed_image
+        dewarped_img = self.dewarper.dewarp_image(processed_image.original_img)
+        if dewarped_img is not None:
+            processed_image.dewarped_img = dewarped_img
+            processed_image.resampled = self.dewarper.resolution is not None
+            self._dump(processed_image.name, 'dewarped', dewarped_img)
+        else:
+            logger.warning(f"Dewarping failed for {processed_image.name}, using the original image.")
+        return processed_image
+
+    def preprocess(self, processed_image):
+        if self.preprocessor is None:
+            return processed_image
+        level = processed_image.route["preprocess"] if processed_image.route is not None else "heavy"
+        if level == "none":
+            # Tesseract binarizes clean pages as well on its own, only their orientation is fixed if requested
+            if self.preprocessor.deskew:
+                with metrics.span('preprocess.deskew'):
+                    processed_image.preprocessed_img, rotation, skew = deskew(processed_image.latest_img)
+                metrics.count('deskew_rotations_total', rotation=rotation)
+                if rotation:
+                    logger.info(f"Turned {processed_image.name} by {rotation} degrees (skew {skew}).")
+                self._dump(processed_image.name, 'preprocessed', processed_image.preprocessed_img)
+            return processed_image
+        preprocessor = self.light_preprocessor if level == "light" else self.preprocessor
+        processed_image.preprocessed_img = preprocessor.preprocess_single_image(processed_image.latest_img)
+        processed_image.resampled = preprocessor.resolution is not None
+        self._dump(processed_image.name, 'preprocessed', processed_image.preprocessed_img)
+        return processed_image
+
+    def extract(self, processed_image):
+        processed_image.words = self.text_extractor.get_words(processed_image.latest_img, resample=not processed_image.resampled)
+        processed_image.extracted_text = self.text_extractor.words_to_text(processed_image.words)
+        return processed_image
+
+    def clean(self, processed_image):
+        if self.cleaner is None:
+            return processed_image
+        processed_image.cleaned_text = self.cleaner.clean_text(processed_image.extracted_text)
+        return processed_image
+
+    @property
+    def light_preprocessor(self):
+        # The preprocessor without erosion and dilation, kept in sync with it (e.g. after autotuning)
+        args = dict(self.preprocessor.get_args(), noise_kernel=0, erode_kernel=0, dilate_kernel=0)
+        if self._light is None or self._light.get_args() != args:
+            self._light = ImagePreprocessor(**args, cache=self.preprocessor.cache, resolution=self.preprocessor.resolution)
+        return self._light
+
+    def autotune(self, tuner, image_paths):
+        # Tune on the pages as the preprocessor will see them, i.e. dewarped, deskewed and at the OCR resolution
+        context = {
+            "dewarp": self.dewarper.get_args() if self.dewarper is not None else None,
+            "deskew": self.preprocessor.deskew,
+            "resolution": self.preprocessor.resolution.get_args() if self.preprocessor.resolution is not None else None
+        }
+        self.preprocessor.update_args(**tuner.tune_book(image_paths, self._prepare_for_tuning, context))
+
+    def _prepare_for_tuning(self, image):
+        if self.dewarper is not None:
+            dewarped_img = self.dewarper.dewarp_image(image)
+            image = dewarped_img if dewarped_img is not None else image
+        if self.preprocessor.deskew:
+            image, _, _ = deskew(image)
+        if self.preprocessor.resolution is not None:
+            image = self.preprocessor.resolution.to_ocr(image)
+        return image
+
+    def _dump(self, name, stage, image):
+        if self.dump_dir is None or name is None:
+            return
+        stage_dir = os.path.join(self.dump_dir, stage)
+        os.makedirs(stage_dir, exist_ok=True)
+        cv2.imwrite(os.path.join(stage_dir, name + '.png'), image)
+
+    def stream(self, source, prefetch_size=4):
+        """Yields the processed pages of a folder, archive, PDF or TIFF in order, decoding the next ones in the background."""
+        for page, image in iter_pages(source, prefetch_size):
+            if image is None:
+                logger.warning(f"Could not decode {page.key}, skipping it.")
+                continue
+            with metrics.span('pipeline.page', page=page.name):
+                processed_image = self.run(ProcessedImage(image, name=page.name))
+            yield processed_image
+
+    def process_single_image(self, image_path, output_dir):
+        page = as_page(image_path)
+        if not (os.path.exists(page.path) and page.filename.lower().endswith(IMAGE_EXTENSIONS)):
+            logger.info(f"{page.path} is not a valid image file.")
+            return
+        with metrics.span('pipeline.page', page=page.name):
+            image = page.read()
+            if image is None:
+                logger.warning(f"Could not decode {page.key}, skipping it.")
+                return
+            processed_image = self.run(ProcessedImage(image, name=page.name))
+            self.save(processed_image, output_dir)
+
+    def save(self, processed_image, output_dir):
+        self.text_extractor.save(processed_image.name, processed_image.extracted_text, processed_image.words, output_dir)
+        if processed_image.cleaned_text is not None:
+            with open(os.path.join(self.clean_dir, processed_image.name + '.txt'), 'w') as file:
+                file.write(processed_image.cleaned_text)
+
+    def process_images(self, image_folder, output_dir, executor="thread", workers=None, manifest=None):
+        pages = list_pages(image_folder)
+        tasks = [(page, output_dir) for page in pages]
+        if manifest is None:
+            run_tasks(self, 'process_single_image', tasks, executor, workers)
+        else:
+            manifest.run(self, 'process_single_image', tasks, 'pipeline', self.get_args(), self.text_extractor.output_path, executor, workers)
+        self.text_extractor.write_book(image_folder, pages, output_dir)
+
+    def stages(self, output_dir, workers=None):
+        """
+        The pipeline split into stages that run concurrently, decode and every enabled step each with their own
+        workers (a dict of stage name to thread count). Steps release the images earlier steps no longer need.
+        """
+        workers = workers or {}
+        def decode(page):
+            image = page.read()
+            if image is None:
+                raise UndecodablePageError(f"Could not decode {page.key}.")
+            return self.route(ProcessedImage(image, name=page.name))
+
+        def release(step):
+            def run(processed_image):
+                step(processed_image)
+                latest = processed_image.latest_img
+                if processed_image.original_img is not latest:
+                    processed_image.original_img = None
+                if processed_image.dewarped_img is not latest:
+                    processed_image.dewarped_img = None
+                return processed_image
+            return run
+
+        def extract(processed_image):
+            self.extract(processed_image)
+            processed_image.original_img = processed_image.dewarped_img = processed_image.preprocessed_img = None
+            if self.cleaner is None:
+                self.save(processed_image, output_dir)
+            return processed_image
+
+        def clean(processed_image):
+            self.clean(processed_image)
+            self.save(processed_image, output_dir)
+            return processed_image
+
+        stages = [Stage('decode', decode, workers.get('decode', 1))]
+        if self.dewarper is not None:
+            stages.append(Stage('dewarp', release(self.dewarp), workers.get('dewarp', 1)))
+        if self.preprocessor is not None:
+            stages.append(Stage('preprocess', release(self.preprocess), workers.get('preprocess', 1)))
+        stages.append(Stage('ocr', extract, workers.get('ocr', 1)))
+        if self.cleaner is not None:
+            stages.append(Stage('clean', clean, workers.get('clean', 1)))
+        return stages
+
+    def process_staged(self, image_folder, output_dir, workers=None, queue_size=4, manifest=None):
+        """
+        Like process_images, with every stage working on a different page at the same time and at most queue_size
+        pages waiting between two stages. Pages are written as they leave the last stage.
+        """
+        pages = list_pages(image_folder)
+        params = self.get_args()
+        pending = pages if manifest is None else [task[0] for task in manifest.pending('pipeline', params, [(page,) for page in pages])]
+        failed = 0
+        for page, _, error in run_stages(pending, self.stages(output_dir, workers), queue_size):
+            if manifest is not None:
+                manifest.record('pipeline', page, params, self.text_extractor.output_path(page, output_dir), error)
+            if isinstance(error, UndecodablePageError):
+                logger.warning(f"Could not decode {page.key}, skipping it.")
+            elif error is not None:
+                if manifest is None:
+                    raise error
+                logger.error(f"pipeline: {page.key} failed with {error!r}")
+                failed += 1
+        if failed:
+            logger.error(f"pipeline: {failed} items failed, they will be retried on the next run.")
+        self.text_extractor.write_book(image_folder, pages, output_dir)
+
+def get_cleaner(args, cache=None):
+    if args.clean_dir is None:
+        return None
+    if args.prompt_template is None:
+        raise SystemExit("--clean_dir needs a --prompt_template.")
+    try:
+        from .postprocessing import TextCleanerLLM
+    except ImportError as e:
+        raise SystemExit(f"Cleanup is not enabled as LLM requirements are not installed ({e}).")
+    logger.info("Loading LLM...")
+    cleaner = TextCleanerLLM(args.model, device_map=args.device_map, cache=cache)
+    cleaner.set_prompt_template(args.prompt_template)
+    return cleaner
+
+def get_pipeline(args):
+    cache = get_cache(args)
+    resolution = get_resolution(args)
+    dewarper = None if args.skip_dewarp else ImageDewarper(additional_args=args.additional_args, backend=args.backend, cache=cache, resolution=resolution)
+    preprocessor = None if args.skip_preprocess else ImagePreprocessor(args.blur_type, args.thresh_type, args.min_thresh, args.max_thresh, args.noise_kernel, args.erode_kernel, args.dilate_kernel, args.noise_iter, args.erode_iter, args.dilate_iter, cache, resolution, args.deskew)
+    text_extractor = TextExtractor(args.lang, args.nan_thresh, args.engine, cache, args.output_format, args.roi, resolution, args.lang_candidates, args.max_engines)
+    if preprocessor is not None and args.preprocess_params is not None:
+        preprocessor.update_args(**load_params(args.preprocess_params))
+    cleaner = get_cleaner(args, cache)
+    return Pipeline(dewarper, preprocessor, text_extractor, dump_dir=args.dump_dir, cleaner=cleaner, clean_dir=args.clean_dir, router=get_router(args))
+
+@with_metrics
+def main(args):
+    pipeline = get_pipeline(args)
+    preprocessor, text_extractor = pipeline.preprocessor, pipeline.text_extractor
+    for output_dir in (args.output_dir, args.clean_dir):
+        if output_dir is not None and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+    logger.info('Running pipeline...')
+    start_time = time.time()
+    if is_page_collection(args.input_path):
+        tuner = get_tuner(args, text_extractor)
+        if tuner is not None and preprocessor is not None:
+            pipeline.autotune(tuner, list_pages(args.input_path))
+        if args.staged:
+            workers = {stage: getattr(args, f'{stage}_workers') for stage in STAGES}
+            pipeline.process_staged(args.input_path, args.output_dir, workers, args.queue_size, get_manifest(args))
+        else:
+            pipeline.process_images(args.input_path, args.output_dir, args.executor, args.workers, get_manifest(args))
+    elif os.path.isfile(args.input_path):
+        pipeline.process_single_image(args.input_path, args.output_dir)
+        text_extractor.write_book(args.input_path, [as_page(args.input_path)], args.output_dir)
+    else:
+        logger.error(f"Invalid input path: {args.input_path}")
+    logger.info(f'Pipeline from {args.input_path} to {args.output_dir} complete in {time.time() - start_time}.')
+
+def parser_add_arguments(parser):
+    parser.add_argument('input_path', help='Path of the image, folder, archive (zip/tar), PDF or multi-page TIFF to process.')
+    parser.add_argument('output_dir', help='Destination folder to store extracted text.')
+    parser.add_argument('--skip_dewarp', action='store_true', help='Do not dewarp the images.')
+    parser.add_argument('--skip_preprocess', action='store_true', help='Do not preprocess the images.')
+    parser.add_argument('--dump_dir', default=None, help='Folder to dump intermediate dewarped and preprocessed images. Nothing is dumped by default.')
+    parser_add_options_dewarping(parser)
+    parser_add_options_preprocessing(parser)
+    parser_add_routing_options(parser)
+    parser_add_autotune_options(parser)
+    parser_add_options_ocr(parser)
+    parser_add_clean_options(parser)
+    parser_add_resolution_options(parser)
+    parser_add_executor_options(parser)
+    parser_add_stage_options(parser, STAGES)
+    parser_add_cache_options(parser)
+    parser_add_manifest_options(parser)
+    parser_add_metrics_options(parser)
+
+def parser_add_clean_options(parser):
+    parser.add_argument('--clean_dir', default=None, help='Folder to write the texts cleaned with an LLM to. No cleanup by default (requires requirements-llm.txt).')
+    parser.add_argument('--prompt_template', default=None, help='Path to the prompt template file used for cleanup.')
+    parser.add_argument('--model', default="TheBloke/Mistral-7B-Instruct-v0.1-GPTQ", help='Name or path of the cleanup model.')
+    parser.add_argument('--device_map', default="auto", help='Where to load the cleanup model, e.g. "auto" or "cpu".')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the full pipeline on a given image path.')
+    parser_add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
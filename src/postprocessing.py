@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
+import re
 import json
+import difflib
+import transformers
 from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
 import argparse
 import os
 import time
 from .utils.logger_config import setup_logger
+from .utils.executors import run_tasks, parser_add_executor_options
+from .utils.cache import hash_text, get_cache, parser_add_cache_options
+from .utils.manifest import get_manifest, parser_add_manifest_options
+from .utils.metrics import metrics, with_metrics, parser_add_metrics_options
 
 logger = setup_logger()
 
@@ -19,7 +26,20 @@ class TextCleanerLLM:
                  revision="main",
                  use_fast=True,
                  prompt_template=None,
-                 pipeline_params=None):
+                 pipeline_params=None,
+                 cache=None,
+                 chunk_tokens=None,
+                 chunk_overlap=32):
+
+        # Kept to rebuild the cleaner within process-pool workers instead of pickling the model
+        self._init_kwargs = dict(model_name_or_path=model_name_or_path, device_map=device_map,
+                                 trust_remote_code=trust_remote_code, revision=revision, use_fast=use_fast,
+                                 prompt_template=prompt_template, pipeline_params=pipeline_params, cache=cache,
+                                 chunk_tokens=chunk_tokens, chunk_overlap=chunk_overlap)
+        self.cache = cache
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        self.model_version = f"{model_name_or_path}@{revision}, transformers {transformers.__version__}"
 
         self.model = AutoModelForCausalLM.from_pretrained(model_name_or_path,
                                                           device_map=device_map,
@@ -27,6 +47,10 @@ class TextCleanerLLM:
                                                           revision=revision)
 
         self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=use_fast)
+        # Batched generation pads prompts on the left, so that every sequence ends where generation starts
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
 
         self.pipeline_params = pipeline_params or {
             'max_new_tokens': 512,
@@ -44,6 +68,17 @@ class TextCleanerLLM:
 
         self.prompt_template = prompt_template
 
+    def get_args(self):
+        return {'prompt_template': self.prompt_template, 'pipeline_params': self.pipeline_params, 'model': self.model_version,
+                'chunk_tokens': self.chunk_tokens, 'chunk_overlap': self.chunk_overlap}
+
+    def __getstate__(self):
+        return {'init_kwargs': self._init_kwargs, 'pipeline_params': self.pipeline_params, 'prompt_template': self.prompt_template}
+
+    def __setstate__(self, state):
+        self.__init__(**{**state['init_kwargs'], 'pipeline_params': state['pipeline_params']})
+        self.prompt_template = state['prompt_template']
+
     def update_pipeline_params(self, new_params):
         self.pipeline_params.update(new_params)
         self.pipe = pipeline("text-generation",
@@ -60,19 +95,159 @@ class TextCleanerLLM:
             prompt_template = json.load(f)
         self.prompt_template = prompt_template['messages']
 
-    def clean_text(self, text): ###
+    def _build_prompt(self, text):
         if self.prompt_template is None:
             prompt_template = [{'role': 'user', 'content': text}]
         else:
-            prompt_template = self.prompt_template.copy()
+            prompt_template = [dict(message) for message in self.prompt_template]  # Do not format the template in place
             prompt_template[-1]['content'] = prompt_template[-1]['content'].format(text=text)
         
-        prompt = self.tokenizer.decode(self.tokenizer.apply_chat_template(prompt_template, return_tensors="pt")[0])
-        return self.pipe(prompt)[0]['generated_text']
+        token_ids = self.tokenizer.apply_chat_template(prompt_template, return_tensors="pt")[0]
+        return self.tokenizer.decode(token_ids), len(token_ids)
+
+    def _chunk_budget(self):
+        # Cleaned text is about as long as its input, so chunks must leave room for it within max_new_tokens and the context
+        max_new_tokens = self.pipeline_params.get('max_new_tokens', 512)
+        budget = self.chunk_tokens or max_new_tokens * 3 // 4
+        template_tokens = self._build_prompt("")[1]
+        return max(self.chunk_overlap + 1, min(budget, self.tokenizer.model_max_length - template_tokens - max_new_tokens))
+
+    def _chunk_text(self, text):
+        """
+        Splits text into chunks of at most the token budget, cut at whitespace, each overlapping the previous one
+        by about chunk_overlap tokens. Returns the chunks and the overlapping text between consecutive chunks.
+        """
+        if self.tokenizer.is_fast:
+            offsets = [start for start, _ in self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']]
+        else:  # No offsets with slow tokenizers, words stand in for tokens
+            offsets = [match.start() for match in re.finditer(r'\S+', text)]
+        budget = self._chunk_budget()
+        if len(offsets) <= budget:
+            return [text], []
+
+        def word_boundary(tok, lowest):
+            # Move back to the closest token that starts a word, so that words are not split across chunks
+            for t in range(tok, lowest, -1):
+                if offsets[t] > 0 and text[offsets[t] - 1].isspace():
+                    return t
+            return tok
+
+        chunks, overlaps = [], []
+        start = 0
+        while True:
+            end = len(offsets) if start + budget >= len(offsets) else word_boundary(start + budget, start + budget // 2)
+            chunk_end = len(text) if end == len(offsets) else offsets[end]
+            chunks.append(text[offsets[start] if start > 0 else 0:chunk_end])
+            if end == len(offsets):
+                return chunks, overlaps
+            next_start = word_boundary(max(end - self.chunk_overlap, start + 1), start)
+            overlaps.append(text[offsets[next_start]:chunk_end])
+            start = next_start
+
+    def _merge(self, merged, output, overlap):
+        # Align the end of what is merged so far with the start of the next output on their longest common run,
+        # which is where both cleaned the same overlapping text
+        window = 2 * len(overlap) + 32
+        tail_start = max(0, len(merged) - window)
+        tail, head = merged[tail_start:], output[:window]
+        match = difflib.SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(0, len(tail), 0, len(head))
+        if match.size >= min(16, max(4, len(overlap) // 2)):
+            return merged[:tail_start + match.a] + output[match.b:]
+        # No reliable alignment, drop as many words from the output as the overlap had
+        skipped = re.match(r'(\s*\S+){%d}\s*' % len(overlap.split()), output) if overlap.split() else None
+        return merged.rstrip() + " " + output[skipped.end() if skipped else 0:].lstrip()
+
+    def _stitch(self, outputs, overlaps):
+        merged = outputs[0]
+        for output, overlap in zip(outputs[1:], overlaps):
+            merged = self._merge(merged, output, overlap)
+        return merged
+
+    def clean_text(self, text): ###
+        return self.clean_texts([text])[0]
 
+    def clean_text_stream(self, text):
+        """
+        Cleans text chunk by chunk, yielding the cleaned text as soon as later chunks can no longer change it.
+        """
+        chunks, overlaps = self._chunk_text(text)
+        merged, emitted = "", 0
+        for i, chunk in enumerate(chunks):
+            output = self._generate([chunk])[0]
+            merged = output if i == 0 else self._merge(merged, output, overlaps[i - 1])
+            if i < len(overlaps):
+                final = len(merged) - (2 * len(overlaps[i]) + 32)  # Only the tail can be cut by the next merge
+                if final > emitted:
+                    yield merged[emitted:final]
+                    emitted = final
+        yield merged[emitted:]
+
+    def clean_texts(self, texts, batch_size=1):
+        """
+        Cleans several texts, generating batch_size chunks at a time. Long texts are split into overlapping chunks
+        that fit the token budget and stitched back together, so that nothing is silently truncated.
+        """
+        chunked = [self._chunk_text(text) for text in texts]
+        outputs = self._generate([chunk for chunks, _ in chunked for chunk in chunks], batch_size)
+        results = []
+        for chunks, overlaps in chunked:
+            results.append(self._stitch(outputs[:len(chunks)], overlaps))
+            outputs = outputs[len(chunks):]
+        return results
+
+    def _generate(self, texts, batch_size=1):
+        # Prompts are sorted by token length, so that sequences of similar length are batched together and little compute is spent on padding
+        prompts = [self._build_prompt(text) for text in texts]
+        key_params = {**self.pipeline_params, 'return_full_text': False}
+        keys = [self.cache.key(hash_text(prompt), 'llm', key_params, self.model_version) for prompt, _ in prompts] if self.cache is not None else None
+        results = [self.cache.get(key) for key in keys] if self.cache is not None else [None] * len(prompts)
+
+        pending = sorted((i for i, result in enumerate(results) if result is None), key=lambda i: prompts[i][1], reverse=True)
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            # Only the generated text, the prompt would be repeated in every chunk
+            with metrics.span('postprocess.generate', batch_size=len(batch), prompt_tokens=sum(prompts[i][1] for i in batch)):
+                outputs = self.pipe([prompts[i][0] for i in batch], batch_size=len(batch), return_full_text=False)
+            for i, output in zip(batch, outputs):
+                results[i] = output[0]['generated_text']
+                if self.cache is not None:
+                    self.cache.put(keys[i], results[i])
+        return results
+
+    def clean_file(self, file_path, output_dir):
+        self.clean_files([file_path], output_dir)
+
+    def clean_files(self, file_paths, output_dir, batch_size=1):
+        texts = []
+        for file_path in file_paths:
+            with open(file_path, 'r') as file:
+                texts.append(file.read())
+        for file_path, cleaned_text in zip(file_paths, self.clean_texts(texts, batch_size)):
+            output_file_path = os.path.join(output_dir, os.path.basename(file_path))
+            with open(output_file_path, 'w') as outfile:
+                outfile.write(cleaned_text)
+
+def clean_files_batched(cleaner, file_paths, output_dir, batch_size, manifest=None, params=None):
+    # Prompts are sorted within windows of files, which bounds memory while still batching similar lengths together
+    window = batch_size * 16
+    for start in range(0, len(file_paths), window):
+        window_paths = file_paths[start:start + window]
+        error = None
+        try:
+            cleaner.clean_files(window_paths, output_dir, batch_size)
+        except Exception as e:
+            if manifest is None:
+                raise
+            logger.error(f"postprocess: batch starting at {window_paths[0]} failed with {e!r}")
+            error = e
+        if manifest is not None:
+            for file_path in window_paths:
+                manifest.record('postprocess', file_path, params, os.path.join(output_dir, os.path.basename(file_path)), error)
+
+@with_metrics
 def main(args):
     logger.info("Loading LLM...")
-    cleaner = TextCleanerLLM()
+    cleaner = TextCleanerLLM(args.model, device_map=args.device_map, cache=get_cache(args), chunk_tokens=args.chunk_tokens, chunk_overlap=args.chunk_overlap)
     if args.prompt_template is not None:
         cleaner.set_prompt_template(args.prompt_template)
 
@@ -80,24 +255,22 @@ def main(args):
     start_time = time.time()
 
     if os.path.isdir(args.input_path):
-        for filename in os.listdir(args.input_path):
-            if filename.endswith('.txt'):
-                file_path = os.path.join(args.input_path, filename)
-                with open(file_path, 'r') as file:
-                    text = file.read()
-                    cleaned_text = cleaner.clean_text(text)
-                    output_file_path = os.path.join(args.output_dir, filename)
-                    with open(output_file_path, 'w') as outfile:
-                        outfile.write(cleaned_text)
-
+        tasks = [(os.path.join(args.input_path, filename), args.output_dir)
+                 for filename in os.listdir(args.input_path)
+                 if filename.endswith('.txt')]
+        manifest = get_manifest(args)
+        params = cleaner.get_args()
+        if args.batch_size > 1:
+            if manifest is not None:
+                tasks = manifest.pending('postprocess', params, tasks)
+            clean_files_batched(cleaner, [task[0] for task in tasks], args.output_dir, args.batch_size, manifest, params)
+        elif manifest is None:
+            run_tasks(cleaner, 'clean_file', tasks, args.executor, args.workers)
+        else:
+            output_path = lambda file_path, output_dir: os.path.join(output_dir, os.path.basename(file_path))
+            manifest.run(cleaner, 'clean_file', tasks, 'postprocess', params, output_path, args.executor, args.workers)
     elif os.path.isfile(args.input_path) and args.input_path.endswith('.txt'):
-        with open(args.input_path, 'r') as file:
-            text = file.read()
-            cleaned_text = cleaner.clean_text(text)
-            output_filename = os.path.basename(args.input_path)
-            output_file_path = os.path.join(args.output_dir, output_filename)
-            with open(output_file_path, 'w') as outfile:
-                outfile.write(cleaned_text)
+        cleaner.clean_file(args.input_path, args.output_dir)
     else:
         logger.error(f"Invalid input path: {args.input_path}")
 
@@ -107,6 +280,15 @@ def parser_add_arguments(parser):
     parser.add_argument('input_path', help='Path of the text file or folder to process.')
     parser.add_argument('output_dir', help='Destination folder to store processed text.')
     parser.add_argument('--prompt_template', required=True, help='Path to prompt template file.') ### 
+    parser.add_argument('--model', default="TheBloke/Mistral-7B-Instruct-v0.1-GPTQ", help='Name or path of the model. GPTQ models need a GPU, use a regular model with --device_map cpu otherwise.')
+    parser.add_argument('--device_map', default="auto", help='Where to load the model, e.g. "auto" or "cpu" for nodes without a GPU.')
+    parser.add_argument('--chunk_tokens', type=int, default=None, help='Maximum tokens of text per prompt, longer texts are split into overlapping chunks. Defaults to 3/4 of max_new_tokens.')
+    parser.add_argument('--chunk_overlap', type=int, default=32, help='Tokens shared by consecutive chunks, used to stitch their outputs back together.')
+    parser.add_argument('--batch_size', type=int, default=1, help='Number of texts generated at once. Texts of many files are sorted by length to reduce padding.')
+    parser_add_executor_options(parser, default="serial")  # A single model is shared by threads
+    parser_add_cache_options(parser)
+    parser_add_manifest_options(parser)
+    parser_add_metrics_options(parser)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process text files using TextCleanerLLM.')
@@ -2,15 +2,111 @@
 import argparse
 import cv2
 import os
+import json
+import threading
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor
+from .utils.executors import run_tasks, parser_add_executor_options
 import time
 from .utils.logger_config import setup_logger
+from .utils.cache import hash_array, get_cache, parser_add_cache_options
+from .utils.manifest import get_manifest, parser_add_manifest_options
+from .utils.sources import as_page, list_pages, is_page_collection
+from .orientation import deskew
+from .utils.resolution import resize, get_resolution, parser_add_resolution_options
+from .utils.metrics import metrics, with_metrics, parser_add_metrics_options
 
 logger = setup_logger()
 
+# Per-thread scratch buffers reused across images, keyed by name
+_buffers = threading.local()
+
+def _buffer(name, shape):
+    buffers = _buffers.__dict__
+    if name not in buffers or buffers[name].shape != shape:
+        buffers[name] = np.empty(shape, dtype=np.uint8)
+    return buffers[name]
+
+class PreprocessingPlan:
+    """
+    Compiled form of the preprocessing parameters, producing the same output as running the steps one by one.
+    Structuring elements are built once, consecutive erosions (or dilations) are merged into a single one with
+    the equivalent larger kernel, and every step writes into per-thread buffers that are reused across images.
+    """
+    def __init__(self, blur_type="median", thresh_type="otsu", min_thresh=127, max_thresh=255, noise_kernel=1, erode_kernel=2, dilate_kernel=2, noise_iter=1, erode_iter=1, dilate_iter=1, deskew=False):
+        self.deskew = deskew
+        self.blur_type = blur_type
+        self.thresh_type = thresh_type
+        self.min_thresh = min_thresh
+        self.max_thresh = max_thresh
+
+        ops = []
+        if noise_kernel >= 1:
+            ops += [('dilate', noise_kernel, noise_iter), ('erode', noise_kernel, noise_iter)]
+        if erode_kernel >= 1:
+            ops.append(('erode', erode_kernel, erode_iter))
+        if dilate_kernel >= 1:
+            ops.append(('dilate', dilate_kernel, dilate_iter))
+        self.morphology = self._compile_morphology(ops)
+
+    @staticmethod
+    def _compile_morphology(ops):
+        # A square kernel of size k with OpenCV's default anchor k // 2 reaches the pixel offsets [-(k // 2), k - 1 - k // 2].
+        # Applying it n times, or chaining kernels, reaches the sum of their ranges, which is itself a square kernel.
+        merged = []
+        for op, kernel_size, iterations in ops:
+            low, high = -iterations * (kernel_size // 2), iterations * (kernel_size - 1 - kernel_size // 2)
+            if low == high == 0:  # 1x1 kernel or no iterations
+                continue
+            if merged and merged[-1][0] == op:
+                merged[-1] = (op, merged[-1][1] + low, merged[-1][2] + high)
+            else:
+                merged.append((op, low, high))
+        return [(cv2.erode if op == 'erode' else cv2.dilate, np.ones((high - low + 1, high - low + 1), np.uint8), (-low, -low))
+                for op, low, high in merged]
+
+    def run(self, image, resolution=None):
+        if image.ndim == 2:
+            gray = image
+        else:
+            with metrics.span('preprocess.grayscale'):
+                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=_buffer('gray', image.shape[:2]))
+        if self.deskew:
+            # Estimated on a downsampled copy, then a single rotation at full resolution
+            with metrics.span('preprocess.deskew'):
+                gray, rotation, skew = deskew(gray)
+            metrics.count('deskew_rotations_total', rotation=rotation)
+        if resolution is not None:
+            with metrics.span('preprocess.resample'):
+                gray = resolution.to_ocr(gray)
+        shape = gray.shape
+
+        with metrics.span('preprocess.blur', blur_type=self.blur_type):
+            if self.blur_type == "median":
+                gray = cv2.medianBlur(gray, 5, dst=_buffer('blur', shape))
+            elif self.blur_type == "gaussian":
+                gray = cv2.GaussianBlur(gray, (5, 5), 0, dst=_buffer('blur', shape))
+
+        binary = _buffer('binary', shape)
+        with metrics.span('preprocess.threshold', thresh_type=self.thresh_type):
+            if self.thresh_type == "otsu" and resolution is not None and resolution.work_scale(gray) < 1.0:
+                # The histogram of a downscaled copy gives (almost) the same threshold
+                thresh, _ = cv2.threshold(resize(gray, resolution.work_scale(gray)), self.min_thresh, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+                cv2.threshold(gray, thresh, 255, cv2.THRESH_BINARY, dst=binary)
+            elif self.thresh_type == "otsu":
+                cv2.threshold(gray, self.min_thresh, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=binary)
+            elif self.thresh_type == "adaptive":
+                cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2, dst=binary)
+            else:  # binary
+                cv2.threshold(gray, self.min_thresh, self.max_thresh, cv2.THRESH_BINARY, dst=binary)
+
+        image = binary
+        for i, (morph, kernel, anchor) in enumerate(self.morphology):
+            with metrics.span(f'preprocess.{morph.__name__}', kernel=kernel.shape[0]):
+                image = morph(image, kernel, dst=_buffer(f'morph{i % 2}', shape), anchor=anchor)
+        return image
+
 class ImagePreprocessor:
-    def __init__(self, blur_type="median", thresh_type="otsu", min_thresh=127, max_thresh=255, noise_kernel=1, erode_kernel=2, dilate_kernel=2, noise_iter=1, erode_iter=1, dilate_iter=1):
+    def __init__(self, blur_type="median", thresh_type="otsu", min_thresh=127, max_thresh=255, noise_kernel=1, erode_kernel=2, dilate_kernel=2, noise_iter=1, erode_iter=1, dilate_iter=1, cache=None, resolution=None, deskew=False):
         self.blur_type = blur_type
         self.thresh_type = thresh_type
         self.min_thresh = min_thresh
@@ -21,12 +117,34 @@ class ImagePreprocessor:
         self.noise_iter = noise_iter
         self.erode_iter = erode_iter
         self.dilate_iter = dilate_iter
+        self.deskew = deskew  # Straighten and turn pages upright first, a cheap alternative to dewarping for flat scans
+        self.cache = cache
+        self.resolution = resolution  # ResolutionPolicy, full resolution if None
+        self._plan = None
+        self._plan_args = None
 
     def update_args(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def get_args(self):
+        return {
+            "blur_type": self.blur_type,
+            "thresh_type": self.thresh_type,
+            "min_thresh": self.min_thresh,
+            "max_thresh": self.max_thresh,
+            "noise_kernel": self.noise_kernel,
+            "erode_kernel": self.erode_kernel,
+            "dilate_kernel": self.dilate_kernel,
+            "noise_iter": self.noise_iter,
+            "erode_iter": self.erode_iter,
+            "dilate_iter": self.dilate_iter,
+            "deskew": self.deskew
+        }
+
     def grayscale(self, image):
+        if image.ndim == 2:  # Already grayscale, e.g. straight out of the dewarper
+            return image
         return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
     def binarization(self, image, blur_type, thresh_type, min_thresh, max_thresh):
@@ -63,11 +181,18 @@ class ImagePreprocessor:
         kernel = np.ones((kernel_size, kernel_size), np.uint8)
         return cv2.dilate(image, kernel, iterations=iterations)
 
-    def remove_and_add_borders(self, image):
-        # Remove borders
-        contours, _ = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    def remove_and_add_borders(self, image, work_scale=1.0):
+        # Remove borders, finding the page contour on a downscaled copy if requested
+        small = image
+        if work_scale < 1.0:
+            _, small = cv2.threshold(resize(image, work_scale), 127, 255, cv2.THRESH_BINARY)
+        contours, _ = cv2.findContours(small, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         cnt = max(contours, key=cv2.contourArea)
         x, y, w, h = cv2.boundingRect(cnt)
+        if small is not image:
+            x0, y0 = int(x / work_scale), int(y / work_scale)
+            x1, y1 = min(image.shape[1], int(np.ceil((x + w) / work_scale))), min(image.shape[0], int(np.ceil((y + h) / work_scale)))
+            x, y, w, h = x0, y0, x1 - x0, y1 - y0
         cropped = image[y:y+h, x:x+w]
         
         # Add borders dynamically based on image dimensions
@@ -81,37 +206,65 @@ class ImagePreprocessor:
         return image_with_border
 
     def preprocess_single_image(self, image):
-        gray_image = self.grayscale(image)
-        bin_image = self.binarization(gray_image, self.blur_type, self.thresh_type, self.min_thresh, self.max_thresh)
-        denoised_image = self.noise_removal(bin_image, self.noise_kernel, self.noise_iter)
-        thin_image = self.thin_font(denoised_image, self.erode_kernel, self.erode_iter)
-        thick_image = self.thick_font(thin_image, self.dilate_kernel, self.dilate_iter)
-        final_image = self.remove_and_add_borders(thick_image)
-        return final_image
-
-    def preprocess_images(self, src_folder, dest_folder):
-        with ThreadPoolExecutor() as executor:
-            futures = []
-            for filename in os.listdir(src_folder):
-                if filename.endswith(('.png', '.jpg', '.jpeg', '.tiff')):
-                    image_path = os.path.join(src_folder, filename)
-                    dest_path = os.path.join(dest_folder, filename)
-                    futures.append(executor.submit(self.process_single_image, image_path, dest_path))
-            for future in futures:
-                future.result()  # to raise any exception that occurred during processing
+        if self.cache is None:
+            return self._preprocess_single_image(image)
+        key = self.cache.key(hash_array(image), 'preprocess', self.get_params(), f"opencv {cv2.__version__}")
+        return self.cache.cached(key, lambda: self._preprocess_single_image(image))
+
+    def get_params(self):
+        # Everything the output depends on, the knobs and the resolution
+        return dict(self.get_args(), resolution=self.resolution.get_args() if self.resolution is not None else None)
+
+    @property
+    def plan(self):
+        # Recompiled whenever the parameters change, e.g. through update_args
+        args = self.get_args()
+        if self._plan is None or self._plan_args != args:
+            self._plan = PreprocessingPlan(**args)
+            self._plan_args = args
+        return self._plan
+
+    def _preprocess_single_image(self, image):
+        # Same as grayscale, binarization, noise_removal, thin_font and thick_font, then remove_and_add_borders.
+        # The border step copies the result out of the plan's reusable buffers.
+        image = self.plan.run(image, self.resolution)
+        with metrics.span('preprocess.borders'):
+            return self.remove_and_add_borders(image, self.resolution.work_scale(image) if self.resolution is not None else 1.0)
+
+    def preprocess_images(self, src_folder, dest_folder, executor="thread", workers=None, manifest=None):
+        tasks = [(page, os.path.join(dest_folder, page.filename)) for page in list_pages(src_folder)]
+        if manifest is None:
+            run_tasks(self, 'process_single_image', tasks, executor, workers)
+        else:
+            manifest.run(self, 'process_single_image', tasks, 'preprocess', self.get_params(), lambda image_path, dest_path: dest_path, executor, workers)
 
     def process_single_image(self, image_path, dest_path):
-        image = cv2.imread(image_path)
-        final_image = self.preprocess_single_image(image)
-        cv2.imwrite(dest_path, final_image)
+        page = as_page(image_path)
+        with metrics.span('preprocess.page', page=page.name):
+            image = page.read()
+            if image is None:
+                logger.warning(f"Could not decode {page.key}, skipping it.")
+                return
+            final_image = self.preprocess_single_image(image)
+            cv2.imwrite(dest_path, final_image)
 
+def load_params(path):
+    with open(path, 'r') as file:
+        params = json.load(file)
+    if any(isinstance(value, dict) for value in params.values()):
+        raise ValueError(f"{path} holds nested parameters, expected a single set of preprocessing parameters.")
+    return params
+
+@with_metrics
 def main(args):
-    preprocessor = ImagePreprocessor(args.blur_type, args.thresh_type, args.min_thresh, args.max_thresh, args.noise_kernel, args.erode_kernel, args.dilate_kernel, args.noise_iter, args.erode_iter, args.dilate_iter)
+    preprocessor = ImagePreprocessor(args.blur_type, args.thresh_type, args.min_thresh, args.max_thresh, args.noise_kernel, args.erode_kernel, args.dilate_kernel, args.noise_iter, args.erode_iter, args.dilate_iter, get_cache(args), get_resolution(args), args.deskew)
+    if args.preprocess_params is not None:
+        preprocessor.update_args(**load_params(args.preprocess_params))
 
     logger.info("Preprocessing images...")
     start_time = time.time()
-    if os.path.isdir(args.input_path):
-        preprocessor.preprocess_images(args.input_path, args.output_dir)
+    if is_page_collection(args.input_path):
+        preprocessor.preprocess_images(args.input_path, args.output_dir, args.executor, args.workers, get_manifest(args))
     elif os.path.isfile(args.input_path):
         filename = os.path.basename(args.input_path)
         dest_path = os.path.join(args.output_dir, filename)
@@ -121,8 +274,16 @@ def main(args):
     logger.info(f'Preprocessing from {args.input_path} to {args.output_dir} complete in {time.time() - start_time}.')
 
 def parser_add_arguments(parser):
-    parser.add_argument('input_path', help='Path of the image or folder to process.')
+    parser.add_argument('input_path', help='Path of the image, folder, archive (zip/tar), PDF or multi-page TIFF to process.')
     parser.add_argument('output_dir', help='Destination folder to store processed images.')
+    parser_add_options(parser)
+    parser_add_resolution_options(parser)
+    parser_add_executor_options(parser)
+    parser_add_cache_options(parser)
+    parser_add_manifest_options(parser)
+    parser_add_metrics_options(parser)
+
+def parser_add_options(parser):
     parser.add_argument('--blur_type', choices=["median", "gaussian", "none"], default="median", help='Type of blur to apply.')
     parser.add_argument('--thresh_type', choices=["otsu", "adaptive", "binary"], default="otsu", help='Type of thresholding to apply.')
     parser.add_argument('--min_thresh', type=int, default=127, help='Minimum threshold value for binary thresholding.')
@@ -133,6 +294,8 @@ def parser_add_arguments(parser):
     parser.add_argument('--noise_iter', type=int, default=1, help='Iterations for noise removal.')
     parser.add_argument('--erode_iter', type=int, default=1, help='Iterations for erosion.')
     parser.add_argument('--dilate_iter', type=int, default=1, help='Iterations for dilation.')
+    parser.add_argument('--deskew', action='store_true', help='Straighten skewed pages and turn sideways or upside-down ones upright. Much cheaper than dewarping, enough for flat scans.')
+    parser.add_argument('--preprocess_params', default=None, help='JSON file with preprocessing parameters, e.g. written by autotune, overriding the options above.')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Preprocess images in a folder.')
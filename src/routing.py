@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import json
+import time
+import threading
+import cv2
+import numpy as np
+from .orientation import text_ink
+from .utils.logger_config import setup_logger
+from .utils.metrics import metrics
+
+logger = setup_logger()
+
+def analyze_page(image, work_size=800, noise_crop=256):
+    """
+    Measures what decides the steps a page needs, on a thumbnail and a small full resolution crop:
+    curvature, the median bow of the text lines as a fraction of the page height (0 for a flat scan);
+    contrast, the gap between the mean ink and the mean paper levels, from 0 to 1;
+    noise, the standard deviation of the paper around its median, in gray levels;
+    text_height, the median thickness of the text lines (about the x-height) in full resolution pixels.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    ink, scale = text_ink(gray, work_size)
+    ys, xs = np.nonzero(ink)
+    if len(ys) < 100:  # Blank page, nothing to straighten or clean
+        return {"curvature": 0.0, "contrast": 1.0, "noise": 0.0, "text_height": 0.0}
+    y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+
+    # Words smeared into lines, the long ones are fitted with a parabola
+    lines = cv2.morphologyEx(ink[y0:y1, x0:x1], cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, (x1 - x0) // 30), 1)))
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(lines, connectivity=8)
+    bows, heights = [], []
+    for i in range(1, n):
+        x, y, w, h, _ = stats[i]
+        if w < 0.3 * (x1 - x0) or h > 0.1 * (y1 - y0):
+            continue
+        line_ys, line_xs = np.nonzero(labels[y:y + h, x:x + w] == i)
+        # Centre line, then the bow of its parabola over the width of the text, so that short lines count as much
+        counts = np.bincount(line_xs, minlength=w)
+        centre = np.bincount(line_xs, weights=line_ys, minlength=w)[counts > 0] / counts[counts > 0]
+        columns = np.flatnonzero(counts) - w / 2
+        bows.append(abs(np.polyfit(columns, centre, 2)[0]) * ((x1 - x0) / 2) ** 2 / ink.shape[0])
+        heights.append(len(line_ys) / w)  # Mean thickness, the box of a bowed line is taller than the line
+
+    # Contrast on the text area of the thumbnail, where the dark surroundings of the page are left out
+    area = cv2.resize(gray, (ink.shape[1], ink.shape[0]), interpolation=cv2.INTER_AREA)[y0:y1, x0:x1] if scale < 1.0 else gray[y0:y1, x0:x1]
+    thresh, _ = cv2.threshold(area, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    dark, light = area[area <= thresh], area[area > thresh]
+    contrast = (float(light.mean()) - float(dark.mean())) / 255 if len(dark) and len(light) else 0.0
+
+    # Noise at full resolution, downsampling averages it away. Only paper away from the ink is looked at.
+    cy, cx = int((y0 + y1) / 2 / scale), int((x0 + x1) / 2 / scale)
+    crop = gray[max(0, cy - noise_crop // 2):cy + noise_crop // 2, max(0, cx - noise_crop // 2):cx + noise_crop // 2]
+    residual = crop.astype(np.float32) - cv2.medianBlur(crop, 5).astype(np.float32)
+    paper = cv2.erode((crop > thresh).astype(np.uint8), np.ones((5, 5), np.uint8)) > 0
+    noise = float(residual[paper].std()) if paper.any() else 0.0
+
+    return {
+        "curvature": float(np.median(bows)) if bows else 0.0,
+        "contrast": round(contrast, 3),
+        "noise": round(noise, 2),
+        "text_height": round(float(np.median(heights)) / scale, 1) if heights else 0.0,
+    }
+
+class PageRouter:
+    """
+    Decides per page whether it needs dewarping and how much preprocessing, so that flat clean scans skip the
+    expensive steps. Pages whose lines bow more than max_curvature are dewarped. Clean pages (contrast of at least
+    clean_contrast, noise of at most clean_noise) go straight to OCR, noisy or faded ones (noise above max_noise,
+    contrast below min_contrast) get the full preprocessing, the rest is only binarized. Small text (thinner than
+    min_text_height pixels) is never eroded or dilated, which would merge or break its strokes.
+    Every decision is logged with its features and timing, and appended to route_log (JSON lines) if given.
+    """
+    def __init__(self, max_curvature=0.0015, clean_contrast=0.5, clean_noise=4.0, min_contrast=0.25, max_noise=10.0,
+                 min_text_height=12, route_log=None):
+        self.max_curvature = max_curvature
+        self.clean_contrast = clean_contrast
+        self.clean_noise = clean_noise
+        self.min_contrast = min_contrast
+        self.max_noise = max_noise
+        self.min_text_height = min_text_height
+        self.route_log = route_log
+        self._lock = threading.Lock()
+
+    def get_args(self):
+        return {"max_curvature": self.max_curvature, "clean_contrast": self.clean_contrast, "clean_noise": self.clean_noise,
+                "min_contrast": self.min_contrast, "max_noise": self.max_noise, "min_text_height": self.min_text_height}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']  # Process-pool workers get their own
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def decide(self, features):
+        dewarp = features["curvature"] > self.max_curvature
+        if features["contrast"] >= self.clean_contrast and features["noise"] <= self.clean_noise:
+            preprocess = "none"
+        elif features["contrast"] < self.min_contrast or features["noise"] > self.max_noise:
+            preprocess = "heavy"
+        else:
+            preprocess = "light"
+        if preprocess == "heavy" and 0 < features["text_height"] < self.min_text_height:
+            preprocess = "light"
+        return {"dewarp": dewarp, "preprocess": preprocess}
+
+    def route(self, image, name=None):
+        start_time = time.perf_counter()
+        with metrics.span('route'):
+            features = analyze_page(image)
+            route = self.decide(features)
+        seconds = time.perf_counter() - start_time
+        metrics.count('routes_total', dewarp=route["dewarp"], preprocess=route["preprocess"])
+        logger.info(f"Route of {name}: dewarp={route['dewarp']}, preprocess={route['preprocess']} "
+                    f"({', '.join(f'{key}={value}' for key, value in features.items())}) in {1000 * seconds:.1f}ms.")
+        if self.route_log is not None:
+            record = dict(page=name, **route, **features, seconds=round(seconds, 4))
+            with self._lock, open(self.route_log, 'a') as file:
+                file.write(json.dumps(record) + "\n")
+        return route
+
+def get_router(args):
+    if not getattr(args, 'route', False):
+        return None
+    return PageRouter(args.max_curvature, args.clean_contrast, args.clean_noise, args.min_contrast, args.max_noise,
+                      args.min_text_height, args.route_log)
+
+def parser_add_routing_options(parser):
+    parser.add_argument('--route', action='store_true', help='Decide per page, from a quick analysis of a thumbnail, whether to dewarp it and how much to preprocess it, instead of running every enabled step on every page.')
+    parser.add_argument('--max_curvature', type=float, default=0.0015, help='Bow of the text lines, as a fraction of the page height, above which a page is dewarped.')
+    parser.add_argument('--clean_contrast', type=float, default=0.5, help='Contrast (0 to 1) from which a page with little noise goes straight to OCR.')
+    parser.add_argument('--clean_noise', type=float, default=4.0, help='Noise (gray levels) up to which a page with good contrast goes straight to OCR.')
+    parser.add_argument('--min_contrast', type=float, default=0.25, help='Contrast below which a page gets the full preprocessing.')
+    parser.add_argument('--max_noise', type=float, default=10.0, help='Noise above which a page gets the full preprocessing. Pages in between are only binarized.')
+    parser.add_argument('--min_text_height', type=float, default=12, help='Text height (about the x-height) in pixels below which pages are never eroded or dilated.')
+    parser.add_argument('--route_log', default=None, help='File to append the route of every page to, with the measures it was decided on, as JSON lines.')
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Local HTTP service keeping the OCR engines (and optionally the LLM) warm between requests.
+
+    POST /ocr?lang=eng&roi=1        image, archive, PDF or multi-page TIFF as the body
+    POST /clean?stream=1            OCR text as the body, requires --prompt_template
+    GET  /health, /queue, /metrics
+"""
+import os
+import json
+import time
+import queue
+import argparse
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+import numpy as np
+from .dewarping import ImageDewarper, parser_add_options as parser_add_options_dewarping
+from .preprocessing import ImagePreprocessor, load_params, parser_add_options as parser_add_options_preprocessing
+from .ocr import TextExtractor, installed_languages
+from .language import DEFAULT_CANDIDATES
+from .pipeline import Pipeline
+from .objects import ProcessedImage
+from .utils.cache import get_cache, parser_add_cache_options
+from .utils.resolution import get_resolution, parser_add_resolution_options
+from .utils.sources import list_pages
+from .utils.imageio import decode_image
+from .utils.metrics import metrics, with_metrics, parser_add_metrics_options
+from .utils.logger_config import setup_logger
+
+logger = setup_logger()
+
+# Magic bytes of the multi-page uploads, anything else is decoded as a single image
+UPLOAD_TYPES = [(b'%PDF', '.pdf'), (b'PK\x03\x04', '.zip'), (b'\x1f\x8b', '.tar.gz'), (b'II*\x00', '.tif'), (b'MM\x00*', '.tif')]
+
+class MicroBatcher:
+    """
+    Collects concurrent requests into batches of at most max_batch items, waiting up to max_wait seconds for a batch
+    to fill, and runs process(items) on a background thread. process returns one result, exception or Future per
+    item, and every request completes on its own, as soon as its item does. At most max_running items run at once,
+    and max_queue wait, further submissions raise queue.Full. Cancelled requests are dropped before they run.
+    """
+    def __init__(self, process, max_batch=8, max_wait=0.01, max_queue=256, name="batcher", max_running=None):
+        self.process = process
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self.running = 0
+        self.batches = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._slots = threading.Semaphore(max_running or max_batch)
+        self._lock = threading.Lock()
+        threading.Thread(target=self._loop, daemon=True, name=name).start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put_nowait((item, future))
+        return future
+
+    def depth(self):
+        return {"queued": self._queue.qsize(), "running": self.running, "batches": self.batches}
+
+    def _next_batch(self):
+        # Every item takes a running slot, so the batch only grows with the slots freed by earlier items
+        self._slots.acquire()
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._slots.acquire(blocking=False):
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                self._slots.release()
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = []
+            for item, future in self._next_batch():
+                if future.set_running_or_notify_cancel():
+                    batch.append((item, future))
+                else:
+                    self._slots.release()
+            if not batch:
+                continue
+            with self._lock:
+                self.running += len(batch)
+            metrics.count('batches_total', batcher=self.name)
+            metrics.count('batched_items_total', len(batch), batcher=self.name)
+            try:
+                results = self.process([item for item, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Future):
+                    result.add_done_callback(lambda done, future=future: self._finish(future, done.exception() or done.result()))
+                else:
+                    self._finish(future, result)
+            self.batches += 1
+
+    def _finish(self, future, result):
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+        with self._lock:
+            self.running -= 1
+        self._slots.release()
+
+class OCRService:
+    """
+    Warm pipelines, one per parameter set, shared by every request. The max_pipelines most recently used are kept,
+    so that clients varying the parameters cannot grow the server without bound. Pages of concurrent requests are
+    batched and spread over a persistent pool of workers, each keeping its Tesseract engines loaded.
+    """
+    def __init__(self, dewarper, text_extractor, preprocessor_defaults=None, workers=None, max_batch=8, max_wait=0.01,
+                 max_queue=256, cleaner=None, dewarp=True, preprocess=True, resolution=None, cache=None, max_pipelines=16, max_in_flight=4):
+        self.dewarper = dewarper
+        self.text_extractor = text_extractor
+        self.preprocessor_defaults = preprocessor_defaults or {}
+        self.resolution = resolution
+        self.cache = cache
+        self.dewarp = dewarp
+        self.preprocess = preprocess
+        self.cleaner = cleaner
+        self.started = time.time()
+        self.max_pipelines = max_pipelines
+        self.max_in_flight = max_in_flight  # Pages of a multi-page request decoded and queued at once
+        self._pipelines = OrderedDict()
+        self._lock = threading.Lock()
+        self._workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr")
+        self.ocr_batcher = MicroBatcher(self._run_pages, max_batch, max_wait, max_queue, name="ocr", max_running=workers)
+        self.clean_batcher = MicroBatcher(self._clean_texts, max_batch, max_wait, max_queue, name="clean") if cleaner is not None else None
+
+    def parse_params(self, query):
+        """Request parameters, typed after the defaults. Unknown parameters and languages raise a ValueError."""
+        defaults = dict(ImagePreprocessor(**self.preprocessor_defaults).get_args(), lang=self.text_extractor.lang,
+                        lang_candidates=self.text_extractor.lang_candidates,
+                        nan_thresh=self.text_extractor.nan_thresh, roi=self.text_extractor.roi, dewarp=self.dewarp,
+                        preprocess=self.preprocess, words=False)
+        params = dict(defaults)
+        for key, value in query.items():
+            if key not in defaults:
+                raise ValueError(f"Unknown parameter {key!r}, expected one of {', '.join(sorted(defaults))}.")
+            default = defaults[key]
+            if isinstance(default, bool):
+                params[key] = value.lower() in ('1', 'true', 'yes')
+            elif isinstance(default, (int, float)):
+                params[key] = type(default)(value)
+            else:
+                params[key] = value
+        for key in ('lang', 'lang_candidates'):
+            params[key] = params[key].replace(' ', '+')  # An unescaped + in the query string reads as a space
+        if params['lang'] != 'auto':
+            # Tesseract fails on every page of an unknown language, better to tell the client right away
+            installed = installed_languages(self.text_extractor.engine)
+            missing = [lang for lang in params['lang'].split('+') if lang not in installed]
+            if missing:
+                raise ValueError(f"Language {'+'.join(missing)} is not installed, expected auto or some of {'+'.join(sorted(installed - {'osd'}))}.")
+        return params
+
+    def pipeline(self, params):
+        key = json.dumps({k: v for k, v in params.items() if k != 'words'}, sort_keys=True)
+        with self._lock:
+            if key not in self._pipelines:
+                preprocessor = None
+                if params['preprocess']:
+                    knobs = {k: params[k] for k in ImagePreprocessor().get_args()}
+                    preprocessor = ImagePreprocessor(**knobs, cache=self.cache, resolution=self.resolution)
+                text_extractor = TextExtractor(params['lang'], params['nan_thresh'], self.text_extractor.engine, self.cache,
+                                               roi=params['roi'], resolution=self.resolution, lang_candidates=params['lang_candidates'],
+                                               max_engines=self.text_extractor.max_engines)
+                self._pipelines[key] = Pipeline(self.dewarper if params['dewarp'] else None, preprocessor, text_extractor)
+                if len(self._pipelines) > self.max_pipelines:
+                    self._pipelines.popitem(last=False)  # Pages still running on it keep it alive until they are done
+            self._pipelines.move_to_end(key)
+            return self._pipelines[key]
+
+    def _run_pages(self, items):
+        # Pages of the batch run side by side on the warm workers, each request is answered when its page is done
+        return [self._workers.submit(self._run_page, *item) for item in items]
+
+    def _run_page(self, name, image, params):
+        start_time = time.perf_counter()
+        with metrics.span('server.page', page=name):
+            processed_image = self.pipeline(params).run(ProcessedImage(image, name=name))
+        result = {"name": name, "text": processed_image.extracted_text, "seconds": round(time.perf_counter() - start_time, 3)}
+        if params['words']:
+            result["words"] = words_to_json(processed_image.words)
+        return result
+
+    def _clean_texts(self, texts):
+        with metrics.span('server.clean', batch_size=len(texts)):
+            return self.cleaner.clean_texts(texts, batch_size=len(texts))
+
+    def submit_page(self, name, image, params):
+        return self.ocr_batcher.submit((name, image, params))
+
+    def health(self):
+        return {"status": "ok", "uptime": round(time.time() - self.started, 1), "engine": self.text_extractor.engine,
+                "llm": self.cleaner.model_version if self.cleaner is not None else None}
+
+    def queue_depth(self):
+        return {"ocr": self.ocr_batcher.depth(), "clean": self.clean_batcher.depth() if self.clean_batcher is not None else None}
+
+def failed_future(error):
+    future = Future()
+    future.set_exception(error)
+    return future
+
+def words_to_json(data):
+    # Columns of parse_tsv as lists, missing words as null
+    return {name: column.tolist() for name, column in data.items()}
+
+def guess_extension(body):
+    for magic, extension in UPLOAD_TYPES:
+        if body.startswith(magic):
+            return extension
+    return None
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive and chunked responses
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            self._send_json(self.service.health())
+        elif path == '/queue':
+            self._send_json(self.service.queue_depth())
+        elif path == '/metrics':
+            self._send(200, metrics.prometheus().encode(), 'text/plain; version=0.0.4')
+        else:
+            self._send_json({"error": f"Unknown path {path}."}, 404)
+
+    def do_POST(self):
+        self._streaming = False
+        url = urlparse(self.path)
+        query = dict(parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if url.path == '/ocr':
+                self._ocr(body, query)
+            elif url.path == '/clean':
+                self._clean(body, query)
+            else:
+                self._send_json({"error": f"Unknown path {url.path}."}, 404)
+        except queue.Full:
+            self._send_json({"error": "Too many queued requests, retry later."}, 503)
+        except ValueError as e:
+            self._send_json({"error": str(e)}, 400)
+        except Exception as e:
+            logger.exception(f"{url.path} failed with {e!r}")
+            if self._streaming:
+                self.close_connection = True  # The status is already sent, the client sees the stream cut short
+            else:
+                self._send_json({"error": repr(e)}, 500)
+
+    def _ocr(self, body, query):
+        name = query.pop('name', 'page')
+        filename = query.pop('filename', None)
+        params = self.service.parse_params(query)
+        extension = guess_extension(body)
+        if filename is None and extension is None:
+            image = decode_image(body)
+            if image is None:
+                raise ValueError("The body is not an image, archive, PDF or TIFF.")
+            self._send_json(self.service.submit_page(name, image, params).result())
+            return
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, os.path.basename(filename) if filename else name + extension)
+            with open(path, 'wb') as file:
+                file.write(body)
+            pages = list_pages(path)
+            if not pages:
+                raise ValueError(f"No pages found in {filename or 'the body'}.")
+            if len(pages) == 1:
+                image = pages[0].read()
+                if image is None:
+                    raise ValueError(f"Could not decode {pages[0].name}.")
+                self._send_json(self.service.submit_page(pages[0].name, image, params).result())
+                return
+
+            # Several pages, streamed back as JSON lines in page order as they are done. A page is only decoded
+            # once one of the max_in_flight before it is written, so a long PDF is never all in memory.
+            in_flight = deque()
+            try:
+                in_flight.append((pages[0].name, self._submit_page(pages[0].name, pages[0].read(), params)))  # If the queue is full, nothing runs yet
+                self._start_stream('application/x-ndjson')
+                for page in pages[1:]:
+                    if len(in_flight) >= self.service.max_in_flight:
+                        self._write_result(*in_flight.popleft())
+                    image = page.read()
+                    while True:
+                        try:
+                            in_flight.append((page.name, self._submit_page(page.name, image, params)))
+                            break
+                        except queue.Full:
+                            # Wait for the pages of this request to make room, unless none is left
+                            if not in_flight:
+                                in_flight.append((page.name, failed_future(RuntimeError("Too many queued requests."))))
+                                break
+                            self._write_result(*in_flight.popleft())
+                while in_flight:
+                    self._write_result(*in_flight.popleft())
+            finally:
+                for _, future in in_flight:
+                    future.cancel()  # The request failed or the client left, pages still queued are dropped
+            self._end_stream()
+
+    def _submit_page(self, name, image, params):
+        if image is None:
+            return failed_future(ValueError(f"Could not decode {name}."))
+        return self.service.submit_page(name, image, params)
+
+    def _write_result(self, page_name, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {"name": page_name, "error": repr(e)}
+        self._write_chunk((json.dumps(result) + "\n").encode())
+
+    def _clean(self, body, query):
+        if self.service.cleaner is None:
+            self._send_json({"error": "Cleanup is not enabled, start the server with --prompt_template."}, 404)
+            return
+        text = body.decode('utf-8')
+        if query.get('stream', '0').lower() in ('1', 'true', 'yes'):
+            # Streamed requests bypass batching, each chunk is sent once later chunks can no longer change it
+            self._start_stream('text/plain; charset=utf-8')
+            for piece in self.service.cleaner.clean_text_stream(text):
+                self._write_chunk(piece.encode('utf-8'))
+            self._end_stream()
+            return
+        self._send_json({"text": self.service.clean_batcher.submit(text).result()})
+
+    def _send(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_json(self, data, status=200):
+        self._send(status, json.dumps(data).encode(), 'application/json')
+
+    def _start_stream(self, content_type):
+        self._streaming = True
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        if data:
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+        self._streaming = False
+
+def get_cleaner(args, cache=None):
+    if args.prompt_template is None:
+        return None
+    from .postprocessing import TextCleanerLLM
+    logger.info("Loading LLM...")
+    cleaner = TextCleanerLLM(args.model, device_map=args.device_map, cache=cache)
+    cleaner.set_prompt_template(args.prompt_template)
+    return cleaner
+
+@with_metrics
+def main(args):
+    # Metrics are always recorded, to be served on /metrics
+    metrics.configure(args.metrics_file, args.trace_file, enabled=True)
+    cache = get_cache(args)
+    resolution = get_resolution(args)
+    dewarper = ImageDewarper(additional_args=args.additional_args, backend=args.backend, cache=cache, resolution=resolution)
+    text_extractor = TextExtractor(args.lang, args.nan_thresh, args.engine, cache, roi=args.roi, resolution=resolution,
+                                   lang_candidates=args.lang_candidates, max_engines=args.max_engines)
+    preprocessor_defaults = {key: getattr(args, key) for key in ImagePreprocessor().get_args()}
+    if args.preprocess_params is not None:
+        preprocessor_defaults.update(load_params(args.preprocess_params))
+    service = OCRService(dewarper, text_extractor, preprocessor_defaults, workers=args.workers, max_batch=args.max_batch, max_wait=args.max_wait / 1000,
+                         max_queue=args.max_queue, cleaner=get_cleaner(args, cache), dewarp=not args.skip_dewarp,
+                         preprocess=not args.skip_preprocess, resolution=resolution, cache=cache, max_pipelines=args.max_pipelines,
+                         max_in_flight=args.max_in_flight)
+
+    # Load the engines before the first request rather than during it
+    warmup = np.full((64, 256, 3), 255, np.uint8)
+    service.submit_page('warmup', warmup, service.parse_params({'dewarp': '0'})).result()
+
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    logger.info(f"Serving on http://{args.host}:{args.port}")
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def parser_add_arguments(parser):
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Only local connections by default.')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+    parser.add_argument('--skip_dewarp', action='store_true', help='Do not dewarp by default, requests can still ask for it with dewarp=1.')
+    parser.add_argument('--skip_preprocess', action='store_true', help='Do not preprocess by default, requests can still ask for it with preprocess=1.')
+    parser.add_argument('--lang', default='eng', help='Default language used by Tesseract, auto to detect it per page.')
+    parser.add_argument('--lang_candidates', default=DEFAULT_CANDIDATES, help='Default languages lang=auto picks from, joined with +.')
+    parser.add_argument('--max_engines', type=int, default=4, help='Warm tesserocr engines, one per language combination, kept per thread.')
+    parser.add_argument('--nan_thresh', type=float, default=0.5, help='Default NaN threshold for cleanup.')
+    parser.add_argument('--engine', choices=['pytesseract', 'tesserocr'], default='tesserocr', help='OCR engine. tesserocr keeps the engines loaded between requests.')
+    parser.add_argument('--roi', action='store_true', help='Only OCR the text regions by default.')
+    parser.add_argument('--workers', type=int, default=None, help='Threads running pages. Defaults to the executor default.')
+    parser.add_argument('--max_batch', type=int, default=8, help='Pages (or texts to clean) of concurrent requests run together at most.')
+    parser.add_argument('--max_wait', type=float, default=10, help='Milliseconds to wait for a batch to fill.')
+    parser.add_argument('--max_queue', type=int, default=256, help='Pages waiting at most, further requests get a 503.')
+    parser.add_argument('--max_in_flight', type=int, default=4, help='Pages of a multi-page request (PDF, archive, TIFF) decoded and queued at once, the next ones wait for the first to be streamed back.')
+    parser.add_argument('--max_pipelines', type=int, default=16, help='Pipelines of distinct request parameters kept warm, the least recently used are dropped.')
+    parser.add_argument('--prompt_template', default=None, help='Prompt template file, enables /clean with a warm LLM.')
+    parser.add_argument('--model', default="TheBloke/Mistral-7B-Instruct-v0.1-GPTQ", help='Name or path of the cleanup model.')
+    parser.add_argument('--device_map', default="auto", help='Where to load the cleanup model, e.g. "auto" or "cpu".')
+    parser_add_options_dewarping(parser)
+    parser_add_options_preprocessing(parser)
+    parser_add_resolution_options(parser)
+    parser_add_cache_options(parser)
+    parser_add_metrics_options(parser)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve OCR over HTTP.')
+    parser_add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,136 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from .metrics import metrics
+
+def hash_bytes(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+def hash_file(path, chunk_size=1024 * 1024):
+    file_hash = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def hash_array(array):
+    # Shape and dtype are part of the content, the same bytes can be different images
+    # Hashed in place, a full-page copy of a large scan costs as much memory as the page
+    array_hash = hashlib.blake2b(f"{array.shape}{array.dtype}".encode(), digest_size=20)
+    array_hash.update(np.ascontiguousarray(array))
+    return array_hash.hexdigest()
+
+def hash_text(text):
+    return hash_bytes(text.encode('utf-8'))
+
+class ResultCache:
+    """
+    On-disk cache of stage results, keyed by (input content hash, stage, stage parameters, tool version).
+    Arrays are stored as .npy and strings as .txt. Least recently used entries are evicted once the cache
+    grows over max_size bytes. Writes are atomic, so the folder can be shared between processes.
+    """
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        return {'cache_dir': self.cache_dir, 'max_size': self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def key(self, content_hash, stage, params, version):
+        payload = json.dumps([content_hash, stage, params, version], sort_keys=True, default=str)
+        return f"{stage}-{hash_bytes(payload.encode())}"
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key[len(key) - 2:], key + suffix)
+
+    def get(self, key):
+        for suffix in ('.npy', '.txt'):
+            path = self._path(key, suffix)
+            try:
+                if suffix == '.npy':
+                    value = np.load(path)
+                else:
+                    with open(path, 'r', encoding='utf-8') as file:
+                        value = file.read()
+            except (FileNotFoundError, ValueError, EOFError):
+                continue
+            os.utime(path)  # Mark as recently used
+            return value
+        return None
+
+    def put(self, key, value):
+        suffix = '.npy' if isinstance(value, np.ndarray) else '.txt'
+        path = self._path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            if suffix == '.npy':
+                np.save(file, value)
+            else:
+                file.write(value.encode('utf-8'))
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        self._track(size)
+
+    def cached(self, key, compute):
+        value = self.get(key)
+        metrics.count('cache_requests_total', stage=key.split('-')[0], result='miss' if value is None else 'hit')
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(('.npy', '.txt')):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:  # Evicted by another process
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def _track(self, size):
+        if self.max_size is None:
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry_size for _, entry_size, _ in self._entries())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache is back to 90% of its size limit
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+def get_cache(args):
+    if getattr(args, 'cache_dir', None) is None:
+        return None
+    max_size = int(args.cache_size * 1024 * 1024) if args.cache_size is not None else None
+    return ResultCache(args.cache_dir, max_size)
+
+def parser_add_cache_options(parser):
+    parser.add_argument('--cache_dir', default=None, help='Folder to cache results in, keyed by input content and parameters. Disabled by default.')
+    parser.add_argument('--cache_size', type=float, default=None, help='Maximum cache size in MB, least recently used results are evicted. Unbounded by default.')
@@ -0,0 +1,78 @@
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from .metrics import metrics
+
+EXECUTOR_TYPES = ["thread", "process", "serial"]
+
+class SerialExecutor(Executor):
+    """Runs every task in the calling thread. Handy for debugging and profiling."""
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+# Object each process-pool worker calls into, set once by the pool initializer
+_worker = None
+
+def _init_worker(worker, metrics_config):
+    global _worker
+    _worker = worker
+    metrics.configure(**metrics_config, exporting=False)
+
+def _call_worker(method, *args):
+    # What the task recorded travels back with its result (or its error), to be merged and written by the main process
+    try:
+        result = getattr(_worker, method)(*args)
+    except Exception as e:
+        e.recorded = metrics.collect()
+        raise
+    return result, metrics.collect()
+
+def _result(future, executor):
+    if executor != "process":
+        return future.result()
+    result, recorded = future.result()
+    metrics.merge(recorded)
+    return result
+
+def run_tasks(worker, method, tasks, executor="thread", workers=None, on_done=None):
+    """
+    Calls worker.<method>(*task) for every task and returns the results in order.
+    With the process executor, worker is pickled once per process rather than once per task,
+    so tasks should be light (e.g. paths) and the images are read within the worker.
+    If given, on_done(task, error) is called from the calling thread as each task finishes,
+    and errors are passed to it instead of being raised.
+    """
+    if executor == "process":
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(worker, metrics.get_config()))
+        fn = partial(_call_worker, method)
+    elif executor == "serial":
+        pool = SerialExecutor()
+        fn = getattr(worker, method)
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        fn = getattr(worker, method)
+
+    with pool:
+        futures = [pool.submit(fn, *task) for task in tasks]
+        if on_done is None:
+            return [_result(future, executor) for future in futures]  # to raise any exception that occurred during processing
+
+        task_index = {future: i for i, future in enumerate(futures)}
+        results = [None] * len(tasks)
+        for future in as_completed(futures):
+            i = task_index[future]
+            error = future.exception()
+            if error is None:
+                results[i] = _result(future, executor)
+            else:
+                metrics.merge(getattr(error, 'recorded', None))
+            on_done(tasks[i], error)
+        return results
+
+def parser_add_executor_options(parser, default="thread"):
+    parser.add_argument('--executor', choices=EXECUTOR_TYPES, default=default, help='How to run images in parallel. Processes avoid the GIL for CPU-bound steps.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of parallel workers. Defaults to the executor default.')
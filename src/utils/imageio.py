@@ -0,0 +1,107 @@
+import os
+import mmap
+import struct
+import hashlib
+import cv2
+import numpy as np
+
+# Grayscale sources stay single channel (a third of the memory of BGR), colour ones are BGR. 16-bit images are
+# brought down to 8 bits and EXIF orientation is applied, as with IMREAD_COLOR.
+DECODE_FLAGS = cv2.IMREAD_ANYCOLOR
+
+# TIFF tags needed to map uncompressed strips, and the byte size of the field types they use
+_TIFF_TAGS = {256: 'width', 257: 'height', 258: 'bits', 259: 'compression', 262: 'photometric', 273: 'offsets',
+              277: 'samples', 279: 'byte_counts', 284: 'planar', 322: 'tile_width'}
+_TIFF_TYPES = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4)}
+
+def map_file(path):
+    """
+    Maps the file read-only, or returns None if it is empty. Its pages are only read when touched, and being backed
+    by the file, they can be dropped again under memory pressure instead of being swapped out.
+    """
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def tiff_view(buffer, index=0):
+    """
+    Returns the frame of an uncompressed 8-bit TIFF as a read-only array over the buffer (e.g. a mapped file),
+    without decoding or copying it, or None if the frame is compressed, tiled, planar or its strips are not contiguous.
+    Grayscale frames are returned as they are, RGB ones as an RGB view.
+    """
+    header = bytes(buffer[:8])
+    if header[:4] not in (b'II*\x00', b'MM\x00*'):
+        return None
+    order = '<' if header[:2] == b'II' else '>'
+    offset = struct.unpack(order + 'I', header[4:8])[0]
+    for _ in range(index):
+        if offset == 0 or offset + 2 > len(buffer):
+            return None
+        count = struct.unpack(order + 'H', buffer[offset:offset + 2])[0]
+        offset = struct.unpack(order + 'I', buffer[offset + 2 + 12 * count:offset + 6 + 12 * count])[0]
+    if offset == 0 or offset + 2 > len(buffer):
+        return None
+
+    tags = {}
+    count = struct.unpack(order + 'H', buffer[offset:offset + 2])[0]
+    for i in range(count):
+        entry = offset + 2 + 12 * i
+        tag, kind, n = struct.unpack(order + 'HHI', buffer[entry:entry + 8])
+        if tag not in _TIFF_TAGS or kind not in _TIFF_TYPES:
+            continue
+        code, size = _TIFF_TYPES[kind]
+        start = entry + 8 if n * size <= 4 else struct.unpack(order + 'I', buffer[entry + 8:entry + 12])[0]
+        tags[_TIFF_TAGS[tag]] = struct.unpack(f"{order}{n}{code}", buffer[start:start + n * size])
+
+    samples = tags.get('samples', (1,))[0]
+    photometric = tags.get('photometric', (None,))[0]
+    if (tags.get('compression', (1,))[0] != 1 or 'tile_width' in tags or any(bits != 8 for bits in tags.get('bits', (1,)))
+            or (samples, photometric) not in ((1, 1), (3, 2)) or (samples > 1 and tags.get('planar', (1,))[0] != 1)):
+        return None
+    width, height = tags['width'][0], tags['height'][0]
+    offsets, byte_counts = tags['offsets'], tags['byte_counts']
+    if any(offsets[i] + byte_counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)):
+        return None
+    size = width * height * samples
+    if sum(byte_counts) < size or offsets[0] + size > len(buffer):
+        return None
+    image = np.frombuffer(buffer, np.uint8, count=size, offset=offsets[0])
+    return image.reshape((height, width) if samples == 1 else (height, width, samples))
+
+def decode_image(buffer):
+    """Decodes an encoded image held in any buffer (bytes, memoryview, mapped file) without copying the buffer first."""
+    return cv2.imdecode(np.frombuffer(buffer, np.uint8), DECODE_FLAGS)
+
+def _from_view(view):
+    # Grayscale views are handed over as they are, RGB ones need their channels swapped, into a single new array
+    return view if view.ndim == 2 else cv2.cvtColor(view, cv2.COLOR_RGB2BGR)
+
+def read_image(path, index=None):
+    """
+    Reads an image file, or a frame of a multi-page TIFF, mapping it rather than reading it into memory.
+    Uncompressed TIFFs are not even decoded, the array is a view of the mapped file.
+    """
+    mapped = map_file(path)
+    if mapped is None:
+        return None
+    view = tiff_view(mapped, index or 0)
+    if view is not None:
+        return _from_view(view)
+    if index is None:
+        return decode_image(mapped)
+    _, frames = cv2.imreadmulti(path, start=index, count=1, flags=DECODE_FLAGS)
+    return frames[0] if frames else None
+
+def read_image_hashed(path):
+    """
+    Returns the image and the content hash of the file (as cache.hash_file), reading the file only once: it is
+    hashed from the mapping, whose pages then stay in the page cache for the decoding.
+    """
+    file_hash = hashlib.blake2b(digest_size=20)
+    mapped = map_file(path)
+    if mapped is None:
+        return None, file_hash.hexdigest()
+    file_hash.update(mapped)
+    view = tiff_view(mapped)
+    return (_from_view(view) if view is not None else decode_image(mapped)), file_hash.hexdigest()
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from .cache import hash_file
+from .executors import run_tasks
+from .sources import Page, as_page, is_page_collection
+from .logger_config import setup_logger
+
+logger = setup_logger()
+
+def hash_params(params):
+    return hashlib.blake2b(json.dumps(params, sort_keys=True, default=str).encode(), digest_size=20).hexdigest()
+
+class Manifest:
+    """
+    SQLite record of a batch run: input hash, parameters, output path and status of every item.
+    Items that completed with the same input content and parameters, and whose output still exists, are skipped on re-runs.
+    Inputs are image paths or pages, the pages of an archive or PDF share its size and mtime.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                stage TEXT, input_path TEXT, input_size INTEGER, input_mtime REAL, input_hash TEXT,
+                params_hash TEXT, output_path TEXT, status TEXT, error TEXT, updated REAL,
+                PRIMARY KEY (stage, input_path)
+            )""")
+        self.conn.commit()
+
+    def _input_hash(self, stage, input_path):
+        # Only rehash the input if it was touched since it was last recorded
+        page = as_page(input_path)
+        stat = os.stat(page.path)
+        row = self.conn.execute("SELECT input_size, input_mtime, input_hash FROM items WHERE stage = ? AND input_path = ?",
+                                (stage, page.key)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return row[2], stat
+        return page.content_hash(), stat
+
+    def is_done(self, stage, input_path, params):
+        row = self.conn.execute("SELECT input_hash, params_hash, output_path, status FROM items WHERE stage = ? AND input_path = ?",
+                                (stage, as_page(input_path).key)).fetchone()
+        if row is None or row[3] != 'done' or row[1] != hash_params(params) or not os.path.exists(row[2]):
+            return False
+        return self._input_hash(stage, input_path)[0] == row[0]
+
+    def record(self, stage, input_path, params, output_path, error=None):
+        input_hash, stat = self._input_hash(stage, input_path)
+        self.conn.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (stage, as_page(input_path).key, stat.st_size, stat.st_mtime, input_hash, hash_params(params),
+                           os.path.abspath(output_path), 'failed' if error else 'done', repr(error) if error else None, time.time()))
+        self.conn.commit()
+
+    def pending(self, stage, params, tasks):
+        """Returns the tasks not done yet. The first element of each task must be its input path or page."""
+        pending = [task for task in tasks if not self.is_done(stage, task[0], params)]
+        for task in pending:
+            if isinstance(task[0], Page):
+                task[0].hash_on_read = True  # Recorded once done, the hash is taken while decoding rather than after
+        logger.info(f"{stage}: {len(tasks) - len(pending)} items already done, {len(pending)} to process.")
+        return pending
+
+    def run(self, worker, method, tasks, stage, params, output_path, executor="thread", workers=None):
+        """
+        Like run_tasks, skipping the tasks already done. The first element of each task must be its input path or page,
+        and output_path maps a task to its output. Failures are recorded and retried on the next run.
+        """
+        pending = self.pending(stage, params, tasks)
+
+        failed = []
+        def on_done(task, error):
+            self.record(stage, task[0], params, output_path(*task), error)
+            if error is not None:
+                logger.error(f"{stage}: {task[0]} failed with {error!r}")
+                failed.append(task[0])
+
+        results = run_tasks(worker, method, pending, executor, workers, on_done=on_done)
+        if failed:
+            logger.error(f"{stage}: {len(failed)} items failed, they will be retried on the next run.")
+        return results
+
+def get_manifest(args):
+    if getattr(args, 'no_manifest', False) or not is_page_collection(args.input_path):
+        return None
+    return Manifest(args.manifest or os.path.join(args.output_dir, '.manifest.sqlite'))
+
+def parser_add_manifest_options(parser):
+    parser.add_argument('--manifest', default=None, help='Path of the SQLite manifest used to resume batch runs. Defaults to .manifest.sqlite in the output folder.')
+    parser.add_argument('--no_manifest', action='store_true', help='Process every item, without reading or writing a manifest.')
@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import bisect
+import tempfile
+import threading
+import functools
+from contextlib import contextmanager, nullcontext
+
+# Seconds, from a median blur on a small crop to an LLM generation
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PREFIX = "ocr_"
+SERVICE_NAME = "ocr-book-pages"
+
+# Spans kept in memory before being appended to the trace file
+_FLUSH_SPANS = 512
+
+_NULL_SPAN = nullcontext()
+
+class Metrics:
+    """
+    Counters, histograms and spans of a run. Disabled (and close to free) until configured with an output file.
+    Every span is timed into the <prefix>span_duration_seconds histogram, labelled with the span name. Spans opened
+    within another one in the same thread are its children, so a page is traced from decoding to its last stage.
+    Metrics are written in the Prometheus text format, spans as OTLP JSON lines (one export request per line,
+    as read by the OpenTelemetry collector's file receiver).
+    """
+    def __init__(self):
+        self.enabled = False
+        self.metrics_file = None
+        self.trace_file = None
+        self.exporting = False  # Only the main process writes, process-pool workers hand their records back
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {}
+        self._histograms = {}
+        self._spans = []
+
+    def configure(self, metrics_file=None, trace_file=None, exporting=True, enabled=False):
+        self.metrics_file = metrics_file
+        self.trace_file = trace_file
+        self.enabled = enabled or metrics_file is not None or trace_file is not None
+        self.exporting = exporting and self.enabled
+
+    def get_config(self):
+        return {"metrics_file": self.metrics_file, "trace_file": self.trace_file, "enabled": self.enabled}
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, name, **attributes):
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, attributes)
+
+    @contextmanager
+    def _span(self, name, attributes):
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        span = {
+            "name": name,
+            "trace_id": parent["trace_id"] if parent else os.urandom(16).hex(),
+            "span_id": os.urandom(8).hex(),
+            "parent_id": parent["span_id"] if parent else None,
+            "start": time.time_ns(),
+            "attributes": attributes,
+            "error": None,
+        }
+        stack.append(span)
+        start_time = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span["error"] = repr(e)
+            raise
+        finally:
+            duration = time.perf_counter() - start_time
+            stack.pop()
+            span["end"] = span["start"] + int(duration * 1e9)
+            status = "error" if span["error"] else "ok"
+            self.observe("span_duration_seconds", duration, span=name)
+            self.count("spans_total", span=name, status=status)
+            if self.trace_file is not None:
+                self._record(span)
+
+    def bind(self, fn):
+        """Wraps fn so that spans it opens in another thread (e.g. of an executor) are children of the current span."""
+        if not self.enabled:
+            return fn
+        stack = list(self._stack())
+        @functools.wraps(fn)
+        def bound(*args, **kwargs):
+            previous = self._stack()
+            self._local.stack = list(stack)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.stack = previous
+        return bound
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Bucket counts (the last one above every bound), then the sum and the count
+                histogram = self._histograms[key] = [0] * (len(DURATION_BUCKETS) + 3)
+            histogram[bisect.bisect_left(DURATION_BUCKETS, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def _record(self, span):
+        with self._lock:
+            self._spans.append(span)
+            flush = self.exporting and len(self._spans) >= _FLUSH_SPANS
+        if flush:
+            self._write_spans()
+
+    def collect(self):
+        """Returns and clears what was recorded since the last call, for the main process to merge."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            state = {"counters": self._counters, "histograms": self._histograms, "spans": self._spans}
+            self._counters, self._histograms, self._spans = {}, {}, []
+        return state
+
+    def merge(self, state):
+        if state is None:
+            return
+        with self._lock:
+            for key, value in state["counters"].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, values in state["histograms"].items():
+                histogram = self._histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    histogram[i] += value
+            self._spans.extend(state["spans"])
+            flush = self.exporting and len(self._spans) >= _FLUSH_SPANS
+        if flush:
+            self._write_spans()
+
+    def write(self):
+        """Writes the metrics file and appends the remaining spans to the trace file."""
+        if not self.exporting:
+            return
+        if self.metrics_file is not None:
+            _write_atomic(self.metrics_file, self.prometheus())
+        if self.trace_file is not None:
+            self._write_spans()
+
+    def prometheus(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+        for (name, labels), values in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, value in zip(DURATION_BUCKETS + ("+Inf",), values):
+                cumulative += value
+                lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {values[-2]:.6f}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Total seconds, calls and mean milliseconds per span name, slowest first."""
+        with self._lock:
+            histograms = [(dict(labels).get("span"), values) for (name, labels), values in self._histograms.items()
+                          if name == "span_duration_seconds"]
+        rows = sorted(((span, values[-2], values[-1]) for span, values in histograms), key=lambda row: -row[1])
+        return "\n".join(f"{span:28s} {total:10.3f}s {calls:8d} calls {1000 * total / calls:10.2f}ms" for span, total, calls in rows)
+
+    def _write_spans(self):
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if not spans:
+            return
+        request = {"resourceSpans": [{
+            "resource": {"attributes": _attributes({"service.name": SERVICE_NAME, "process.pid": os.getpid()})},
+            "scopeSpans": [{"scope": {"name": "src"}, "spans": [_otlp_span(span) for span in spans]}],
+        }]}
+        with open(self.trace_file, 'a') as file:
+            file.write(json.dumps(request) + "\n")
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+def _attributes(attributes):
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            value = {"boolValue": value}
+        elif isinstance(value, int):
+            value = {"intValue": str(value)}  # int64 is a string in OTLP JSON
+        elif isinstance(value, float):
+            value = {"doubleValue": value}
+        else:
+            value = {"stringValue": str(value)}
+        result.append({"key": key, "value": value})
+    return result
+
+def _otlp_span(span):
+    result = {
+        "traceId": span["trace_id"],
+        "spanId": span["span_id"],
+        "name": span["name"],
+        "kind": 1,  # Internal
+        "startTimeUnixNano": str(span["start"]),
+        "endTimeUnixNano": str(span["end"]),
+        "attributes": _attributes(span["attributes"]),
+        "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+    }
+    if span["parent_id"] is not None:
+        result["parentSpanId"] = span["parent_id"]
+    return result
+
+def _write_atomic(path, text):
+    # Scrapers (e.g. node_exporter's textfile collector) must never read a half-written file
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+# Shared by every stage of the process
+metrics = Metrics()
+
+def with_metrics(main):
+    """Decorates a subcommand's main(args) to record metrics when --metrics_file or --trace_file is given."""
+    @functools.wraps(main)
+    def wrapper(args):
+        metrics.configure(getattr(args, 'metrics_file', None), getattr(args, 'trace_file', None))
+        try:
+            return main(args)
+        finally:
+            metrics.write()
+            if metrics.enabled:
+                from .logger_config import setup_logger
+                setup_logger().info(f"Time per span:\n{metrics.summary()}")
+    return wrapper
+
+def parser_add_metrics_options(parser):
+    parser.add_argument('--metrics_file', default=None, help='File to write per stage counters and duration histograms to, in the Prometheus text format. Disabled by default.')
+    parser.add_argument('--trace_file', default=None, help='File to append per page spans to, as OpenTelemetry (OTLP JSON) lines. Disabled by default.')
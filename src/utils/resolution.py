@@ -0,0 +1,52 @@
+import cv2
+
+class ResolutionPolicy:
+    """
+    Resolutions the stages work at. Analysis steps (threshold estimation, contour detection) run on a copy at
+    work_dpi, and the image Tesseract reads is resampled once to ocr_dpi. Phone captures carry no meaningful
+    DPI, so it is estimated from the image width, taken as the width of the page, page_width inches.
+    """
+    def __init__(self, work_dpi=None, ocr_dpi=None, page_width=6.0):
+        self.work_dpi = work_dpi
+        self.ocr_dpi = ocr_dpi
+        self.page_width = page_width
+
+    def get_args(self):
+        return {"work_dpi": self.work_dpi, "ocr_dpi": self.ocr_dpi, "page_width": self.page_width}
+
+    def dpi(self, image):
+        return image.shape[1] / self.page_width
+
+    def work_scale(self, image):
+        # Only ever downscale for analysis
+        if self.work_dpi is None:
+            return 1.0
+        return min(1.0, self.work_dpi / self.dpi(image))
+
+    def ocr_width(self):
+        return None if self.ocr_dpi is None else int(round(self.ocr_dpi * self.page_width))
+
+    def to_work(self, image):
+        return resize(image, self.work_scale(image))
+
+    def to_ocr(self, image):
+        if self.ocr_dpi is None:
+            return image
+        return resize(image, self.ocr_dpi / self.dpi(image))
+
+def resize(image, scale):
+    # Within 1% is close enough, and saves a full resampling pass
+    if abs(scale - 1.0) < 0.01:
+        return image
+    interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_CUBIC
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=interpolation)
+
+def get_resolution(args):
+    if getattr(args, 'work_dpi', None) is None and getattr(args, 'ocr_dpi', None) is None:
+        return None
+    return ResolutionPolicy(args.work_dpi, args.ocr_dpi, args.page_width)
+
+def parser_add_resolution_options(parser):
+    parser.add_argument('--work_dpi', type=float, default=None, help='Resolution of the downscaled copy used for threshold estimation and contour detection. Full resolution by default.')
+    parser.add_argument('--ocr_dpi', type=float, default=None, help='Resolution images are resampled to before OCR, e.g. 300. Left as is by default.')
+    parser.add_argument('--page_width', type=float, default=6.0, help='Page width in inches, used to estimate the resolution of the inputs.')
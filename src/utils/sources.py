@@ -0,0 +1,249 @@
+import os
+import cv2
+import queue
+import tarfile
+import zipfile
+import threading
+from functools import lru_cache
+from .cache import hash_bytes, hash_file
+from .imageio import decode_image, read_image, read_image_hashed
+from .metrics import metrics
+
+try:
+    import pypdfium2
+    PDF_AVAILABLE = True
+except ImportError:
+    PDF_AVAILABLE = False
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.webp')
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+PDF_EXTENSIONS = ('.pdf',)
+
+# Resolution PDF pages are rasterized at
+PDF_DPI = 300
+
+# Archives and PDFs stay open per thread, reopening them for every page would reparse their index each time.
+# Forked workers inherit the handles of the parent, whose file offset they would share, so they open their own.
+_handles = threading.local()
+
+def _open(path, kind):
+    handles = _handles.__dict__
+    stat = os.stat(path)
+    key = (kind, path, os.getpid())
+    if key not in handles or handles[key][0] != (stat.st_size, stat.st_mtime):
+        if kind == 'zip':
+            handle = zipfile.ZipFile(path)
+        elif kind == 'tar':
+            handle = tarfile.open(path)
+        else:
+            handle = pypdfium2.PdfDocument(path)
+        handles[key] = ((stat.st_size, stat.st_mtime), handle)
+    return handles[key][1]
+
+@lru_cache(maxsize=64)
+def _container_hash(path, size, mtime_ns):
+    # PDF pages and TIFF frames are identified by the hash of their container, hashed once rather than once per page
+    return hash_file(path)
+
+def _is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+def _archive_kind(path):
+    lower = path.lower()
+    if lower.endswith('.zip'):
+        return 'zip'
+    if lower.endswith(ARCHIVE_EXTENSIONS):
+        return 'tar'
+    return None
+
+class Page:
+    """
+    Lazy reference to a single page: an image file, an image inside a zip/tar archive, a frame of a multi-page TIFF
+    or a page of a PDF. It is light and picklable, and the image is only decoded by read().
+    Files are memory-mapped rather than read. Pages a manifest records are hashed while they are decoded, so that
+    they are read once.
+    """
+    def __init__(self, path, member=None, index=None, name=None, extension=None):
+        self.path = path  # File holding the page
+        self.member = member  # Archive member, if any
+        self.index = index  # Frame or page number, if any
+        stem, ext = os.path.splitext(os.path.basename(member or path))
+        self.name = name or stem  # Used to name the outputs
+        self.extension = extension or ext
+        self._content_hash = None  # Set by read(), from the bytes it decoded, if hash_on_read
+        self.hash_on_read = False  # Set by the manifest, which needs the hash once the page is done
+
+    @property
+    def key(self):
+        # Unique across sources, plain files are identified by their path alone
+        key = os.path.abspath(self.path)
+        if self.member is not None:
+            key += '::' + self.member
+        if self.index is not None:
+            key += f'::{self.index}'
+        return key
+
+    @property
+    def is_file(self):
+        return self.member is None and self.index is None
+
+    @property
+    def filename(self):
+        return self.name + self.extension
+
+    def __repr__(self):
+        return f"Page({self.key!r})"
+
+    def read_bytes(self):
+        if self.member is None:
+            with open(self.path, 'rb') as file:
+                return file.read()
+        if _archive_kind(self.path) == 'zip':
+            return _open(self.path, 'zip').read(self.member)
+        return _open(self.path, 'tar').extractfile(self.member).read()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_content_hash'] = None  # The file may change before the copy reads it
+        state['hash_on_read'] = False  # The hash of the copy would not come back
+        return state
+
+    def read(self):
+        """
+        Returns the page as a BGR image, or a grayscale one for grayscale sources. Pages of uncompressed grayscale
+        TIFFs are read-only views of the mapped file.
+        """
+        with metrics.span('decode', page=self.name):
+            return self._read()
+
+    def _read(self):
+        if self.path.lower().endswith(PDF_EXTENSIONS):
+            return self._render_pdf()
+        if self.is_file:
+            if not self.hash_on_read:
+                return read_image(self.path)
+            image, self._content_hash = read_image_hashed(self.path)
+            return image
+        if self.index is None:
+            data = self.read_bytes()
+            if self.hash_on_read:
+                self._content_hash = hash_bytes(data)
+            return decode_image(data)
+        return read_image(self.path, self.index)
+
+    def _render_pdf(self):
+        if not PDF_AVAILABLE:
+            raise ImportError("Reading PDFs requires pypdfium2, install requirements-pdf.txt.")
+        bitmap = _open(self.path, 'pdf')[self.index].render(scale=PDF_DPI / 72)
+        return cv2.cvtColor(bitmap.to_numpy(), cv2.COLOR_RGB2BGR if bitmap.n_channels == 3 else cv2.COLOR_RGBA2BGR)
+
+    def content_hash(self):
+        if self._content_hash is not None:
+            return self._content_hash
+        if self.member is not None:
+            return hash_bytes(self.read_bytes())
+        if self.index is not None:
+            stat = os.stat(self.path)
+            return f"{_container_hash(os.path.abspath(self.path), stat.st_size, stat.st_mtime_ns)}:{self.index}"
+        return hash_file(self.path)
+
+def as_page(page):
+    return page if isinstance(page, Page) else Page(page)
+
+def is_page_collection(path):
+    """Whether the path holds several pages, i.e. is a folder, an archive, a PDF or a multi-page TIFF."""
+    if os.path.isdir(path):
+        return True
+    if not os.path.isfile(path):
+        return False
+    lower = path.lower()
+    if lower.endswith(ARCHIVE_EXTENSIONS + PDF_EXTENSIONS):
+        return True
+    return lower.endswith(TIFF_EXTENSIONS) and cv2.imcount(path) > 1
+
+def _file_pages(path, prefix_members=False):
+    lower = path.lower()
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if _archive_kind(path) is not None:
+        return _archive_pages(path, prefix_members)
+    if lower.endswith(PDF_EXTENSIONS):
+        if not PDF_AVAILABLE:
+            raise ImportError("Reading PDFs requires pypdfium2, install requirements-pdf.txt.")
+        return [Page(path, index=i, name=f"{stem}_{i + 1:04d}", extension='.png') for i in range(len(_open(path, 'pdf')))]
+    if lower.endswith(TIFF_EXTENSIONS):
+        count = cv2.imcount(path)
+        if count > 1:
+            return [Page(path, index=i, name=f"{stem}_{i + 1:04d}", extension='.png') for i in range(count)]
+    if _is_image(path):
+        return [Page(path)]
+    return []
+
+def _archive_pages(path, prefix_members=False):
+    if _archive_kind(path) == 'zip':
+        members = [info.filename for info in _open(path, 'zip').infolist() if not info.is_dir()]
+    else:
+        members = [info.name for info in _open(path, 'tar').getmembers() if info.isfile()]
+    # Members in subfolders are named after their full path, so that pages of different chapters do not collide.
+    # Within a folder they are also prefixed by the archive name, in case several archives are in it.
+    prefix = os.path.basename(path).split('.')[0] + '_' if prefix_members else ''
+    return [Page(path, member, name=prefix + os.path.splitext(member)[0].replace('/', '_'))
+            for member in sorted(members) if _is_image(member) and not os.path.basename(member).startswith('.')]
+
+def list_pages(path):
+    """
+    Lists the pages of a folder, archive, PDF, TIFF or image without decoding them. Folders are not walked recursively,
+    but the archives, PDFs and multi-page TIFFs in them are expanded.
+    """
+    if not os.path.isdir(path):
+        return _file_pages(path)
+    pages = []
+    for filename in sorted(os.listdir(path)):
+        file_path = os.path.join(path, filename)
+        if os.path.isfile(file_path):
+            pages.extend(_file_pages(file_path, prefix_members=True))
+    return pages
+
+def prefetch(pages, size=4):
+    """
+    Yields (page, image) for every page, decoding the next ones in a background thread.
+    At most size decoded pages wait in memory. Pages that fail to decode are yielded with a None image.
+    """
+    buffer = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        for page in pages:
+            try:
+                image = page.read()
+            except Exception:
+                image = None
+            if not put((page, image)):
+                return
+        put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            yield item
+    finally:
+        # Let the producer exit if the consumer stops early
+        stop.set()
+
+def iter_pages(path, prefetch_size=4):
+    """Decodes the pages of any source in order, prefetching in the background."""
+    return prefetch(list_pages(path), prefetch_size)
@@ -0,0 +1,104 @@
+import time
+import queue
+import threading
+from .metrics import metrics
+
+class Stage:
+    """A step of a staged run, fn(item) returns the item handed to the next stage. Runs on workers threads."""
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, workers={self.workers})"
+
+def run_stages(items, stages, queue_size=4):
+    """
+    Runs every item through the stages, all stages working at the same time on different items.
+    Stages are connected by queues holding at most queue_size items, so a slow stage blocks the ones before it
+    (backpressure) rather than letting finished items pile up in memory.
+    Yields (item, result, error) as items leave the last stage, in completion order. An item whose stage raised
+    skips the remaining stages and is yielded with the error. The caller may stop iterating early.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    done = object()
+    stop = threading.Event()
+
+    def put(q, entry, name=None):
+        try:
+            q.put_nowait(entry)
+            return True
+        except queue.Full:
+            pass
+        # Time spent held back by a slower next stage
+        start_time = time.perf_counter()
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                if name is not None:
+                    metrics.observe('stage_blocked_seconds', time.perf_counter() - start_time, stage=name)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return done
+
+    def feed():
+        for item in items:
+            if not put(queues[0], (item, item, None)):
+                return
+        put(queues[0], done)
+
+    def work(i, stage, remaining, lock):
+        inbox, outbox = queues[i], queues[i + 1]
+        while True:
+            entry = get(inbox)
+            if entry is done:
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                # The last worker of the stage to finish tells the next stage, the others pass the marker on to it
+                put(outbox if last else inbox, done)
+                return
+            item, value, error = entry
+            if error is None:
+                try:
+                    with metrics.span(f'stage.{stage.name}'):
+                        value = stage.fn(value)
+                except Exception as e:
+                    value, error = None, e
+                    metrics.count('stage_errors_total', stage=stage.name)
+            if not put(outbox, (item, value, error), stage.name):
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True, name="stage-feed")]
+    for i, stage in enumerate(stages):
+        remaining, lock = [stage.workers], threading.Lock()
+        threads += [threading.Thread(target=work, args=(i, stage, remaining, lock), daemon=True, name=f"stage-{stage.name}-{n}")
+                    for n in range(stage.workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            entry = queues[-1].get()
+            if entry is done:
+                return
+            yield entry
+    finally:
+        # Let every stage exit if the consumer stops early
+        stop.set()
+
+def parser_add_stage_options(parser, stages):
+    parser.add_argument('--staged', action='store_true', help=f'Run the {", ".join(stages)} stages concurrently on different pages, each with its own workers, instead of running every step of a page in one worker.')
+    for stage in stages:
+        parser.add_argument(f'--{stage}_workers', type=int, default=1, help=f'Threads of the {stage} stage, with --staged.')
+    parser.add_argument('--queue_size', type=int, default=4, help='Pages waiting between two stages at most, with --staged. A slow stage holds back the ones before it.')
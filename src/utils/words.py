@@ -0,0 +1,121 @@
+import os
+import tempfile
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+# Tesseract's TSV columns and how they are stored. Levels are 1 page, 2 block, 3 paragraph, 4 line and 5 word,
+# so the block/paragraph/line hierarchy and its boxes are kept along with the words.
+NUMERIC_COLUMNS = {
+    "level": "int8", "page_num": "int16", "block_num": "int32", "par_num": "int32", "line_num": "int32", "word_num": "int32",
+    "left": "int32", "top": "int32", "width": "int32", "height": "int32", "conf": "float32",
+}
+WORDS_DIR = ".words"
+
+def _require_parquet():
+    if not PARQUET_AVAILABLE:
+        raise ImportError("The parquet output requires pyarrow, install requirements-parquet.txt.")
+
+def page_table(data, page):
+    """Arrow table of one page from the columns returned by parse_tsv."""
+    _require_parquet()
+    columns = {"page": pa.array([page] * len(data["text"]), pa.string()).dictionary_encode()}
+    for name, dtype in NUMERIC_COLUMNS.items():
+        columns[name] = pa.array(np.asarray(data[name]).astype(dtype))
+    columns["text"] = pa.array(data["text"], pa.string())
+    return pa.table(columns)
+
+def _write_atomic(path, write):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    os.close(fd)
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def page_path(output_dir, name):
+    return os.path.join(output_dir, WORDS_DIR, name + '.parquet')
+
+def write_page(output_dir, data, name):
+    """Writes the words of a page next to the others of its book, until they are merged by write_book."""
+    path = page_path(output_dir, name)
+    _write_atomic(path, lambda tmp_path: pq.write_table(page_table(data, name), tmp_path, compression='zstd'))
+    return path
+
+def write_book(path, page_paths, row_group_size=65536):
+    """
+    Merges the page files, in order, into a single file per book. Pages are streamed one by one, and each row
+    gets the page_index of its page so that readers can select page ranges from the row group statistics.
+    """
+    _require_parquet()
+    page_paths = [path for path in page_paths if os.path.exists(path)]
+
+    def write(tmp_path):
+        writer = None
+        for page_index, page_file in enumerate(page_paths):
+            table = pq.read_table(page_file)
+            table = table.append_column("page_index", pa.array(np.full(len(table), page_index, dtype=np.int32)))
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression='zstd')
+            writer.write_table(table, row_group_size=row_group_size)
+        if writer is not None:
+            writer.close()
+
+    _write_atomic(path, write)
+    return path
+
+class WordsReader:
+    """
+    Reads the OCR output of a book written with --output_format parquet. Columns are only read when requested,
+    and page and confidence filters are pushed down to the row groups.
+    """
+    def __init__(self, path):
+        _require_parquet()
+        self.path = path
+
+    @property
+    def pages(self):
+        data = self.read(columns=["page_index", "page"], level=None)
+        _, first = np.unique(data["page_index"], return_index=True)
+        return [data["page"][i] for i in first]
+
+    def read(self, pages=None, columns=None, min_conf=None, level=5):
+        """
+        Returns a dict of NumPy columns, like parse_tsv, with the rows of the given pages (all by default) and level
+        (words by default, None for every level). Missing words are None.
+        """
+        filters = []
+        if pages is not None:
+            filters.append(("page", "in", list(pages)))
+        if level is not None:
+            filters.append(("level", "=", level))
+        if min_conf is not None:
+            filters.append(("conf", ">=", min_conf))
+        table = pq.read_table(self.path, columns=columns, filters=filters or None)
+        data = {}
+        for name in table.column_names:
+            column = table.column(name).combine_chunks()
+            if pa.types.is_dictionary(column.type):
+                column = column.dictionary_decode()
+            data[name] = column.to_numpy(zero_copy_only=False)
+        return data
+
+    def text(self, page, nan_thresh=0.5):
+        """Text of a page, the same that the txt output holds."""
+        from ..ocr import TextExtractor
+        data = self.read(pages=[page], columns=list(NUMERIC_COLUMNS) + ["text"], level=None)
+        data = {name: values.astype(np.int64) if name in NUMERIC_COLUMNS and name != "conf" else values for name, values in data.items()}
+        return TextExtractor(nan_thresh=nan_thresh).words_to_text(data)
+
+    def search(self, word, case_sensitive=False):
+        """Returns the page and box of every occurrence of a word."""
+        table = pq.read_table(self.path, columns=["page", "left", "top", "width", "height", "conf", "text"], filters=[("level", "=", 5)])
+        text = table.column("text")
+        mask = pc.equal(text, word) if case_sensitive else pc.equal(pc.utf8_lower(text), word.lower())
+        matches = table.filter(pc.fill_null(mask, False))
+        return [dict(row) for row in matches.to_pylist()]
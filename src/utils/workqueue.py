@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from .logger_config import setup_logger
+
+logger = setup_logger()
+
+class WorkQueue:
+    """
+    SQLite queue of work units, meant to live on storage shared by every node. Workers lease units for a limited
+    time, renew the lease while they work, and acknowledge them when done. Units whose lease expired (the worker
+    died or lost the storage) are handed to another worker, and failed units are retried up to max_attempts times.
+    Rollback journaling is used rather than WAL, which needs shared memory and does not work across machines.
+    """
+    def __init__(self, path, lease_seconds=600, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=120, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()  # The connection is shared with the lease renewal thread
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (job TEXT PRIMARY KEY, params TEXT, created REAL);
+            CREATE TABLE IF NOT EXISTS units (
+                job TEXT, book TEXT, start INTEGER, stop INTEGER, payload TEXT,
+                status TEXT, attempts INTEGER, worker TEXT, lease_expires REAL, error TEXT, updated REAL,
+                PRIMARY KEY (job, book, start)
+            );
+            CREATE INDEX IF NOT EXISTS units_status ON units (status, lease_expires);
+            CREATE TABLE IF NOT EXISTS books (job TEXT, book TEXT, finalized INTEGER, PRIMARY KEY (job, book));
+        """)
+
+    def _transaction(self, fn):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can never lease the same unit
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+                self.conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def submit(self, job, params, units):
+        """
+        Adds the units (book, start, stop, payload) of a job. Units already queued are kept as they are, except
+        failed ones which are retried. Returns the number of units added or requeued.
+        """
+        def submit():
+            self.conn.execute("INSERT OR IGNORE INTO jobs VALUES (?, ?, ?)", (job, json.dumps(params, default=str), time.time()))
+            changed = 0
+            for book, start, stop, payload in units:
+                cursor = self.conn.execute("INSERT OR IGNORE INTO units VALUES (?, ?, ?, ?, ?, 'pending', 0, NULL, NULL, NULL, ?)",
+                                           (job, book, start, stop, json.dumps(payload), time.time()))
+                if cursor.rowcount == 0:
+                    cursor = self.conn.execute("UPDATE units SET status = 'pending', attempts = 0, error = NULL, updated = ? "
+                                               "WHERE job = ? AND book = ? AND start = ? AND status = 'failed'", (time.time(), job, book, start))
+                changed += cursor.rowcount
+                self.conn.execute("INSERT OR IGNORE INTO books VALUES (?, ?, 0)", (job, book))
+                if cursor.rowcount:
+                    self.conn.execute("UPDATE books SET finalized = 0 WHERE job = ? AND book = ?", (job, book))
+            return changed
+        return self._transaction(submit)
+
+    def lease(self, worker):
+        """Returns the next unit as a dict, leased to the worker, or None if none is available right now."""
+        def lease():
+            now = time.time()
+            # Expired on their last attempt, nobody will pick them up again
+            self.conn.execute("UPDATE units SET status = 'failed', error = 'Lease expired', updated = ? "
+                              "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+            row = self.conn.execute("""
+                SELECT job, book, start, stop, payload, attempts FROM units
+                WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ?
+                ORDER BY status = 'leased', job, book, start LIMIT 1""", (now, self.max_attempts)).fetchone()
+            if row is None:
+                return None
+            job, book, start, stop, payload, attempts = row
+            self.conn.execute("UPDATE units SET status = 'leased', attempts = ?, worker = ?, lease_expires = ?, updated = ? "
+                              "WHERE job = ? AND book = ? AND start = ?", (attempts + 1, worker, now + self.lease_seconds, now, job, book, start))
+            if attempts > 0:
+                logger.warning(f"{worker}: retrying {book} [{start}:{stop}], attempt {attempts + 1} of {self.max_attempts}.")
+            return {"job": job, "book": book, "start": start, "stop": stop, "payload": json.loads(payload), "attempt": attempts + 1}
+        return self._transaction(lease)
+
+    def renew(self, unit, worker):
+        """Extends the lease, returns False if the unit was meanwhile handed to another worker."""
+        with self._lock:
+            cursor = self.conn.execute("UPDATE units SET lease_expires = ? WHERE job = ? AND book = ? AND start = ? AND worker = ? AND status = 'leased'",
+                                       (time.time() + self.lease_seconds, unit["job"], unit["book"], unit["start"], worker))
+        return cursor.rowcount == 1
+
+    def ack(self, unit, worker):
+        with self._lock:
+            self.conn.execute("UPDATE units SET status = 'done', lease_expires = NULL, error = NULL, updated = ? "
+                              "WHERE job = ? AND book = ? AND start = ? AND worker = ?", (time.time(), unit["job"], unit["book"], unit["start"], worker))
+
+    def fail(self, unit, worker, error):
+        # Back to pending until the attempts run out
+        with self._lock:
+            self.conn.execute("UPDATE units SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, lease_expires = NULL, error = ?, updated = ? "
+                              "WHERE job = ? AND book = ? AND start = ? AND worker = ?",
+                              (self.max_attempts, repr(error), time.time(), unit["job"], unit["book"], unit["start"], worker))
+
+    def params(self, job):
+        with self._lock:
+            row = self.conn.execute("SELECT params FROM jobs WHERE job = ?", (job,)).fetchone()
+        return json.loads(row[0])
+
+    def claim_book(self, job, book):
+        """True for exactly one caller once every unit of the book is done, which then writes the book-level outputs."""
+        def claim():
+            if self.conn.execute("SELECT COUNT(*) FROM units WHERE job = ? AND book = ? AND status != 'done'", (job, book)).fetchone()[0]:
+                return False
+            return self.conn.execute("UPDATE books SET finalized = 1 WHERE job = ? AND book = ? AND finalized = 0", (job, book)).rowcount == 1
+        return self._transaction(claim)
+
+    def remaining(self):
+        """Units that may still be worked on: pending, or leased (their worker may die and leave them to others)."""
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM units WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM units GROUP BY status").fetchall())
+            failed = self.conn.execute("SELECT book, start, stop, error FROM units WHERE status = 'failed' ORDER BY book, start").fetchall()
+            workers = self.conn.execute("SELECT worker, book, start, stop, lease_expires FROM units WHERE status = 'leased' ORDER BY worker").fetchall()
+        return counts, failed, workers
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class LeaseKeeper:
+    """Renews a unit's lease in the background while it is being worked on."""
+    def __init__(self, work_queue, unit, worker):
+        self.work_queue = work_queue
+        self.unit = unit
+        self.worker = worker
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _renew(self):
+        while not self._stop.wait(self.work_queue.lease_seconds / 3):
+            if not self.work_queue.renew(self.unit, self.worker):
+                logger.warning(f"{self.worker}: lost the lease of {self.unit['book']} [{self.unit['start']}:{self.unit['stop']}].")
+                self.lost = True
+                return
+
+def parser_add_queue_options(parser):
+    parser.add_argument('--queue', required=True, help='Path of the SQLite work queue, on storage shared by every node.')
+    parser.add_argument('--lease', type=float, default=600, help='Seconds a unit stays leased without the worker renewing it before another worker takes it over.')
+    parser.add_argument('--max_attempts', type=int, default=3, help='Times a unit is tried before it is marked as failed.')
@@ -0,0 +1,43 @@
+import random
+import pytest
+
+pytest.importorskip("transformers")
+from src.postprocessing import TextCleanerLLM
+
+WORDS = ["the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "señor", "l'home", "12", "Chapter", "IV."]
+
+class WordTokenizer:
+    """Slow tokenizer, the chunking falls back to words as tokens."""
+    is_fast = False
+
+def make_cleaner(budget, overlap):
+    cleaner = TextCleanerLLM.__new__(TextCleanerLLM)  # No model is loaded, only the chunking is exercised
+    cleaner.tokenizer = WordTokenizer()
+    cleaner.chunk_overlap = overlap
+    cleaner._chunk_budget = lambda: budget
+    return cleaner
+
+def make_text(n_words, seed=0):
+    rng = random.Random(seed)
+    return "".join(rng.choice(WORDS) + rng.choice([" ", " ", " ", "\n", "  ", "\n\n"]) for _ in range(n_words)).strip()
+
+@pytest.mark.parametrize("n_words,budget,overlap", [(50, 100, 8), (300, 64, 8), (1000, 100, 32), (257, 40, 39)])
+def test_chunks_stitch_back_to_the_text(n_words, budget, overlap):
+    cleaner, text = make_cleaner(budget, overlap), make_text(n_words, n_words)
+    chunks, overlaps = cleaner._chunk_text(text)
+    assert len(overlaps) == len(chunks) - 1
+    assert all(len(chunk.split()) <= budget for chunk in chunks)
+    assert all(chunk.endswith(overlap) for chunk, overlap in zip(chunks, overlaps))
+    assert cleaner._stitch(chunks, overlaps) == text
+
+def test_cleaned_chunks_are_stitched_on_their_overlap():
+    cleaner, text = make_cleaner(64, 16), make_text(400, 1)
+    chunks, overlaps = cleaner._chunk_text(text)
+    assert cleaner._stitch([chunk.upper() for chunk in chunks], overlaps) == text.upper()
+
+def test_stream_yields_the_stitched_text():
+    cleaner, text = make_cleaner(64, 16), make_text(400, 2)
+    cleaner._generate = lambda texts, batch_size=1: list(texts)
+    parts = list(cleaner.clean_text_stream(text))
+    assert len(parts) > 1
+    assert "".join(parts) == text
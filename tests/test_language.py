@@ -0,0 +1,41 @@
+import numpy as np
+from src.ocr import TSV_HEADER, parse_tsv
+from src.language import LanguageDetector
+
+class FakeTesseract:
+    """Reads the same words with every language, each language reading them with its own confidence."""
+    def __init__(self, text, confs):
+        self.text = text
+        self.confs = confs
+        self.langs = []
+
+    def detect_script(self, image):
+        return "Latin", 10.0
+
+    def read_crop(self, image, lang):
+        self.langs.append(lang)
+        conf = self.confs.get(lang, 0)
+        return parse_tsv(TSV_HEADER + "".join(f"5\t1\t1\t1\t1\t{i + 1}\t0\t0\t10\t10\t{conf}\t{word}\n" for i, word in enumerate(self.text.split())))
+
+def page():
+    image = np.full((600, 600), 255, np.uint8)
+    image[100:500:20, 50:550] = 0
+    return image
+
+def test_candidates_are_ranked_by_one_read_with_the_script_model():
+    tesseract = FakeTesseract("Der Hund ist nicht in dem Haus, und die Katze auch nicht.", {"deu": 90, "nld": 60, "eng": 95})
+    detector = LanguageDetector(tesseract, "eng+spa+deu+nld+fra", max_scored=2, script_models={"Latin": "script/Latin"})
+    assert detector.detect(page()) == "deu"
+    # Only the two candidates with the most stopwords read the crop on their own, English is never scored
+    assert tesseract.langs == ["script/Latin", "deu", "nld"]
+
+def test_first_candidate_ranks_without_a_script_model():
+    tesseract = FakeTesseract("el perro de la casa y los gatos", {})
+    detector = LanguageDetector(tesseract, "eng+spa+fra", max_scored=1)
+    assert detector.detect(page()) == "spa"
+    assert tesseract.langs == ["eng"]
+
+def test_few_candidates_are_scored_directly():
+    tesseract = FakeTesseract("the dog", {"eng": 90, "deu": 50})
+    assert LanguageDetector(tesseract, "eng+deu").detect(page()) == "eng"
+    assert tesseract.langs == ["eng", "deu"]
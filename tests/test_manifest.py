@@ -0,0 +1,81 @@
+import os
+import pytest
+from src.utils.manifest import Manifest
+from src.utils.sources import Page
+from src.utils.cache import hash_file
+
+PARAMS = {"lang": "eng"}
+
+class Copier:
+    """Writes its input page to the output folder, failing on the pages it is told to."""
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+
+    def process(self, input_path, output_dir):
+        name = os.path.basename(input_path)
+        self.calls.append(name)
+        if name in self.fail:
+            raise ValueError(f"Cannot read {name}")
+        with open(input_path, 'rb') as src, open(output_path(input_path, output_dir), 'wb') as dst:
+            dst.write(src.read())
+
+def output_path(input_path, output_dir):
+    return os.path.join(output_dir, os.path.basename(input_path) + '.out')
+
+@pytest.fixture
+def book(tmp_path):
+    input_dir, output_dir = tmp_path / "book", tmp_path / "out"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    tasks = []
+    for i in range(4):
+        path = input_dir / f"page_{i}.png"
+        path.write_bytes(b"page %d" % i)
+        tasks.append((str(path), str(output_dir)))
+    return tasks, Manifest(str(tmp_path / "manifest.sqlite"))
+
+def run(manifest, worker, tasks, params=PARAMS):
+    manifest.run(worker, 'process', tasks, 'stage', params, output_path, executor='serial')
+
+def test_interrupted_run_resumes_where_it_stopped(book):
+    tasks, manifest = book
+    run(manifest, Copier(), tasks[:2])  # Killed after two pages
+    assert manifest.pending('stage', PARAMS, tasks) == tasks[2:]
+
+    worker = Copier()
+    run(manifest, worker, tasks)
+    assert worker.calls == ["page_2.png", "page_3.png"]
+    assert manifest.pending('stage', PARAMS, tasks) == []
+
+def test_failed_items_are_retried(book):
+    tasks, manifest = book
+    run(manifest, Copier(fail={"page_1.png"}), tasks)
+    assert manifest.pending('stage', PARAMS, tasks) == [tasks[1]]
+    run(manifest, Copier(), tasks)
+    assert manifest.pending('stage', PARAMS, tasks) == []
+
+def test_changed_inputs_outputs_and_params_are_redone(book):
+    tasks, manifest = book
+    run(manifest, Copier(), tasks)
+    with open(tasks[0][0], 'wb') as file:
+        file.write(b"rescanned page")
+    os.remove(output_path(*tasks[3]))
+    assert manifest.pending('stage', PARAMS, tasks) == [tasks[0], tasks[3]]
+    assert manifest.pending('stage', {"lang": "spa"}, tasks) == tasks
+
+def test_touched_but_unchanged_inputs_are_skipped(book):
+    tasks, manifest = book
+    run(manifest, Copier(), tasks)
+    os.utime(tasks[0][0], (0, 0))  # Rehashed, and found identical
+    assert manifest.pending('stage', PARAMS, tasks) == []
+
+def test_pages_are_hashed_while_decoding_only_for_the_manifest(book):
+    tasks, manifest = book
+    pages = [(Page(path), output_dir) for path, output_dir in tasks]
+    pages[0][0].read()
+    assert pages[0][0]._content_hash is None
+    pending = manifest.pending('stage', PARAMS, pages)
+    assert all(page.hash_on_read for page, _ in pending)
+    pending[1][0].read()
+    assert pending[1][0].content_hash() == hash_file(tasks[1][0])
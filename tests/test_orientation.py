@@ -0,0 +1,43 @@
+import cv2
+import numpy as np
+import pytest
+from benchmarks.corpus import render_page, page_text
+from src.orientation import deskew, estimate_skew
+
+TURNS = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+PAGES = {
+    "a4_dense": dict(width=2480, height=3508, lines=40),
+    "a4_sparse": dict(width=2480, height=3508, lines=6),
+    "landscape_dense": dict(width=3508, height=2480, lines=28),
+}
+
+def make_page(width, height, lines, skew, seed=0):
+    rng = np.random.default_rng(seed)
+    return render_page(page_text(rng, lines=lines), rng, width=width, height=height, skew=skew)[0]
+
+@pytest.mark.parametrize("turn", [0, 90, 180, 270])
+@pytest.mark.parametrize("skew", [0, 3])
+@pytest.mark.parametrize("page", PAGES)
+def test_turned_pages_are_put_upright(page, skew, turn):
+    image = make_page(**PAGES[page], skew=skew)
+    turned = cv2.rotate(image, TURNS[turn]) if turn else image
+    rotation, _ = estimate_skew(turned)
+    assert rotation == turn % 180
+    upright, rotation, _ = deskew(turned)
+    assert rotation == (360 - turn) % 360  # Clockwise, undoing the turn
+    assert (upright.shape[0] > upright.shape[1]) == (image.shape[0] > image.shape[1])
+
+def test_skew_is_measured():
+    image = make_page(1600, 2300, 28, skew=0)
+    height, width = image.shape[:2]
+    tilted = cv2.warpAffine(image, cv2.getRotationMatrix2D((width / 2, height / 2), 4, 1.0), (width, height), borderMode=cv2.BORDER_REPLICATE)
+    _, skew = estimate_skew(image)
+    _, tilted_skew = estimate_skew(tilted)
+    assert tilted_skew - skew == pytest.approx(-4, abs=0.3)
+
+def test_blank_page_is_left_alone():
+    blank = np.full((1000, 800), 240, np.uint8)
+    assert estimate_skew(blank) == (0, 0.0)
+    image, rotation, skew = deskew(blank)
+    assert (rotation, skew) == (0, 0.0) and image.shape == blank.shape
@@ -0,0 +1,62 @@
+import json
+import cv2
+import numpy as np
+import pytest
+from benchmarks.corpus import render_page, page_text
+from src.routing import PageRouter, analyze_page
+from src.preprocessing import ImagePreprocessor
+from src.pipeline import Pipeline
+from src.objects import ProcessedImage
+
+def features(curvature=0.0, contrast=0.6, noise=1.0, text_height=20.0):
+    return {"curvature": curvature, "contrast": contrast, "noise": noise, "text_height": text_height}
+
+@pytest.mark.parametrize("page,route", [
+    (features(), {"dewarp": False, "preprocess": "none"}),
+    (features(curvature=0.002), {"dewarp": True, "preprocess": "none"}),
+    (features(noise=6.0), {"dewarp": False, "preprocess": "light"}),
+    (features(contrast=0.4), {"dewarp": False, "preprocess": "light"}),
+    (features(noise=12.0), {"dewarp": False, "preprocess": "heavy"}),
+    (features(contrast=0.2), {"dewarp": False, "preprocess": "heavy"}),
+    (features(noise=12.0, text_height=8.0), {"dewarp": False, "preprocess": "light"}),  # Small text is never eroded
+    (features(noise=12.0, text_height=0.0), {"dewarp": False, "preprocess": "heavy"}),  # No lines measured
+])
+def test_decide(page, route):
+    assert PageRouter().decide(page) == route
+
+def make_page(seed=0, turn=None, **distortions):
+    rng = np.random.default_rng(seed)
+    image = render_page(page_text(rng), rng, **distortions)[0]
+    return cv2.rotate(image, turn) if turn is not None else image
+
+@pytest.mark.parametrize("distortions,route", [
+    (dict(curvature=0, noise=2, border=0), {"dewarp": False, "preprocess": "none"}),
+    (dict(curvature=0, noise=25, border=0), {"dewarp": False, "preprocess": "heavy"}),
+    (dict(curvature=0.03, noise=3), {"dewarp": True, "preprocess": "none"}),
+])
+def test_pages_are_routed(distortions, route):
+    assert PageRouter().decide(analyze_page(make_page(**distortions))) == route
+
+def test_blank_page_goes_straight_to_ocr():
+    assert PageRouter().decide(analyze_page(np.full((800, 600), 235, np.uint8))) == {"dewarp": False, "preprocess": "none"}
+
+def test_routes_are_logged(tmp_path):
+    log = tmp_path / "routes.jsonl"
+    router = PageRouter(route_log=str(log))
+    router.route(make_page(curvature=0, noise=2, border=0), "page_1")
+    record = json.loads(log.read_text())
+    assert record["page"] == "page_1" and record["preprocess"] == "none" and "contrast" in record
+
+@pytest.mark.parametrize("turn", [None, cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180])
+@pytest.mark.parametrize("noise", [2, 25])  # Clean pages are only deskewed, noisy ones fully preprocessed
+def test_routed_pages_are_put_upright(turn, noise):
+    pipeline = Pipeline(preprocessor=ImagePreprocessor(deskew=True), router=PageRouter())
+    page = pipeline.route(ProcessedImage(make_page(curvature=0, noise=noise, border=0, skew=0, turn=turn), "page"))
+    assert page.route["preprocess"] == ("none" if noise == 2 else "heavy")
+    pipeline.preprocess(page)
+    height, width = page.preprocessed_img.shape[:2]
+    assert height > width
+    # The text sits in the upper half of the page, as rendered
+    ink = cv2.cvtColor(page.preprocessed_img, cv2.COLOR_BGR2GRAY) if page.preprocessed_img.ndim == 3 else page.preprocessed_img
+    rows = np.flatnonzero((ink < 128).sum(axis=1) > 0.05 * ink.shape[1])
+    assert rows.mean() < ink.shape[0] / 2
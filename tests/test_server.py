@@ -0,0 +1,68 @@
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from src.server import MicroBatcher
+
+class SlowPages:
+    """Runs items on a pool, every item sleeping its own number of seconds, and remembers how many ran at once."""
+    def __init__(self, workers=8):
+        self.pool = ThreadPoolExecutor(workers)
+        self.running = self.peak = 0
+        self.seen = []
+        self.lock = threading.Lock()
+
+    def run(self, seconds):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(seconds)
+        with self.lock:
+            self.running -= 1
+        return seconds
+
+    def __call__(self, items):
+        self.seen.extend(items)
+        return [self.pool.submit(self.run, item) for item in items]
+
+def test_items_complete_on_their_own():
+    batcher = MicroBatcher(SlowPages(), max_batch=4, max_wait=0.05)
+    slow, fast = batcher.submit(1.0), batcher.submit(0.01)
+    assert fast.result(timeout=0.5) == 0.01
+    assert not slow.done()
+    assert slow.result(timeout=2) == 1.0
+
+def test_running_items_are_bounded():
+    pages = SlowPages()
+    batcher = MicroBatcher(pages, max_batch=8, max_wait=0.01, max_running=2)
+    futures = [batcher.submit(0.05) for _ in range(8)]
+    assert [future.result(timeout=5) for future in futures] == [0.05] * 8
+    assert pages.peak == 2
+    assert batcher.depth()["running"] == 0
+
+def test_errors_and_synchronous_results():
+    def process(items):
+        return [ValueError(item) if item < 0 else item * 2 for item in items]
+    batcher = MicroBatcher(process, max_batch=4, max_wait=0.05)
+    ok, bad = batcher.submit(2), batcher.submit(-1)
+    assert ok.result(timeout=1) == 4
+    with pytest.raises(ValueError):
+        bad.result(timeout=1)
+
+def test_cancelled_items_do_not_run():
+    pages = SlowPages()
+    batcher = MicroBatcher(pages, max_batch=1, max_wait=0, max_running=1)
+    first, second = batcher.submit(0.2), batcher.submit(0.3)
+    assert second.cancel()
+    assert batcher.submit(0.01).result(timeout=2) == 0.01
+    assert first.result() == 0.2 and pages.seen == [0.2, 0.01]
+
+def test_full_queue_is_refused():
+    batcher = MicroBatcher(SlowPages(), max_batch=1, max_wait=0, max_queue=2, max_running=1)
+    batcher.submit(0.5)
+    time.sleep(0.1)  # Running, out of the queue
+    batcher.submit(0.01)
+    batcher.submit(0.01)
+    with pytest.raises(queue.Full):
+        batcher.submit(0.01)
@@ -0,0 +1,12 @@
+import pytest
+from src.ocr import TextExtractor, parse_tsv, TSV_HEADER
+from benchmarks.text_assembly import synthetic_tsv, legacy_get_text
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("nan_thresh", [0.0, 0.3, 0.5, 1.0])
+def test_matches_pandas_implementation(seed, nan_thresh):
+    tsv = synthetic_tsv(500, seed)
+    assert TextExtractor(nan_thresh=nan_thresh)._assemble_text(parse_tsv(tsv), nan_thresh) == legacy_get_text(tsv, nan_thresh)
+
+def test_empty_page():
+    assert TextExtractor()._assemble_text(parse_tsv(TSV_HEADER), 0.5) == legacy_get_text(TSV_HEADER, 0.5)
@@ -0,0 +1,36 @@
+import pytest
+from src.ocr import TextExtractor, parse_tsv
+from benchmarks.text_assembly import synthetic_tsv
+
+pytest.importorskip("pyarrow")
+from src.utils.words import WordsReader, write_page, write_book, page_path
+
+@pytest.fixture
+def book(tmp_path):
+    pages = {f"page_{i:04d}": parse_tsv(synthetic_tsv(300, seed=i)) for i in (2, 0, 1)}
+    for name, data in pages.items():
+        write_page(str(tmp_path), data, name)
+    path = write_book(str(tmp_path / "book.parquet"), [page_path(str(tmp_path), name) for name in pages])
+    return WordsReader(path), pages
+
+def test_pages_keep_the_book_order(book):
+    reader, pages = book
+    assert reader.pages == list(pages)
+
+def test_text_matches_the_txt_output(book):
+    reader, pages = book
+    for name, data in pages.items():
+        assert reader.text(name) == TextExtractor().words_to_text(data)
+
+def test_filters(book):
+    reader, pages = book
+    words = reader.read(pages=["page_0001"], columns=["level", "conf", "text"], min_conf=50)
+    assert len(words["text"]) > 0
+    assert (words["level"] == 5).all() and (words["conf"] >= 50).all()
+
+def test_search(book):
+    reader, pages = book
+    expected = sum(sum(text is not None and text.lower() == "fox" for text in data["text"]) for data in pages.values())
+    matches = reader.search("FOX")
+    assert len(matches) == expected > 0
+    assert {match["page"] for match in matches} <= set(pages)
@@ -0,0 +1,67 @@
+import time
+import pytest
+from src.utils.workqueue import WorkQueue
+
+@pytest.fixture
+def work_queue(tmp_path):
+    work_queue = WorkQueue(str(tmp_path / "queue.sqlite"), lease_seconds=0.3, max_attempts=2)
+    work_queue.submit("job", {"lang": "eng"}, [("book", 0, 10, {"source": "book.zip"}), ("book", 10, 20, {"source": "book.zip"})])
+    return work_queue
+
+def test_units_are_leased_once(work_queue):
+    first, second = work_queue.lease("a"), work_queue.lease("b")
+    assert (first["start"], second["start"]) == (0, 10)
+    assert first["payload"] == {"source": "book.zip"} and first["attempt"] == 1
+    assert work_queue.lease("c") is None
+    assert work_queue.params("job") == {"lang": "eng"}
+
+def test_expired_lease_is_reclaimed(work_queue):
+    unit = work_queue.lease("a")
+    work_queue.lease("a")
+    time.sleep(0.4)
+    reclaimed = work_queue.lease("b")
+    assert (reclaimed["start"], reclaimed["attempt"]) == (unit["start"], 2)
+    # The first worker lost it, and can neither renew nor acknowledge it any more
+    assert not work_queue.renew(unit, "a")
+    work_queue.ack(unit, "a")
+    assert work_queue.stats()[0].get("done", 0) == 0
+    assert work_queue.renew(reclaimed, "b")
+    work_queue.ack(reclaimed, "b")
+    assert work_queue.stats()[0]["done"] == 1
+
+def test_renewed_lease_is_kept(work_queue):
+    units = [work_queue.lease("a"), work_queue.lease("a")]
+    for _ in range(3):
+        time.sleep(0.1)
+        assert all(work_queue.renew(unit, "a") for unit in units)
+    assert work_queue.lease("b") is None
+
+def test_expired_on_last_attempt_fails(work_queue):
+    work_queue.lease("a")
+    work_queue.lease("a")
+    time.sleep(0.4)
+    work_queue.lease("b")
+    work_queue.lease("b")
+    time.sleep(0.4)
+    assert work_queue.lease("c") is None
+    counts, failed, _ = work_queue.stats()
+    assert counts == {"failed": 2}
+    assert [error for *_, error in failed] == ["Lease expired", "Lease expired"]
+    assert work_queue.remaining() == 0
+
+def test_failed_units_are_retried_then_requeued_by_submit(work_queue):
+    for attempt in (1, 2):
+        unit = work_queue.lease("a")
+        assert (unit["start"], unit["attempt"]) == (0, attempt)
+        work_queue.fail(unit, "a", ValueError("bad page"))
+    assert work_queue.stats()[0] == {"failed": 1, "pending": 1}
+    assert work_queue.submit("job", {}, [("book", 0, 10, {})]) == 1
+    assert work_queue.lease("a")["attempt"] == 1
+
+def test_book_is_claimed_once_when_done(work_queue):
+    units = [work_queue.lease("a"), work_queue.lease("a")]
+    work_queue.ack(units[0], "a")
+    assert not work_queue.claim_book("job", "book")
+    work_queue.ack(units[1], "a")
+    assert work_queue.claim_book("job", "book")
+    assert not work_queue.claim_book("job", "book")